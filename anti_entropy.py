@@ -0,0 +1,253 @@
+# Anti-entropy repair between replicas, so that replicas which drifted apart,
+# after a crash or an upload or removal that only reached one of them, end up
+# with the same files again. Intended usage, on a replica:
+#   repairer = anti_entropy.Repairer(share, find_peers, on_change)
+#   backend_protocols["RPC"] = ...  # serve repairer.handlers to other replicas
+#   repairer.start(interval)        # every interval seconds, repair from one peer
+# where find_peers() returns a list of (host, port) addresses of other
+# replicas' back-end ports, and on_change() is called after the share index
+# changes because of a repair.
+#
+# Each replica keeps a Merkle tree over its share index: the files and
+# tombstones (see share_index.py) are spread over 16**depth leaves by a hash of
+# their name, each leaf has a hash of everything in it (name, size, and
+# content digest for a file, just the name for a tombstone), and each node
+# above has a hash of its 16 children's hashes. To repair from a peer, a
+# replica compares the roots, and then asks for the children of only the nodes
+# whose hashes differ, one level at a time, and finally for the contents of
+# only the leaves that differ. So finding the differences takes depth + 2
+# round trips, and the amount sent grows with the number of differences, not
+# the number of files. The tree itself is kept up to date from the share
+# index's change log, so keeping it costs time in proportion to the changes.
+#
+# For each name in a leaf that differs, the newer version wins, by file
+# modification time or tombstone time (copies keep the original's
+# modification time), with the larger digest winning a tie. Repairs only ever
+# pull from the peer: files are copied over rpc directly between the two
+# replicas, and removals are copied as tombstones. Each replica repairs from a
+# random peer now and then, so changes spread to all of them.
+#
+# Times from different machines are compared, so their clocks should be
+# roughly in step. A replica that was gone for longer than
+# share_index.tombstone_ttl can bring back files that were removed meanwhile.
+
+import hashlib    # for tree hashes
+import json       # for leaf contents
+import os         # for os.path.basename()
+import random     # for picking a peer
+import struct     # for node numbers
+import threading  # for the repair thread and the tree lock
+import time       # for time.sleep() and time.perf_counter()
+
+import metrics                           # for prometheus-style metrics
+import rpc                               # for talking to peers
+from multithread_logging import *        # for log() and logerr()
+
+fanout = 16
+depth = 3           # so 4096 leaves
+hash_size = 16
+
+repair_rounds = metrics.Counter("anti_entropy_rounds_total",
+        "Anti-entropy repair rounds, by outcome.", ["outcome"])
+repaired_files = metrics.Counter("anti_entropy_repairs_total",
+        "Files fetched, linked to contents already stored, or removed by anti-entropy repair, by action.", ["action"])
+repair_bytes = metrics.Counter("anti_entropy_bytes_total",
+        "Bytes of file data fetched by anti-entropy repair.")
+
+def leaf_of(name):
+    h = hashlib.blake2b(name.encode("utf-8", "surrogateescape"), digest_size=4).digest()
+    return int.from_bytes(h, "big") % (fanout ** depth)
+
+def entry_line(name, entry):
+    if entry[0] is None:
+        return "%s\0-\n" % (name)
+    return "%s\0%d\0%s\n" % (name, entry[0], entry[2] or "?")
+
+# MerkleTree is a Merkle tree over a share index, see above.
+class MerkleTree:
+    def __init__(self, share):
+        self.share = share
+        self.lock = threading.Lock()
+        self.version = None   # share index version the tree is up to date with
+        self.leaves = [{} for i in range(fanout ** depth)]   # name -> entry
+        # levels[0] is [root hash], levels[depth] has one hash for each leaf
+        self.levels = [[b""] * (fanout ** level) for level in range(depth + 1)]
+
+    # Bring the tree up to date with the share index.
+    def refresh(self):
+        with self.lock:
+            changes = None
+            if self.version is not None:
+                changes, version = self.share.changes_since(self.version)
+            if changes is None:
+                entries, version = self.share.entries()
+                self.leaves = [{} for i in range(fanout ** depth)]
+                for name, entry in entries.items():
+                    self.leaves[leaf_of(name)][name] = entry
+                dirty = set(range(fanout ** depth))
+            else:
+                dirty = set()
+                for name, size in changes:
+                    leaf = leaf_of(name)
+                    entry = self.share.entry(name)
+                    if entry is None:
+                        self.leaves[leaf].pop(name, None)
+                    else:
+                        self.leaves[leaf][name] = entry
+                    dirty.add(leaf)
+            self.version = version
+            for i in dirty:
+                leaf = self.leaves[i]
+                text = "".join([entry_line(name, leaf[name]) for name in sorted(leaf)])
+                self.levels[depth][i] = hashlib.blake2b(text.encode("utf-8", "surrogateescape"),
+                        digest_size=hash_size).digest()
+            for level in range(depth - 1, -1, -1):
+                dirty = set(i // fanout for i in dirty)
+                below = self.levels[level + 1]
+                for i in dirty:
+                    self.levels[level][i] = hashlib.blake2b(b"".join(below[i * fanout:(i + 1) * fanout]),
+                            digest_size=hash_size).digest()
+
+    # Rebuild the whole tree next time, after changes the change log doesn't show.
+    def invalidate(self):
+        with self.lock:
+            self.version = None
+
+    # Return the hashes of the given nodes at one level of the tree.
+    def hashes(self, level, nodes):
+        with self.lock:
+            return [self.levels[level][i] for i in nodes]
+
+    # Return the entries in one leaf, as a dictionary.
+    def leaf(self, i):
+        with self.lock:
+            return dict(self.leaves[i])
+
+# Decide what to do about one name, given our entry for it and the peer's, as
+# returned by ShareIndex.entry(). Returns "fetch", "remove", or None.
+def decide(mine, theirs):
+    if theirs is None:
+        return None
+    if theirs[0] is not None and theirs[2] is None:
+        return None   # the peer doesn't know its digest yet, try again later
+    if mine is not None and mine[0] is not None and theirs[0] is not None and mine[2] == theirs[2]:
+        return None   # same contents
+    if mine is not None and (theirs[1], theirs[2] or "") <= (mine[1], mine[2] or ""):
+        return None   # ours is newer, the peer will fetch it from us
+    if theirs[0] is None:
+        return "remove"
+    return "fetch"
+
+# Repairer keeps a replica's Merkle tree, answers peers' questions about it,
+# and repairs from peers.
+class Repairer:
+    def __init__(self, share, find_peers, on_change):
+        self.share = share
+        self.tree = MerkleTree(share)
+        self.find_peers = find_peers
+        self.on_change = on_change
+        self.handlers = { "tree": self.answer_tree, "leaves": self.answer_leaves, "fetch": self.answer_fetch }
+
+    # Repair from a random peer every interval seconds, in a background thread.
+    def start(self, interval):
+        t = threading.Thread(target=self.run, args=(interval,), name="AntiEntropy")
+        t.daemon = True
+        t.start()
+
+    def run(self, interval):
+        n = self.share.fill_digests()
+        if n > 0:
+            log("Anti-entropy: worked out digests for %d files" % (n))
+            self.tree.invalidate()
+        while True:
+            time.sleep(interval * random.uniform(0.5, 1.5))
+            try:
+                peers = self.find_peers()
+                if len(peers) == 0:
+                    continue
+                self.repair_from(random.choice(peers))
+            except (OSError, rpc.RPCError, ValueError) as err:
+                repair_rounds.inc(("failed",))
+                logerr("Anti-entropy repair failed: %s" % (err))
+
+    # Find what differs from one peer, at the given (host, port) address, and
+    # fetch or remove whatever the peer has newer versions of. Returns a short
+    # description of what was done, for logging.
+    def repair_from(self, addr):
+        start = time.perf_counter()
+        self.tree.refresh()
+        link = rpc.connect(addr, {})
+        try:
+            nodes = [0]
+            for level in range(depth + 1):
+                theirs = self.ask_tree(link, level, nodes)
+                mine = self.tree.hashes(level, nodes)
+                differ = [i for i, a, b in zip(nodes, mine, theirs) if a != b]
+                if level == depth or len(differ) == 0:
+                    break
+                nodes = [c for i in differ for c in range(i * fanout, (i + 1) * fanout)]
+            if len(differ) == 0:
+                repair_rounds.inc(("in_sync",))
+                return "in sync"
+            fetched = removed = 0
+            their_leaves = json.loads(link.call("leaves", json.dumps(differ).encode()))
+            for i, leaf in zip(differ, their_leaves):
+                for name, theirs in leaf.items():
+                    action = decide(self.share.entry(name), theirs)
+                    if action == "fetch":
+                        if self.fetch(link, name, theirs):
+                            fetched += 1
+                    elif action == "remove":
+                        self.share.remove(name, theirs[1])
+                        repaired_files.inc(("remove",))
+                        removed += 1
+        finally:
+            link.close()
+        if fetched + removed > 0:
+            self.on_change()
+        repair_rounds.inc(("repaired",))
+        how = "%d leaves differ, fetched %d files, removed %d (%.1f ms)" % (
+                len(differ), fetched, removed, (time.perf_counter() - start) * 1000)
+        log("Anti-entropy repair from %s:%s: %s" % (addr[0], addr[1], how))
+        return how
+
+    def ask_tree(self, link, level, nodes):
+        reply = link.call("tree", struct.pack("<B%dI" % (len(nodes)), level, *nodes))
+        if len(reply) != hash_size * len(nodes):
+            raise ValueError("peer sent %d bytes of tree hashes, expected %d" % (len(reply), hash_size * len(nodes)))
+        return [reply[i:i + hash_size] for i in range(0, len(reply), hash_size)]
+
+    # Copy one file from the peer, if it still has the version we expect. If we
+    # already have the same contents under some other name, nothing is fetched.
+    def fetch(self, link, name, theirs):
+        if self.share.store_copy(name, theirs[2], theirs[1]):
+            repaired_files.inc(("link",))
+            return True
+        data = link.call("fetch", name.encode("utf-8", "surrogateescape"), timeout=60.0)
+        if len(data) != theirs[0] or hashlib.blake2b(data, digest_size=16).hexdigest() != theirs[2]:
+            return False   # changed since it told us about it
+        self.share.store(name, data, theirs[1])
+        repaired_files.inc(("fetch",))
+        repair_bytes.inc((), len(data))
+        return True
+
+    def answer_tree(self, link, payload):
+        level = payload[0]
+        nodes = struct.unpack_from("<%dI" % ((len(payload) - 1) // 4), payload, 1)
+        if level > depth or any(i >= fanout ** level for i in nodes):
+            raise ValueError("no such tree node")
+        if level == 0:
+            self.tree.refresh()
+        return b"".join(self.tree.hashes(level, nodes))
+
+    def answer_leaves(self, link, payload):
+        leaves = json.loads(payload)
+        if not isinstance(leaves, list) or any(type(i) is not int or not 0 <= i < fanout ** depth for i in leaves):
+            raise ValueError("no such tree node")
+        return json.dumps([self.tree.leaf(i) for i in leaves], separators=(",", ":")).encode()
+
+    def answer_fetch(self, link, payload):
+        name = payload.decode("utf-8", "surrogateescape")
+        if name != os.path.basename(name) or name in ("", ".", ".."):
+            raise ValueError("bad filename")
+        return self.share.read(name)
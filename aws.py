@@ -118,23 +118,19 @@ region_coords = {
     "us-west-2":       (46.15, -123.88),
 }
 
+# These ask the EC2 metadata service directly. See metadata.py for a version
+# that works in either cloud, or on a laptop.
 def get_my_external_ip():
-    import requests
-    r = requests.get('http://169.254.169.254/latest/meta-data/public-ipv4')
-    r.raise_for_status()
-    return r.text
+    import metadata
+    return metadata.AWSMetadata().get_my_external_ip()
 
 def get_my_dns_hostname():
-    import requests
-    r = requests.get('http://169.254.169.254/latest/meta-data/public-hostname')
-    r.raise_for_status()
-    return r.text
+    import metadata
+    return metadata.AWSMetadata().get_my_dns_hostname()
 
 def get_my_zone():
-    import requests
-    r = requests.get('http://169.254.169.254/latest/meta-data/placement/availability-zone/')
-    r.raise_for_status()
-    return r.text
+    import metadata
+    return metadata.AWSMetadata().get_my_zone()
 
 # test code
 if __name__ == "__main__":
@@ -0,0 +1,16 @@
+# Benchmark suite for the cloud file storage service.
+#
+# This starts a local copy of the service, either the single full-server or a
+# central coordinator plus some replicas, all on localhost ports, then drives it
+# with a mix of requests like a crowd of browsers would make, and reports the
+# throughput and latency percentiles as JSON. Run it from the top of the repo:
+#   python3 -m bench --topology full --duration 30 --concurrency 16
+#   python3 -m bench --topology central --replicas 3 --rate 200 > run1.json
+# See bench/__main__.py for all the options.
+#
+# The pieces are:
+#   local_cluster.py  -- starting and stopping the local servers (at the top of the repo)
+#   bench/loadgen.py  -- the workload mix and the closed- and open-loop drivers
+#   bench/micro.py    -- microbenchmarks for request parsing and socket buffering
+#   bench/importtime.py -- how long the server modules take to import
+#   bench/layout.py   -- the ./share/ folder layouts, at large numbers of files
@@ -0,0 +1,99 @@
+# Command-line entry point for the benchmarks. Run from the top of the repo:
+#   python3 -m bench --help
+#   python3 -m bench --topology full --duration 30 --concurrency 16
+#   python3 -m bench --topology central --replicas 3 --rate 200 --output run1.json
+#   python3 -m bench --url http://localhost:8000 --duration 10   # an already-running server
+# The results are printed (or saved) as JSON, so two runs can be compared.
+
+import argparse   # for command-line options
+import json       # for the report
+import os         # for finding the top of the repo
+import platform   # for describing the machine in the report
+import sys        # for sys.stdout and sys.stderr
+import time       # for the report timestamp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import local_cluster
+from bench import loadgen
+
+def parse_args(argv):
+    p = argparse.ArgumentParser(prog="python3 -m bench",
+            description="Benchmark a local copy of the cloud file storage service.")
+    p.add_argument("--topology", choices=["full", "central"], default="full",
+            help="start the single full-server, or a central coordinator plus replicas (default: full)")
+    p.add_argument("--replicas", type=int, default=2,
+            help="number of replicas, for --topology central (default: 2)")
+    p.add_argument("--url", default=None,
+            help="benchmark an already-running server at this url, instead of starting one")
+    p.add_argument("--duration", type=float, default=20.0, help="seconds to measure (default: 20)")
+    p.add_argument("--warmup", type=float, default=3.0, help="seconds to run before measuring (default: 3)")
+    p.add_argument("--concurrency", type=int, default=8,
+            help="closed loop: simulated users; open loop: worker threads (default: 8)")
+    p.add_argument("--rate", type=float, default=None,
+            help="run open loop, with this many operations per second on average (default: closed loop)")
+    p.add_argument("--think-time", type=float, default=0.0,
+            help="closed loop: average seconds each user waits between operations (default: 0)")
+    p.add_argument("--mix", default=None,
+            help="operation weights, like listing=30,small=40,large=10,upload=10,delete=10")
+    p.add_argument("--small-files", type=int, default=20, help="number of small files to seed (default: 20)")
+    p.add_argument("--small-size", type=int, default=4096, help="bytes per small file (default: 4096)")
+    p.add_argument("--large-files", type=int, default=4, help="number of large files to seed (default: 4)")
+    p.add_argument("--large-size", type=int, default=1024*1024, help="bytes per large file (default: 1 MB)")
+    p.add_argument("--seed", type=int, default=1, help="random seed, for repeatable runs (default: 1)")
+    p.add_argument("--output", default=None, help="write the JSON report to this file instead of stdout")
+    p.add_argument("--keep", action="store_true", help="keep the servers' scratch folders, for looking at their logs")
+    return p.parse_args(argv)
+
+def main(argv):
+    args = parse_args(argv)
+    mix = loadgen.default_mix if args.mix is None else loadgen.parse_mix(args.mix)
+
+    topo = None
+    if args.url is not None:
+        url = args.url
+        described = { "kind": "external", "url": url }
+    elif args.topology == "full":
+        topo = local_cluster.start_full_server(args.keep)
+    else:
+        topo = local_cluster.start_cluster(args.replicas, args.keep)
+    if topo is not None:
+        url = topo.url
+        described = topo.describe()
+        print("Started %s topology at %s (scratch folder %s)" % (topo.kind, url, topo.scratch), file=sys.stderr)
+
+    try:
+        gen = loadgen.LoadGenerator(url, mix, args.seed, args.think_time, args.small_size)
+        gen.seed_files(args.small_files, args.small_size, args.large_files, args.large_size)
+        if args.rate is None:
+            mode = "closed"
+            results = gen.run_closed_loop(args.concurrency, args.duration, args.warmup)
+        else:
+            mode = "open"
+            results = gen.run_open_loop(args.rate, args.concurrency, args.duration, args.warmup)
+    finally:
+        if topo is not None:
+            topo.stop()
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": { "python": platform.python_version(), "machine": platform.machine(), "system": platform.system() },
+        "topology": described,
+        "config": {
+            "mode": mode, "duration_s": args.duration, "warmup_s": args.warmup,
+            "concurrency": args.concurrency, "rate": args.rate, "think_time_s": args.think_time,
+            "mix": mix, "seed": args.seed,
+            "small_files": args.small_files, "small_size": args.small_size,
+            "large_files": args.large_files, "large_size": args.large_size,
+        },
+        "results": results.summary(),
+    }
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    return 0 if report["results"]["errors"] == 0 else 2
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
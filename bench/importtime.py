@@ -0,0 +1,155 @@
+# Benchmark for how long it takes to import the server modules, which is most of
+# what a new server process does before it can answer its first request. Run
+# from the top of the repo:
+#   python3 -m bench.importtime                    # run, and compare to the baseline
+#   python3 -m bench.importtime --update-baseline  # run, and save as the new baseline
+#
+# Each module is imported in a fresh python process with "-X importtime", which
+# makes python print how long every import took. This is done several times,
+# keeping the fastest, and the total for the module is compared against
+# bench/importtime_baseline.json, like bench/micro.py does. The slowest of the
+# module's own imports are listed too, which is usually where to look when the
+# total goes up.
+
+import argparse    # for command-line options
+import json        # for the baseline file
+import os          # for paths
+import platform    # for describing the machine
+import subprocess  # for running python
+import sys         # for sys.executable and sys.exit()
+import time        # for the baseline timestamp
+
+from bench.micro import repo_dir, current_commit
+
+baseline_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "importtime_baseline.json")
+
+default_threshold = 0.25   # flag anything more than 25% slower than the baseline
+
+# The modules each kind of server imports at startup. (full-server.py starts
+# serving as soon as it is loaded, so it can't be imported on its own, but it
+# imports mostly the same things as helpers.)
+modules = ["http_helpers", "helpers", "central", "replica", "metadata", "cloud"]
+
+# Import a module in a new python process, and return the total time it took in
+# microseconds, and the times for each module it imported directly, as a list of
+# (name, microseconds) pairs. Modules that python loads while starting up, like
+# site, aren't counted, and modules already loaded by then count as free.
+def import_once(module):
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+            cwd=repo_dir, capture_output=True, text=True, timeout=60)
+    if out.returncode != 0:
+        raise RuntimeError("importing %s failed:\n%s" % (module, out.stderr[-2000:]))
+    lines = []
+    for line in out.stderr.splitlines():
+        # lines look like: "import time:       552 |      99607 |         requests"
+        # where the indentation of the name shows which import pulled it in
+        fields = line[len("import time:"):].split("|")
+        if not line.startswith("import time:") or len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        depth = len(fields[2]) - len(fields[2].lstrip())
+        lines.append((fields[2].strip(), depth, int(fields[1])))
+    # python lists each module after everything it imported, so the module's
+    # direct imports are the lines just above it that are one level deeper
+    i = max(i for i, (name, depth, us) in enumerate(lines) if name == module)
+    total, top = lines[i][2], lines[i][1]
+    children = []
+    for name, depth, us in reversed(lines[:i]):
+        if depth <= top:
+            break
+        if depth == top + 2:
+            children.append((name, us))
+    return total, children
+
+# Import a module several times over, and return the fastest total, and the
+# direct imports from that run.
+def time_import(module, repeat):
+    best = None
+    for r in range(repeat):
+        total, children = import_once(module)
+        if best is None or total < best[0]:
+            best = (total, children)
+    return best
+
+# Return the n slowest of a module's direct imports.
+def heaviest(children, n=4):
+    return sorted(children, key=lambda c: -c[1])[:n]
+
+def load_baseline():
+    try:
+        with open(baseline_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def save_baseline(results):
+    baseline = {
+        "commit": current_commit(),
+        "recorded": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": { "python": platform.python_version(), "machine": platform.machine(),
+                  "system": platform.system(), "processor": platform.processor() },
+        "us": results,
+    }
+    with open(baseline_path, "w") as f:
+        f.write(json.dumps(baseline, indent=2) + "\n")
+
+def main(argv):
+    p = argparse.ArgumentParser(prog="python3 -m bench.importtime",
+            description="Measure how long the server modules take to import.")
+    p.add_argument("--repeat", type=int, default=7, help="imports per module, keeping the fastest (default: 7)")
+    p.add_argument("--threshold", type=float, default=default_threshold,
+            help="flag modules slower than the baseline by more than this fraction (default: %.2f)" % (default_threshold))
+    p.add_argument("--update-baseline", action="store_true", help="save these results as the new baseline")
+    p.add_argument("--json", action="store_true", help="print results as JSON instead of a table")
+    args = p.parse_args(argv)
+
+    baseline = load_baseline()
+    old = {} if baseline is None else baseline["us"]
+
+    results = {}
+    regressions = []
+    rows = []
+    for module in modules:
+        total, children = time_import(module, args.repeat)
+        results[module] = total
+        change = None
+        flag = ""
+        if module in old:
+            change = total / old[module] - 1.0
+            if change > args.threshold:
+                regressions.append(module)
+                flag = "REGRESSION"
+            elif change < -args.threshold:
+                flag = "faster"
+        slowest = heaviest(children)
+        rows.append((module, total, old.get(module), change, flag, slowest))
+        if not args.json:
+            print("%-14s %9.1f ms %9s %8s  %-10s  %s" % (module, total / 1000,
+                    "-" if module not in old else "%.1f ms" % (old[module] / 1000),
+                    "" if change is None else "%+.0f%%" % (change * 100), flag,
+                    ", ".join("%s %.1f" % (name, us / 1000) for name, us in slowest)), flush=True)
+
+    if args.json:
+        print(json.dumps({
+            "commit": current_commit(),
+            "baseline_commit": None if baseline is None else baseline.get("commit"),
+            "results": [{ "module": module, "us": total, "baseline_us": base,
+                          "change": None if change is None else round(change, 4), "flag": flag,
+                          "heaviest": [{ "module": name, "us": us } for name, us in slowest] }
+                        for module, total, base, change, flag, slowest in rows],
+            "regressions": regressions,
+        }, indent=2))
+    elif baseline is None:
+        print("No baseline yet, use --update-baseline to save one.")
+    else:
+        print("Compared to baseline from commit %s, recorded %s." % (baseline.get("commit"), baseline.get("recorded")))
+        if len(regressions) > 0:
+            print("%d regressions, slower by more than %.0f%%: %s" % (len(regressions), args.threshold * 100, ", ".join(regressions)))
+
+    if args.update_baseline:
+        save_baseline(results)
+        print("Saved baseline to %s." % (baseline_path), file=sys.stderr)
+        return 0
+    return 1 if len(regressions) > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,147 @@
+# Benchmark for the ./share/ folder layouts in share_layout.py, at large
+# numbers of files. Run from the top of the repo:
+#   python3 -m bench.layout                            # 10k and 100k files
+#   python3 -m bench.layout --sizes 1000000 --json     # a million files
+#
+# For each size, this fills a scratch folder with that many small files in
+# each layout, then measures, in each one:
+#   scan         a replica's startup with no snapshot: ShareIndex.load()
+#                scanning and stat()'ing every file
+#   rescan       a replica's startup after one upload since its last
+#                snapshot, which only rescans the folders that changed
+#   server_scan  full-server.py's startup scan, listing every file and its size
+#   open         opening and reading a file picked at random, as when serving
+#                a download (median and 99th percentile)
+#   create       creating a new file, as when storing an upload (median and
+#                99th percentile)
+# The scratch folders are removed afterwards, unless --keep is given.
+#
+# Everything here mostly measures the file system and the kernel's caches of
+# folders and inodes, which are warm after the folder is filled. So there is
+# no baseline to compare against; the point is comparing the layouts on the
+# same machine and file system.
+
+import argparse    # for command-line options
+import json        # for printing results
+import os          # for making files
+import random      # for picking files
+import shutil      # for removing the scratch folders
+import sys         # for sys.exit()
+import tempfile    # for the scratch folders
+import time        # for time.perf_counter()
+
+from bench.micro import repo_dir, current_commit
+import share_index
+import share_layout
+
+default_sizes = [10000, 100000]
+samples = 2000     # random opens and creates to time
+
+def file_name(i):
+    return "file-%07d.txt" % (i)
+
+# Make a folder with n small files in the given layout, and return its path.
+def fill(scratch, layout_name, n):
+    root = os.path.join(scratch, "%s-%d" % (layout_name, n), "share")
+    os.makedirs(root)
+    share_layout.write_layout_name(root, layout_name)
+    layout = share_layout.open_layout(root)
+    data = b"x" * 100
+    for i in range(n):
+        fd = os.open(layout.make_path(file_name(i)), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+    return root
+
+def percentile(times, p):
+    times = sorted(times)
+    return times[min(len(times) - 1, int(len(times) * p))]
+
+# Run all the measurements on one filled folder, and return them as a
+# dictionary, with times in milliseconds.
+def measure(root, n):
+    layout = share_layout.open_layout(root)
+    snapshot_path = root + "-index.json"
+    result = {}
+
+    share = share_index.ShareIndex(root, snapshot_path)
+    start = time.perf_counter()
+    share.load()
+    result["scan_ms"] = (time.perf_counter() - start) * 1000
+    if len(share.files) != n:
+        raise RuntimeError("%s: the share index found %d files, expected %d" % (root, len(share.files), n))
+
+    share.save_snapshot()
+    share.store("uploaded-%d.txt" % (n), b"new file")
+    share = share_index.ShareIndex(root, snapshot_path)
+    start = time.perf_counter()
+    how = share.load()
+    result["rescan_ms"] = (time.perf_counter() - start) * 1000
+    result["rescan"] = how
+
+    start = time.perf_counter()
+    sizes = [(entry.name, entry.stat(follow_symlinks=False).st_size) for entry in layout.files()]
+    result["server_scan_ms"] = (time.perf_counter() - start) * 1000
+
+    times = []
+    for i in random.sample(range(n), min(n, samples)):
+        start = time.perf_counter()
+        with open(layout.path(file_name(i)), "rb") as f:
+            f.read()
+        times.append(time.perf_counter() - start)
+    result["open_p50_us"] = percentile(times, 0.50) * 1e6
+    result["open_p99_us"] = percentile(times, 0.99) * 1e6
+
+    times = []
+    for i in range(samples):
+        start = time.perf_counter()
+        with open(layout.make_path("created-%d.txt" % (i)), "wb") as f:
+            f.write(b"y" * 100)
+        times.append(time.perf_counter() - start)
+    result["create_p50_us"] = percentile(times, 0.50) * 1e6
+    result["create_p99_us"] = percentile(times, 0.99) * 1e6
+    return result
+
+def main(argv):
+    p = argparse.ArgumentParser(prog="python3 -m bench.layout",
+            description="Compare the ./share/ folder layouts at large numbers of files.")
+    p.add_argument("--sizes", type=lambda s: [int(n) for n in s.split(",")], default=default_sizes,
+            help="comma-separated numbers of files (default: %s)" % (",".join(str(n) for n in default_sizes)))
+    p.add_argument("--layouts", type=lambda s: s.split(","), default=list(share_layout.layouts),
+            help="comma-separated layouts to compare (default: %s)" % (",".join(share_layout.layouts)))
+    p.add_argument("--dir", default=None, help="where to make the scratch folders (default: a temporary folder)")
+    p.add_argument("--keep", action="store_true", help="don't remove the scratch folders afterwards")
+    p.add_argument("--json", action="store_true", help="print results as JSON instead of a table")
+    args = p.parse_args(argv)
+
+    scratch = tempfile.mkdtemp(prefix="bench-layout-", dir=args.dir)
+    results = []
+    try:
+        for n in args.sizes:
+            for layout_name in args.layouts:
+                start = time.perf_counter()
+                root = fill(scratch, layout_name, n)
+                fill_s = time.perf_counter() - start
+                result = measure(root, n)
+                result.update(files=n, layout=layout_name, fill_s=round(fill_s, 1))
+                results.append(result)
+                if not args.json:
+                    print("%8d %-8s scan %8.1f ms  rescan %8.1f ms  server_scan %8.1f ms  "
+                          "open p50 %6.1f us p99 %7.1f us  create p50 %6.1f us p99 %7.1f us" % (
+                            n, layout_name, result["scan_ms"], result["rescan_ms"], result["server_scan_ms"],
+                            result["open_p50_us"], result["open_p99_us"],
+                            result["create_p50_us"], result["create_p99_us"]), flush=True)
+    finally:
+        if args.keep:
+            print("Kept the scratch folders in %s" % (scratch), file=sys.stderr)
+        else:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps({ "commit": current_commit(), "results": results }, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,359 @@
+# Load generator for the cloud file storage service benchmarks.
+# Intended usage:
+#   gen = loadgen.LoadGenerator("http://localhost:8000", loadgen.default_mix, seed=1)
+#   gen.seed_files(num_small=20, small_size=4096, num_large=4, large_size=1024*1024)
+#   results = gen.run_closed_loop(concurrency=16, duration=30, warmup=5)
+#   results = gen.run_open_loop(rate=200, concurrency=64, duration=30, warmup=5)
+#   print(results.summary())
+#
+# The load is a mix of the things a browser does: viewing the listing page,
+# viewing small files, downloading large files, uploading new files, and
+# deleting files. Redirects are followed the way a browser follows them, so one
+# operation against the central coordinator includes the hop to a replica, and
+# its latency is the whole thing, end to end.
+#
+# There are two ways of driving the load:
+#  - Closed loop: a fixed number of simulated users, each starting its next
+#    operation as soon as the last one finishes (plus optional think time). This
+#    finds the maximum throughput.
+#  - Open loop: operations arrive at a fixed average rate (with random, Poisson
+#    spacing), no matter how fast the server is keeping up. Latency is measured
+#    from when each operation was supposed to start, so when the server falls
+#    behind the queueing delay shows up in the latency, as it would for real
+#    users, instead of quietly lowering the request rate.
+
+import http.client   # for talking HTTP, with persistent connections
+import urllib.parse  # for splitting urls
+import random        # for choosing operations, seeded so runs are repeatable
+import threading     # for worker threads
+import queue         # for handing open-loop arrivals to workers
+import time          # for time.perf_counter() and time.sleep()
+
+# The default mix of operations, as relative weights.
+default_mix = {
+    "listing": 30,      # GET /shared-files.html
+    "small": 40,        # GET /view/ of a small file
+    "large": 10,        # GET /download/ of a large file
+    "upload": 10,       # POST /upload of a new small file
+    "delete": 10,       # POST /delete of a file uploaded earlier in the run
+}
+
+max_redirects = 5
+
+# Parse a mix like "listing=30,small=40,large=10,upload=10,delete=10". Any
+# operation not mentioned gets weight 0.
+def parse_mix(spec):
+    mix = dict.fromkeys(default_mix, 0)
+    for part in spec.split(","):
+        part = part.strip()
+        if len(part) == 0:
+            continue
+        op, weight = part.split("=", 1)
+        op = op.strip()
+        if op not in default_mix:
+            raise ValueError("unknown operation '%s' in mix, should be one of %s" % (op, ", ".join(default_mix)))
+        mix[op] = float(weight)
+    return mix
+
+# Return the value at the given percentile (0 to 100) of a sorted list, using
+# the nearest-rank method.
+def percentile(sorted_values, pct):
+    if len(sorted_values) == 0:
+        return None
+    rank = int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1
+    rank = max(0, min(len(sorted_values) - 1, rank))
+    return sorted_values[rank]
+
+# Results holds latencies and error counts, per operation. Each worker thread
+# has its own Results, so nothing is shared while the benchmark is running, and
+# they are all merged at the end.
+class Results:
+    def __init__(self):
+        self.latencies = {}   # op -> list of seconds
+        self.errors = {}      # op -> number of failed operations
+        self.elapsed = 0.0    # length of the measured part of the run, in seconds
+
+    def record(self, op, seconds, ok):
+        if ok:
+            self.latencies.setdefault(op, []).append(seconds)
+        else:
+            self.errors[op] = self.errors.get(op, 0) + 1
+
+    def merge(self, other):
+        for op, vals in other.latencies.items():
+            self.latencies.setdefault(op, []).extend(vals)
+        for op, n in other.errors.items():
+            self.errors[op] = self.errors.get(op, 0) + n
+
+    # Summarize latencies (in milliseconds) for a list of seconds.
+    @staticmethod
+    def latency_summary(values):
+        values = sorted(values)
+        if len(values) == 0:
+            return { "count": 0 }
+        return {
+            "count": len(values),
+            "mean_ms": round(sum(values) / len(values) * 1000, 3),
+            "p50_ms": round(percentile(values, 50) * 1000, 3),
+            "p95_ms": round(percentile(values, 95) * 1000, 3),
+            "p99_ms": round(percentile(values, 99) * 1000, 3),
+            "max_ms": round(values[-1] * 1000, 3),
+        }
+
+    # Return everything as a dictionary, ready to be dumped as JSON.
+    def summary(self):
+        all_values = []
+        for vals in self.latencies.values():
+            all_values.extend(vals)
+        num_ok = len(all_values)
+        num_errors = sum(self.errors.values())
+        per_op = {}
+        for op in sorted(set(self.latencies) | set(self.errors)):
+            entry = Results.latency_summary(self.latencies.get(op, []))
+            entry["errors"] = self.errors.get(op, 0)
+            per_op[op] = entry
+        elapsed = max(self.elapsed, 1e-9)
+        return {
+            "duration_s": round(self.elapsed, 3),
+            "operations": num_ok + num_errors,
+            "errors": num_errors,
+            "throughput_ops": round(num_ok / elapsed, 2),
+            "latency": Results.latency_summary(all_values),
+            "per_operation": per_op,
+        }
+
+# Client is one simulated browser. It keeps a persistent connection open to each
+# server it talks to, and follows redirects. Not thread-safe: each worker thread
+# has its own.
+class Client:
+    def __init__(self, base_url, timeout=30.0):
+        u = urllib.parse.urlsplit(base_url)
+        self.host = u.hostname
+        self.port = u.port or 80
+        self.timeout = timeout
+        self.conns = {}   # (host, port) -> http.client.HTTPConnection
+
+    def close(self):
+        for c in self.conns.values():
+            c.close()
+        self.conns = {}
+
+    # Send one request and read the whole response. If the connection was
+    # closed by the server (e.g. idle timeout), reconnect and try once more.
+    def send_once(self, host, port, method, path, body, headers):
+        key = (host, port)
+        for attempt in range(2):
+            c = self.conns.get(key)
+            if c is None:
+                c = http.client.HTTPConnection(host, port, timeout=self.timeout)
+                self.conns[key] = c
+            try:
+                c.request(method, path, body=body, headers=headers)
+                resp = c.getresponse()
+                data = resp.read()
+                if resp.will_close:
+                    c.close()
+                    del self.conns[key]
+                return resp, data
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                c.close()
+                del self.conns[key]
+                if attempt == 1:
+                    raise
+
+    # Make a request, following redirects the way a browser does: a 307 repeats
+    # the same request at the new location, and 302 or 303 switch to GET.
+    # Returns the final (response, body).
+    def request(self, method, path, body=None, headers=None):
+        host, port = self.host, self.port
+        headers = dict(headers or {})
+        for i in range(max_redirects + 1):
+            resp, data = self.send_once(host, port, method, path, body, headers)
+            if resp.status not in (301, 302, 303, 307, 308):
+                return resp, data
+            location = resp.getheader("Location")
+            u = urllib.parse.urlsplit(location)
+            if u.hostname is not None:
+                host, port = u.hostname, u.port or 80
+            path = u.path
+            if u.query:
+                path += "?" + u.query
+            if resp.status in (302, 303) or (resp.status == 301 and method == "POST"):
+                method, body = "GET", None
+                headers.pop("Content-Type", None)
+        raise RuntimeError("too many redirects")
+
+# Build a multipart/form-data body for uploading one file, like a browser does.
+def multipart_upload_body(filename, data):
+    boundary = "----cloud-drive-bench-%016x" % (random.getrandbits(64))
+    parts = [
+        ("--%s\r\n" % (boundary)).encode(),
+        ('Content-Disposition: form-data; name="files[]"; filename="%s"\r\n' % (filename)).encode(),
+        b"Content-Type: application/octet-stream\r\n\r\n",
+        data,
+        ("\r\n--%s--\r\n" % (boundary)).encode(),
+    ]
+    return b"".join(parts), "multipart/form-data; boundary=%s" % (boundary)
+
+# LoadGenerator holds the configuration for one benchmark run.
+class LoadGenerator:
+    def __init__(self, base_url, mix=default_mix, seed=0, think_time=0.0, upload_size=4096):
+        self.base_url = base_url
+        self.ops = [op for op in mix if mix[op] > 0]
+        self.weights = [mix[op] for op in self.ops]
+        if len(self.ops) == 0:
+            raise ValueError("the operation mix is empty")
+        self.seed = seed
+        self.think_time = think_time
+        self.upload_size = upload_size
+        self.small_files = []
+        self.large_files = []
+
+    # Upload the files that the "small" and "large" operations will fetch.
+    def seed_files(self, num_small=20, small_size=4096, num_large=4, large_size=1024*1024):
+        client = Client(self.base_url)
+        rng = random.Random(self.seed)
+        try:
+            for i in range(num_small):
+                name = "bench-small-%d.bin" % (i)
+                self.upload(client, name, rng.randbytes(small_size))
+                self.small_files.append(name)
+            for i in range(num_large):
+                name = "bench-large-%d.bin" % (i)
+                self.upload(client, name, rng.randbytes(large_size))
+                self.large_files.append(name)
+        finally:
+            client.close()
+
+    def upload(self, client, name, data):
+        body, ctype = multipart_upload_body(name, data)
+        resp, _ = client.request("POST", "/upload", body, { "Content-Type": ctype })
+        if resp.status >= 400:
+            raise RuntimeError("upload of %s failed with status %d" % (name, resp.status))
+
+    # Perform one operation. Returns True if it succeeded. The worker parameter
+    # is a dictionary holding the worker's own state: its client, random number
+    # generator, and the names of files it has uploaded (which only it deletes).
+    def do_op(self, op, worker):
+        client = worker["client"]
+        rng = worker["rng"]
+        if op == "delete" and len(worker["uploaded"]) == 0:
+            op = "upload"
+        if op == "listing":
+            resp, _ = client.request("GET", "/shared-files.html")
+        elif op == "small":
+            name = rng.choice(self.small_files)
+            resp, _ = client.request("GET", "/view/" + urllib.parse.quote(name))
+        elif op == "large":
+            name = rng.choice(self.large_files)
+            resp, _ = client.request("GET", "/download/" + urllib.parse.quote(name))
+        elif op == "upload":
+            worker["counter"] += 1
+            name = "bench-up-%d-%d.bin" % (worker["id"], worker["counter"])
+            body, ctype = multipart_upload_body(name, rng.randbytes(self.upload_size))
+            resp, _ = client.request("POST", "/upload", body, { "Content-Type": ctype })
+            if resp.status < 400:
+                worker["uploaded"].append(name)
+        elif op == "delete":
+            name = worker["uploaded"].pop(0)
+            body = urllib.parse.urlencode({ "filename": name })
+            resp, _ = client.request("POST", "/delete", body,
+                    { "Content-Type": "application/x-www-form-urlencoded" })
+        return resp.status < 400
+
+    def new_worker(self, i):
+        return { "id": i, "client": Client(self.base_url), "rng": random.Random(self.seed * 1000003 + i),
+                 "uploaded": [], "counter": 0 }
+
+    # Choose an operation, do it, and record it if we are past the warmup.
+    def timed_op(self, worker, results, measure_from, scheduled=None):
+        op = worker["rng"].choices(self.ops, self.weights)[0]
+        start = time.perf_counter()
+        if scheduled is None:
+            scheduled = start
+        try:
+            ok = self.do_op(op, worker)
+        except Exception:
+            ok = False
+            worker["client"].close()
+        if scheduled >= measure_from:
+            results.record(op, time.perf_counter() - scheduled, ok)
+
+    # Run a closed-loop benchmark: concurrency workers, each doing one operation
+    # after another, for warmup + duration seconds. Only the last duration
+    # seconds are measured.
+    def run_closed_loop(self, concurrency, duration, warmup=0.0):
+        now = time.perf_counter()
+        measure_from = now + warmup
+        stop_at = measure_from + duration
+        all_results = [Results() for i in range(concurrency)]
+
+        def work(i):
+            worker = self.new_worker(i)
+            try:
+                while time.perf_counter() < stop_at:
+                    self.timed_op(worker, all_results[i], measure_from)
+                    if self.think_time > 0:
+                        time.sleep(worker["rng"].expovariate(1.0 / self.think_time))
+            finally:
+                worker["client"].close()
+
+        return self.run_workers(concurrency, work, all_results, measure_from)
+
+    # Run an open-loop benchmark: operations arrive at an average of rate per
+    # second, for warmup + duration seconds, and are handed to a pool of
+    # concurrency workers. Only arrivals in the last duration seconds are measured.
+    def run_open_loop(self, rate, concurrency, duration, warmup=0.0):
+        now = time.perf_counter()
+        measure_from = now + warmup
+        stop_at = measure_from + duration
+        all_results = [Results() for i in range(concurrency)]
+        arrivals = queue.SimpleQueue()
+
+        def work(i):
+            worker = self.new_worker(i)
+            try:
+                while True:
+                    scheduled = arrivals.get()
+                    if scheduled is None:
+                        break
+                    self.timed_op(worker, all_results[i], measure_from, scheduled)
+            finally:
+                worker["client"].close()
+
+        def dispatch():
+            rng = random.Random(self.seed)
+            t = time.perf_counter()
+            while True:
+                t += rng.expovariate(rate)
+                if t >= stop_at:
+                    break
+                delay = t - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                arrivals.put(t)
+            for i in range(concurrency):
+                arrivals.put(None)
+
+        dispatcher = threading.Thread(target=dispatch, name="Dispatcher")
+        dispatcher.daemon = True
+        dispatcher.start()
+        results = self.run_workers(concurrency, work, all_results, measure_from)
+        dispatcher.join()
+        return results
+
+    # Start the worker threads, wait for them all, and merge their results.
+    def run_workers(self, concurrency, work, all_results, measure_from):
+        threads = []
+        for i in range(concurrency):
+            t = threading.Thread(target=work, args=(i,), name="Worker-%d" % (i))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        results = Results()
+        for r in all_results:
+            results.merge(r)
+        results.elapsed = time.perf_counter() - measure_from
+        return results
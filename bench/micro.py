@@ -0,0 +1,292 @@
+# Microbenchmarks for the code that runs on every request: the parsers in
+# http_helpers, and SmartSocket's receive buffering. Run from the top of the repo:
+#   python3 -m bench.micro                      # run, and compare to the baseline
+#   python3 -m bench.micro --filter multipart   # run only some of them
+#   python3 -m bench.micro --update-baseline    # run, and save as the new baseline
+#
+# Each benchmark is timed by running it in a loop long enough to get a stable
+# measurement, several times over, and keeping the fastest. The results are
+# compared against bench/micro_baseline.json, which is checked in, and any that
+# got slower by more than the threshold are flagged as regressions (and the exit
+# status is 1). When a change makes things faster, or a regression is expected,
+# update the baseline and commit it along with the change, so the file records
+# which commit each set of numbers came from.
+#
+# Timings depend on the machine, so only compare against a baseline recorded on
+# the same kind of machine. The baseline records some details to help with that.
+
+import argparse    # for command-line options
+import gc          # for turning off garbage collection while timing
+import json        # for the baseline file
+import os          # for paths
+import platform    # for describing the machine
+import socket      # for socketpair()
+import subprocess  # for asking git which commit this is
+import sys         # for sys.path and sys.exit()
+import time        # for time.perf_counter()
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+import http_helpers
+from smartsocket import SmartSocket
+
+baseline_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "micro_baseline.json")
+
+default_threshold = 0.25   # flag anything more than 25% slower than the baseline
+
+#### Sample inputs ####
+
+browser_headers = "\r\n".join([
+    "Host: localhost:8000",
+    "User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/119.0",
+    "Accept: text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8",
+    "Accept-Language: en-US,en;q=0.5",
+    "Accept-Encoding: gzip, deflate, br",
+    "Connection: keep-alive",
+    "Referer: http://localhost:8000/shared-files.html",
+    "Cookie: session=8f1b2c3d4e5f6a7b8c9d0e1f2a3b4c5d; theme=dark",
+    "Upgrade-Insecure-Requests: 1",
+    "Sec-Fetch-Dest: document",
+    "Sec-Fetch-Mode: navigate",
+    "Sec-Fetch-Site: same-origin",
+    "", ""])
+
+short_params = "filename=My%20Report%20%282022%29.pdf&status=Success%2C+added+file"
+long_params = "&".join(["files[]=file-number-%d.txt" % (i) for i in range(200)])
+
+disposition = 'form-data; name="files[]"; filename="Quarterly Results 2022.pdf"'
+
+boundary = "----WebKitFormBoundary7MA4YWxkTrZu0gW"
+multipart_ctype = "multipart/form-data; boundary=" + boundary
+
+def multipart_body(files):
+    parts = []
+    for name, data in files:
+        parts.append(("--%s\r\n" % (boundary)).encode())
+        parts.append(('Content-Disposition: form-data; name="files[]"; filename="%s"\r\n' % (name)).encode())
+        parts.append(b"Content-Type: application/octet-stream\r\n\r\n")
+        parts.append(data)
+        parts.append(b"\r\n")
+    parts.append(("--%s--\r\n" % (boundary)).encode())
+    return b"".join(parts)
+
+def request_bytes(method, path, body=b""):
+    req = "%s %s HTTP/1.1\r\n" % (method, path) + browser_headers
+    if len(body) > 0:
+        req = req[:-2] + "Content-Type: %s\r\nContent-Length: %d\r\n\r\n" % (multipart_ctype, len(body))
+    return req.encode() + body
+
+# FakeSocket stands in for a real socket, handing out a fixed message at most
+# chunk_size bytes per recv() call, like data trickling in off the network. It
+# starts over from the beginning of the message after it runs out.
+class FakeSocket:
+    def __init__(self, data, chunk_size):
+        self.data = data
+        self.chunk_size = chunk_size
+        self.pos = 0
+
+    def recv(self, n):
+        if self.pos >= len(self.data):
+            self.pos = 0
+        n = min(n, self.chunk_size, len(self.data) - self.pos)
+        piece = self.data[self.pos:self.pos+n]
+        self.pos += n
+        return piece
+
+#### The benchmarks ####
+
+# Each of these returns a function to be timed.
+
+def bench_parse_http_headers():
+    return lambda: http_helpers.parse_http_headers(browser_headers)
+
+def bench_parse_urlencoded_short():
+    return lambda: http_helpers.parse_urlencoded_params(short_params)
+
+def bench_parse_urlencoded_long():
+    return lambda: http_helpers.parse_urlencoded_params(long_params)
+
+def bench_parse_content_disposition():
+    return lambda: http_helpers.parse_content_disposition(disposition)
+
+def bench_parse_multipart(files):
+    body = multipart_body(files)
+    return lambda: http_helpers.parse_multipart_form_data(multipart_ctype, body)
+
+# Receive a request from a real (unix domain) socket. The cost includes sending
+# the request into the other end of the socket pair.
+def bench_recv_request(method, path, body=b""):
+    a, b = socket.socketpair()
+    sock = SmartSocket(b)
+    msg = request_bytes(method, path, body)
+    def run():
+        a.sendall(msg)
+        if http_helpers.recv_one_request_from_client(sock) is None:
+            raise RuntimeError("request was not received")
+    return run
+
+def bench_recv_until(size, chunk_size):
+    msg = b"x" * (size - 4) + b"\r\n\r\n"
+    sock = SmartSocket(FakeSocket(msg, chunk_size))
+    return lambda: sock.recv_until(b"\r\n\r\n")
+
+def bench_recv_exactly(size, chunk_size):
+    sock = SmartSocket(FakeSocket(b"x" * size, chunk_size))
+    return lambda: sock.recv_exactly(size)
+
+# All the benchmarks, as (name, function returning the function to time).
+benchmarks = [
+    ("parse_http_headers", bench_parse_http_headers),
+    ("parse_urlencoded_params/short", bench_parse_urlencoded_short),
+    ("parse_urlencoded_params/200-items", bench_parse_urlencoded_long),
+    ("parse_content_disposition", bench_parse_content_disposition),
+    ("parse_multipart_form_data/1x1KB", lambda: bench_parse_multipart([("a.txt", b"x" * 1024)])),
+    ("parse_multipart_form_data/10x1KB", lambda: bench_parse_multipart([("f%d.txt" % (i), b"x" * 1024) for i in range(10)])),
+    ("parse_multipart_form_data/1x1MB", lambda: bench_parse_multipart([("big.bin", b"x" * (1024*1024))])),
+    ("recv_one_request/GET", lambda: bench_recv_request("GET", "/view/My%20Report.pdf")),
+    ("recv_one_request/POST-multipart-16KB", lambda: bench_recv_request("POST", "/upload",
+            multipart_body([("a.bin", b"x" * (16*1024))]))),
+    ("recv_until/1KB-in-512B-chunks", lambda: bench_recv_until(1024, 512)),
+    ("recv_until/64KB-in-512B-chunks", lambda: bench_recv_until(64*1024, 512)),
+    ("recv_until/64KB-in-4KB-chunks", lambda: bench_recv_until(64*1024, 4096)),
+    ("recv_until/64KB-in-64KB-chunks", lambda: bench_recv_until(64*1024, 64*1024)),
+    ("recv_exactly/64KB-in-512B-chunks", lambda: bench_recv_exactly(64*1024, 512)),
+    ("recv_exactly/64KB-in-4KB-chunks", lambda: bench_recv_exactly(64*1024, 4096)),
+    ("recv_exactly/1MB-in-4KB-chunks", lambda: bench_recv_exactly(1024*1024, 4096)),
+    ("recv_exactly/1MB-in-64KB-chunks", lambda: bench_recv_exactly(1024*1024, 64*1024)),
+]
+
+#### Timing ####
+
+# Time a function, returning the fastest of several runs, in nanoseconds per
+# call. Each run loops enough times to take at least min_time seconds. Like the
+# timeit module, garbage collection is turned off while timing, so a collection
+# triggered by some earlier benchmark's garbage doesn't land in this one.
+def time_function(fn, repeat=5, min_time=0.05):
+    gc.collect()
+    gc.disable()
+    try:
+        return time_loops(fn, repeat, min_time)
+    finally:
+        gc.enable()
+
+def time_loops(fn, repeat, min_time):
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(loops):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        loops *= 10 if elapsed < min_time / 10 else 2
+    best = elapsed / loops
+    for r in range(repeat - 1):
+        start = time.perf_counter()
+        for i in range(loops):
+            fn()
+        best = min(best, (time.perf_counter() - start) / loops)
+    return best * 1e9
+
+def current_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=repo_dir,
+                capture_output=True, text=True, timeout=10)
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def load_baseline():
+    try:
+        with open(baseline_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def save_baseline(results):
+    baseline = {
+        "commit": current_commit(),
+        "recorded": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": { "python": platform.python_version(), "machine": platform.machine(),
+                  "system": platform.system(), "processor": platform.processor() },
+        "ns_per_op": { name: round(ns, 1) for name, ns in results.items() },
+    }
+    with open(baseline_path, "w") as f:
+        f.write(json.dumps(baseline, indent=2) + "\n")
+
+def format_ns(ns):
+    if ns >= 1e6:
+        return "%.2f ms" % (ns / 1e6)
+    elif ns >= 1e3:
+        return "%.2f us" % (ns / 1e3)
+    return "%.0f ns" % (ns)
+
+def main(argv):
+    p = argparse.ArgumentParser(prog="python3 -m bench.micro",
+            description="Microbenchmarks for request parsing and socket buffering.")
+    p.add_argument("--filter", default=None, help="only run benchmarks whose name contains this")
+    p.add_argument("--repeat", type=int, default=5, help="timing runs per benchmark, keeping the fastest (default: 5)")
+    p.add_argument("--threshold", type=float, default=default_threshold,
+            help="flag benchmarks slower than the baseline by more than this fraction (default: %.2f)" % (default_threshold))
+    p.add_argument("--update-baseline", action="store_true", help="save these results as the new baseline")
+    p.add_argument("--json", action="store_true", help="print results as JSON instead of a table")
+    args = p.parse_args(argv)
+
+    baseline = load_baseline()
+    old = {} if baseline is None else baseline["ns_per_op"]
+
+    results = {}
+    regressions = []
+    rows = []
+    for name, setup in benchmarks:
+        if args.filter is not None and args.filter not in name:
+            continue
+        fn = setup()
+        ns = time_function(fn, args.repeat)
+        if name in old and ns / old[name] - 1.0 > args.threshold:
+            # timings are noisy, so before calling it a regression, try again
+            ns = min(ns, time_function(fn, args.repeat * 2))
+        results[name] = ns
+        change = None
+        flag = ""
+        if name in old:
+            change = ns / old[name] - 1.0
+            if change > args.threshold:
+                regressions.append(name)
+                flag = "REGRESSION"
+            elif change < -args.threshold:
+                flag = "faster"
+        rows.append((name, ns, old.get(name), change, flag))
+        if not args.json:
+            print("%-40s %12s %12s %8s  %s" % (name, format_ns(ns),
+                    "-" if name not in old else format_ns(old[name]),
+                    "" if change is None else "%+.0f%%" % (change * 100), flag), flush=True)
+
+    if args.json:
+        print(json.dumps({
+            "commit": current_commit(),
+            "baseline_commit": None if baseline is None else baseline.get("commit"),
+            "results": [{ "name": name, "ns_per_op": round(ns, 1), "baseline_ns_per_op": base,
+                          "change": None if change is None else round(change, 4), "flag": flag }
+                        for name, ns, base, change, flag in rows],
+            "regressions": regressions,
+        }, indent=2))
+    elif baseline is None:
+        print("No baseline yet, use --update-baseline to save one.")
+    else:
+        print("Compared to baseline from commit %s, recorded %s." % (baseline.get("commit"), baseline.get("recorded")))
+        if len(regressions) > 0:
+            print("%d regressions, slower by more than %.0f%%: %s" % (len(regressions), args.threshold * 100, ", ".join(regressions)))
+
+    if args.update_baseline:
+        if args.filter is not None:
+            # keep the baseline numbers for the benchmarks we didn't run
+            for name, ns in old.items():
+                results.setdefault(name, ns)
+        save_baseline(results)
+        print("Saved baseline to %s." % (baseline_path), file=sys.stderr)
+        return 0
+    return 1 if len(regressions) > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,165 @@
+# A content-addressed store for shared files, so that the same contents
+# uploaded under several names, or uploaded again and again, are only stored
+# once. Intended usage:
+#   blobs = blob_store.BlobStore("./share.blobs", "./share.tmp")
+#   blobs.open()                                   # at startup
+#   digest = blobs.put(data, "./share/notes.txt")  # instead of writing the file
+#   blobs.remove("./share/notes.txt", digest)      # instead of os.remove()
+#
+# Each distinct content is stored once, as a "blob" named by a hash of its
+# contents, in a folder tree sharded by the first two bytes of the hash, like
+# ./share.blobs/3f/2a/3f2a9c0e17d4b865..., so no one folder gets too big. Each
+# shared file, like ./share/notes.txt, is a hard link to its blob. So everything
+# that reads ./share/ keeps working as before, and the file system keeps count
+# of how many names each blob has: a blob with a link count of 1 has no names
+# left, and is removed along with the last name. Putting contents that are
+# already stored only adds a link, with no data written at all.
+#
+# Uploads arrive whole in memory, so put() works out the hash before writing
+# anything, and only writes the data if the hash is new. Blobs are written to
+# a temporary folder first and then linked into place, so a crash never leaves
+# a half-written blob. A crash at the wrong moment can leave a blob with no
+# names, and sweep() cleans those up.
+
+import hashlib    # for content hashes
+import itertools  # for numbering temporary names
+import os         # for os.link(), os.replace(), etc.
+import shutil     # for clearing out the temporary folder
+import tempfile   # for temporary files
+import threading  # for threading.Lock()
+
+import metrics    # for prometheus-style metrics
+
+digest_size = 16  # bytes of blake2b hash, the same as the share index's digests
+
+dedup_hits = metrics.Counter("blob_store_dedup_total",
+        "Files stored without writing any data, because the contents were already stored.")
+dedup_bytes = metrics.Counter("blob_store_dedup_bytes_total",
+        "Bytes not written because the contents were already stored.")
+
+# Return the hex digest of some data, as used to name blobs.
+def content_digest(data):
+    return hashlib.blake2b(data, digest_size=digest_size).hexdigest()
+
+# Return the hex digest of a file's contents, reading it a piece at a time.
+def file_digest(path):
+    h = hashlib.blake2b(digest_size=digest_size)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+class BlobStore:
+    def __init__(self, blob_dir, tmp_dir):
+        self.blob_dir = blob_dir.rstrip("/")
+        self.tmp_dir = tmp_dir.rstrip("/")
+        # The lock is held while adding or removing links to blobs, so a blob
+        # isn't removed just as a new name is linked to it.
+        self.lock = threading.Lock()
+        self.names = itertools.count()   # for naming staged links
+
+    # Create the folders if needed, and clear out any temporary files left over
+    # from a crash.
+    def open(self):
+        os.makedirs(self.blob_dir, exist_ok=True)
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        os.makedirs(self.tmp_dir)
+
+    def path(self, digest):
+        return os.path.join(self.blob_dir, digest[0:2], digest[2:4], digest)
+
+    # Store data under the given path, replacing whatever was there, and return
+    # its digest. If the path held a file with different contents, its blob
+    # loses a name, see release().
+    def put(self, data, dest):
+        digest, staged = self.stage(data)
+        try:
+            os.replace(staged, dest)
+        except:
+            os.remove(staged)
+            raise
+        return digest
+
+    # Make sure there is a blob for the data, and return its digest and the
+    # path of a new, temporary name for the blob. The caller moves that into
+    # place with os.replace(). The extra name keeps the blob from being removed
+    # in the meantime, so the move can't fail because of that.
+    def stage(self, data):
+        digest = content_digest(data)
+        staged = self.stage_existing(digest)
+        if staged is not None:
+            dedup_hits.inc()
+            dedup_bytes.inc((), len(data))
+            return digest, staged
+        blob = self.path(digest)
+        staged = os.path.join(self.tmp_dir, "staged-%d" % (next(self.names)))
+        fd, tmp = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            with self.lock:
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                try:
+                    os.link(tmp, blob)
+                except FileExistsError:
+                    pass   # someone else stored the same contents meanwhile
+                os.link(blob, staged)
+        finally:
+            os.remove(tmp)
+        return digest, staged
+
+    # Like stage(), but only if there is already a blob with the given digest.
+    # Returns the temporary name, or None if there is no such blob.
+    def stage_existing(self, digest):
+        staged = os.path.join(self.tmp_dir, "staged-%d" % (next(self.names)))
+        with self.lock:
+            try:
+                os.link(self.path(digest), staged)
+                return staged
+            except FileNotFoundError:
+                return None
+
+    # Remove the file at the given path, and its blob too if that was its last
+    # name. Give the digest if it's known, otherwise it is worked out from the
+    # file, but only if it's the last name.
+    def remove(self, path, digest=None):
+        with self.lock:
+            last = os.stat(path).st_nlink == 2   # just this name and the blob
+            if last and digest is None:
+                digest = file_digest(path)
+            os.remove(path)
+            if last:
+                self.release_locked(digest)
+
+    # Remove a blob if it has no names left, after one of its names was
+    # replaced or removed some other way.
+    def release(self, digest):
+        with self.lock:
+            self.release_locked(digest)
+
+    def release_locked(self, digest):
+        blob = self.path(digest)
+        try:
+            if os.stat(blob).st_nlink == 1:
+                os.remove(blob)
+        except FileNotFoundError:
+            pass
+
+    # Remove blobs with no names left, and return how many there were.
+    def sweep(self):
+        removed = 0
+        for top in os.scandir(self.blob_dir):
+            if not top.is_dir():
+                continue
+            for mid in os.scandir(top.path):
+                if not mid.is_dir():
+                    continue
+                for entry in os.scandir(mid.path):
+                    with self.lock:
+                        try:
+                            if entry.stat().st_nlink == 1:
+                                os.remove(entry.path)
+                                removed += 1
+                        except FileNotFoundError:
+                            pass
+        return removed
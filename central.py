@@ -8,14 +8,18 @@
 
 from helpers import *
 import random
-import requests
 
 from dataclasses import dataclass # use python3's dataclass feature
 import threading                  # for threading.Thread()
 import sys                        # for exiting and command-line args
 from fileshare_helpers import *   # for csci356 filesharing helper code
 from multithread_logging import * # for csci356 logging helper code
-from collections import defaultdict
+import stats                      # for contention-free statistics counters
+import tracing                    # for tracing requests across servers
+import share_index                # for the replicas' file listings
+import inventory_wire             # for the binary /filenames format
+import change_feed                # for change notifications from replicas
+import rpc                        # for talking to replicas over the back-end port
 
 # This data type represents a collection of information about some other
 # replica. You can add or remove variables as you see fit. Use it like this:
@@ -37,18 +41,50 @@ my_frontend_port = None   # port number for the browser-facing listening socket
 my_backend_port = None    # port number for peer-facing listening socket
 my_region = None          # geographic region where this server is located
 
-stats_updates = threading.Condition() # used to synchronize access to statistics variables
-num_connections_so_far = 0  # how many browser connections we have handled so far
-num_connections_now = 0     # how many browser connections we are handling right now
-num_local_files = 0         # number of shared files stored locally on this server
-num_uploads = 0             # how many uploads of shared files we have handled so far
-num_downloads = 0           # how many downloads of shared files we have handled so far
-
+# Statistics counters. Use server_stats.snapshot() to read them all at once.
+server_stats = stats.StatsGroup([
+    "connections_so_far",  # how many browser connections we have handled so far
+    "connections_now",     # how many browser connections we are handling right now
+])
+server_stats.export_metrics({
+    "connections_so_far": ("http_connections_total", "counter", "Browser connections handled so far."),
+    "connections_now": ("http_connections_open", "gauge", "Browser connections being handled right now."),
+})
+metrics.Gauge("replicas", "Replicas known to be alive.", fn=lambda: len(replicaset))
+metrics.Gauge("replica_change_feeds", "Replicas sending change notifications.", fn=lambda: len(replica_links))
+replica_events = metrics.Counter("replica_change_events_total",
+        "File changes received in change notifications, by replica.", ["replica"])
+replica_resyncs = metrics.Counter("replica_resyncs_total",
+        "Times a replica had to send its whole listing in a change notification, by replica.", ["replica"])
+
+# The replicaset and locations are never modified in place. Instead, a new
+# set or dictionary is built and the global variable is switched over to it,
+# so other threads can read them without any locking. The catalog_lock is only
+# needed when switching, to make sure two threads don't both switch at once
+# and lose one of the updates.
+catalog_lock = threading.Lock()
 # val: replica_ip_port_tuple (ip,port)
-replicaset = set()
+replicaset = frozenset()
 # key: filename
 # val: (ip,port)
-locations = defaultdict(tuple)
+locations = {}
+# Each replica's file listing as of the version it last sent, kept up to date
+# by change notifications from the replica, or by asking it for what changed
+# since then. Entries are replaced whole, never modified in place, so they can
+# be read without locking too.
+# key: replica_ip_port_tuple (ip,port)
+# val: (version, {filename: size})
+inventories = {}
+# Replicas with an rpc connection open to our back-end port, which send change
+# notifications over it, so they don't need to be asked for their listings.
+# See change_feed.py and rpc.py.
+# key: replica_ip_port_tuple (ip,port)
+# val: rpc.Connection
+replica_links = {}
+# The listing built from the inventories by gather_shared_file_list(), kept
+# until the next change to them.
+catalog_generation = 0            # goes up by one whenever inventories or replicaset change
+catalog_cache = (None, [])        # (catalog_generation, list of (filename, size) pairs)
 
 # This condition variable is used to signal that some thread
 # crashed, in which case it is time to cleanup and exit the program.
@@ -56,129 +92,313 @@ crash_updates = threading.Condition()
 
 # Create a list of all known shared files, along with their sizes.
 # This returns a list of (filename, size) pairs.
+# Replicas that send change notifications are already up to date, so only the
+# others are asked for their listings. When all the replicas send them, this
+# doesn't talk to any replicas at all.
 def gather_shared_file_list():
-    global replicaset, locations
-
-    all_files, all_sizes = [], []
-    old_replicas_list = []
-    new_replicas = set()
-    new_locations = defaultdict(tuple)
-
-    with stats_updates:
-        old_replicas_list = list(replicaset)
-        stats_updates.notify_all()
-
-    for replica_ip_port_tuple in old_replicas_list:
-        replica_ip = replica_ip_port_tuple[0]
-        replica_port = replica_ip_port_tuple[1]
-        url = 'http://' + replica_ip + ":" + replica_port + "/filenames"
-        try:
-            r = requests.get(url)
-            log("GATHERING FILE LIST from %s" % url)
-            new_replicas.add(replica_ip_port_tuple)
-            allfiles_string = r.content.decode("utf-8")
-            if allfiles_string == "":
-                continue
-            log("response string:%s" % allfiles_string)
-            parsed_files = allfiles_string.split('&')
-            for filename_size_string in parsed_files:
-                fname, size_str = filename_size_string.split(',')
-                size = int(size_str)
+    global locations, catalog_cache
+
+    old_replicas_list = [r for r in replicaset if r not in replica_links]
+    if len(old_replicas_list) > 0:
+        dead = set()
+        with tracing.phase("fanout", "%d replicas" % (len(old_replicas_list))):
+            for replica_ip_port_tuple in old_replicas_list:
+                if not poll_replica(replica_ip_port_tuple):
+                    dead.add(replica_ip_port_tuple)
+        if len(dead) > 0:
+            forget_replicas(dead)
+
+    with catalog_lock:
+        generation, listing = catalog_cache
+        if generation == catalog_generation:
+            return listing
+        generation = catalog_generation
+        all_files, all_sizes = [], []
+        new_locations = {}
+        for replica_ip_port_tuple in replicaset:
+            version, files = inventories.get(replica_ip_port_tuple, (None, {}))
+            replica_ip, replica_port = replica_ip_port_tuple
+            for fname, size in files.items():
                 if fname in new_locations:
                     continue
                 all_files.append(fname)
                 all_sizes.append(size)
                 new_locations[fname] = (replica_ip, str(replica_port))
-        except:
-            log("replica %s is dead" % replica_ip)
-
-    with stats_updates:
-        replicaset = new_replicas
         locations = new_locations
-        stats_updates.notify_all()
-    
-    return list(zip(all_files, all_sizes))
+        listing = list(zip(all_files, all_sizes))
+        catalog_cache = (generation, listing)
+    return listing
+
+# Ask one replica what changed since the version we have of its listing, or
+# for the whole listing if we don't have one, and update its inventory.
+# Returns False if the replica didn't answer.
+def poll_replica(replica_ip_port_tuple):
+    replica_ip = replica_ip_port_tuple[0]
+    replica_port = replica_ip_port_tuple[1]
+    url = 'http://' + replica_ip + ":" + replica_port + "/filenames"
+    version, files = inventories.get(replica_ip_port_tuple, (None, None))
+    if version is not None:
+        url += "?since=%d" % (version)
+    replica_label = replica_ip + ":" + replica_port
+    try:
+        start = time.perf_counter()
+        with tracing.phase("replica_request", replica_label + " /filenames"):
+            r, changes = fetch_inventory(url)
+        metrics.replica_requests.inc((replica_label, "filenames"))
+        metrics.replica_request_seconds.observe(time.perf_counter() - start, (replica_label, "filenames"))
+        logdebug("GATHERING FILE LIST from %s", url)
+    except:
+        log("replica %s is dead" % replica_ip)
+        return False
+    new_version = r.headers.get("X-Inventory-Version")
+    update_inventory(replica_ip_port_tuple, None if new_version is None else int(new_version),
+            changes, r.headers.get("X-Inventory-Delta") == "yes")
+    return True
+
+# Apply a list of (name, size) changes, with size None for a removed file, to a
+# replica's inventory, bringing it up to the given version. If delta is False,
+# the changes are the whole listing instead. Changes older than the inventory
+# we already have are ignored. A version of None means the replica doesn't keep
+# versions, so next time it will be asked for its whole listing again.
+def update_inventory(replica_ip_port_tuple, version, changes, delta):
+    global inventories, catalog_generation
+    with catalog_lock:
+        old_version, files = inventories.get(replica_ip_port_tuple, (None, {}))
+        if delta and old_version is not None and version is not None and version <= old_version:
+            return
+        if delta:
+            if len(changes) > 0:
+                files = dict(files)
+                for fname, size in changes:
+                    if size is None:
+                        files.pop(fname, None)
+                    else:
+                        files[fname] = size
+        else:
+            files = dict(changes)
+        new_inventories = dict(inventories)
+        new_inventories[replica_ip_port_tuple] = (version, files)
+        inventories = new_inventories
+        catalog_generation += 1
+
+# Forget some replicas that have died.
+def forget_replicas(dead):
+    global replicaset, inventories, catalog_generation
+    with catalog_lock:
+        replicaset = replicaset - dead
+        inventories = { r: inv for r, inv in inventories.items() if r not in dead }
+        catalog_generation += 1
+
+# Return the version and the list of (name, size) pairs a replica sent with
+# /register, in the binary format from inventory_wire.py, which has the version
+# in it, or in the "name,size&name,size" text format from older replicas, with
+# the version as a url parameter. The list is None if it can't be decoded.
+def registration_listing(req):
+    try:
+        if req.headers.get("Content-Type", "").startswith(inventory_wire.mime_type):
+            decoder = inventory_wire.InventoryDecoder()
+            records = decoder.feed(req.content)
+            decoder.finish()
+            return decoder.version, [(name, size) for name, size, mtime, digest in records]
+        return req.params.get("version"), share_index.parse_listing(req.plaintext_content)
+    except ValueError as err:
+        logerr("Bad file listing in registration: %s" % (err))
+        return None, None
+
+# Add a replica to the replicaset. Replicas that kept their files from an
+# earlier run send along their file listing and its digest, so their files can
+# be found right away, without waiting for the next gather_shared_file_list().
+# Returns a status message for the replica.
+# A listing that doesn't match its digest is ignored, and the replica is asked
+# for its whole listing later, as if it had sent none.
+def register_replica(ip, port, digest, version, listing):
+    global replicaset, catalog_generation
+    if digest is not None and (listing is None or share_index.inventory_digest(listing) != digest):
+        logerr("Replica %s:%s sent a listing that doesn't match its digest, ignoring it" % (ip, port))
+        digest = None
+    with catalog_lock:
+        replicaset = replicaset | {(ip, port)}
+        catalog_generation += 1
+    if digest is None:
+        return "registered, with 0 files"
+    update_inventory((ip, port), None if version is None else int(version), listing, False)
+    return "registered, with %d files" % (len(listing))
+
+# Handle an rpc connection from a replica, on the back-end port. The replica
+# says who it is with a "hello" call, then sends change notifications, see
+# change_feed.py. While the connection is open, gather_shared_file_list()
+# doesn't need to ask the replica for its listing.
+def handle_replica_rpc(sock, peer_addr, first_line):
+    global replica_links
+    rpc.check_hello(first_line)
+    sock.s.settimeout(3 * change_feed.ping_interval)  # give up after missing a few pings
+    link = rpc.Connection(sock, rpc_handlers)
+    try:
+        link.run()
+    finally:
+        replica = link.peer
+        if replica is not None:
+            with catalog_lock:
+                if replica_links.get(replica) is link:
+                    replica_links = { r: l for r, l in replica_links.items() if r != replica }
+            log("Change notifications from replica %s:%s ended, polling it instead" % replica)
+
+def rpc_hello(link, payload):
+    global replica_links
+    words = payload.decode().split()
+    ip, port = words[0], words[1]
+    replica = (ip, port)
+    link.backend_port = words[2] if len(words) > 2 else None
+    if replica not in replicaset:
+        # we must have restarted since it registered, and it will send its whole
+        # listing next, since we don't have any version of it
+        log("Registering replica ip:port %s:%s again" % (ip, port))
+        register_replica(ip, port, None, None, None)
+    link.peer = replica
+    with catalog_lock:
+        new_links = dict(replica_links)
+        new_links[replica] = link
+        replica_links = new_links
+    log("Change notifications from replica %s:%s" % (ip, port))
+    version = inventories.get(replica, (None, None))[0]
+    return b"" if version is None else str(version).encode()
+
+def rpc_changes(link, payload):
+    if link.peer is None:
+        raise rpc.RPCError("change notification before hello")
+    decoder = inventory_wire.InventoryDecoder()
+    records = decoder.feed(payload)
+    decoder.finish()
+    label = "%s:%s" % link.peer
+    if not decoder.delta:
+        replica_resyncs.inc((label,))
+    update_inventory(link.peer, decoder.version, [(name, size) for name, size, mtime, digest in records], decoder.delta)
+    replica_events.inc((label,), len(records))
+
+def rpc_ping(link, payload):
+    return b"pong"
+
+# Tell a replica where the other replicas' back-end ports are, for anti-entropy
+# repair between them.
+def rpc_peers(link, payload):
+    lines = ["%s %s\n" % (other.peer[0], other.backend_port) for other in replica_links.values()
+            if other is not link and other.backend_port is not None]
+    return "".join(lines).encode()
+
+rpc_handlers = { "hello": rpc_hello, "changes": rpc_changes, "ping": rpc_ping, "peers": rpc_peers }
+backend_protocols["RPC"] = handle_replica_rpc
+
+# Check that a replica is alive, over its rpc connection if it has one, or with
+# an HTTP request if not. Raises an exception if it isn't.
+def ping_replica(replica_ip_port_tuple):
+    import requests
+    replica_label = replica_ip_port_tuple[0] + ":" + replica_ip_port_tuple[1]
+    with tracing.phase("replica_request", replica_label + " ping"):
+        link = replica_links.get(replica_ip_port_tuple)
+        if link is not None:
+            link.call("ping", timeout=2.0)
+            return
+        url = "http://" + replica_label + "/ping"
+        r = requests.get(url, headers=tracing.outgoing_headers())
+    if r.status_code != 200:
+        raise Exception("ping failure during upload !!!!!!")
+
+# Ask a replica for its file listing, or the changes to it, at the given url.
+# The binary format is asked for, but older replicas only know the text one,
+# so either can come back. Returns the response, and a list of (name, size)
+# pairs with size None for removed files.
+def fetch_inventory(url):
+    import requests
+    headers = tracing.outgoing_headers()
+    headers["Accept"] = "%s, text/plain;q=0.5" % (inventory_wire.mime_type)
+    r = requests.get(url, headers=headers, stream=True)
+    r.raise_for_status()
+    if r.headers.get("Content-Type", "").startswith(inventory_wire.mime_type):
+        decoder = inventory_wire.InventoryDecoder()
+        changes = []
+        for piece in r.iter_content(64 * 1024):
+            changes.extend([(name, size) for name, size, mtime, digest in decoder.feed(piece)])
+        decoder.finish()
+        return r, changes
+    text = r.content.decode("utf-8")
+    logdebug("response string:%s", text)
+    if r.headers.get("X-Inventory-Delta") == "yes":
+        return r, share_index.parse_changes(text)
+    return r, share_index.parse_listing(text)
 
 def getFileReplicaTuple(filename):
     gather_shared_file_list()
-    replicaTuple = None
-    with stats_updates:
-        replicaTuple = locations[filename]
-        stats_updates.notify_all()
-    log("replica tuple returning info %s" % str(replicaTuple))
+    with tracing.phase("catalog_lookup", filename):
+        replicaTuple = locations.get(filename, ())
+    logdebug("replica tuple returning info %s", replicaTuple)
     return replicaTuple
 
+# Bounce the client towards a replica, recording which replica we picked. The
+# trace ID goes along in the url, so the replica can add to the same trace.
+def redirect_to_replica(conn, replica_ip, replica_port, req_path, route):
+    metrics.replica_requests.inc((replica_ip + ":" + str(replica_port), route))
+    redirect_to_other_server(conn, "", replica_ip, replica_port, tracing.add_trace_param(req_path))
+
 # Send the dynamically-generated main page to the client.
 def send_main_page(conn, status=None):
-    logwarn("Responding with main page")
+    logdebug("Responding with main page")
     listing = gather_shared_file_list()
-    content = make_pretty_main_page(my_region, my_name, listing, status)
-    content_len = len(content)
-
-    resp = "HTTP/1.1 200 OK\r\n"
-    resp += "Date: %s\r\n" % (http.http_date_now())
-    if conn.keep_alive:
-        resp += "Connection: keep-alive\r\n"
-    else:
-        resp += "Connection: close\r\n"
-    resp += "Content-Length: %d\r\n" % (content_len)
-    resp += "Content-Type: text/html\r\n"
-    log(resp)
-    conn.sock.sendall(resp.encode() + b"\r\n" + content.encode())
+    content = generate_pretty_main_page(my_region, my_name, listing, status)
+    resp = http.HTTPResponse("200 OK", "text/html", content)
+    resp.compress(conn.accept_encoding)
+    http.send_response(conn, resp)
 
 # Handle one browser connection. This will receive an HTTP request, handle it,
 # and repeat this as long as the browser says to keep-alive. If there are any
 # errors, or if the browser says to close, the connection is closed.
 def handle_http_connection(conn):
-    global replicaset, locations, num_connections_so_far, num_connections_now
+    global replicaset
 
     static_file_names = os.listdir("./static/")  # list of static files we can serve
 
-    log("New browser connection from %s:%d" % (conn.client_addr))
-    with stats_updates:
-        num_connections_so_far += 1
-        num_connections_now += 1
-        log("Current number of connections %s" % str(num_connections_now))
-        stats_updates.notify_all()
+    log_sampled("new-conn", "New browser connection from %s:%d", conn.client_addr[0], conn.client_addr[1])
+    server_stats.update(connections_so_far=1, connections_now=1)
     try:
         conn.keep_alive = True
         while conn.keep_alive:
-            log("Waiting for next request")
+            logdebug("Waiting for next request")
             # handle one HTTP request from browser
-            req = http.recv_one_request_from_client(conn.sock)
+            req = http.recv_next_request(conn)
             if req is None:
-                logerr("No request?! Something went terribly wrong, dropping connection.")
+                logdebug("No more requests, dropping connection.")
                 break
-            log(req)
-            conn.num_requests += 1
-            conn.keep_alive = req.keep_alive
+            log_sampled("request", "%s %s", req.method, req.urlpath)
+            logdebug(req)
+            start = time.perf_counter()
+            tracing.begin_trace(req, "central")
         
             # GET /index.html
             if req.method == "GET" and req.path in ["/index.html", "/"]:
-                log("Handler: GET /index.html")
+                logdebug("Handler: GET /index.html")
                 send_redirect_to_main_page(conn, None)
 
             # GET /shared-files.html
             # GET /shared-files.html?status=Some+message+to+be+displayed+on_page
             elif req.method == "GET" and req.path == "/shared-files.html":
-                log("Handler: GET /shared-files.html")
+                logdebug("Handler: GET /shared-files.html")
                 status = None
                 if "status" in req.params:
                     status = req.params["status"]
-                log("Begin trasmitting main page")
+                logdebug("Begin trasmitting main page")
                 send_main_page(conn, status)
-                log("Main page send completed!!!")
+                logdebug("Main page send completed!!!")
             
-            # GET FROM REPLICA /register
-            elif req.method == "GET" and req.path.startswith("/register"):
+            # GET or POST FROM REPLICA /register
+            elif req.method in ["GET", "POST"] and req.path.startswith("/register"):
                 params = req.params
                 ip = params["ip"]
                 port = params["port"]
-                with stats_updates:
-                    replicaset.add((ip, port))
-                    log("Registering replica ip:port %s" % (str(ip) + ":" + str(port)))
-                    stats_updates.notify_all()
-                send_ok(conn, "cool")
+                log("Registering replica ip:port %s" % (str(ip) + ":" + str(port)))
+                version, listing = registration_listing(req)
+                status = register_replica(ip, port, params.get("digest"), version, listing)
+                resp = http.HTTPResponse("200 OK", "text/plain", status)
+                resp.add_header("X-RPC-Port", str(my_backend_port))  # where to open an rpc connection
+                http.send_response(conn, resp)
 
             elif req.method == "GET" and req.path.startswith("/") and req.path[1:] in static_file_names:
                 send_static_local_file(conn, req.path[1:])
@@ -193,12 +413,8 @@ def handle_http_connection(conn):
                     # find a working replica
                     # refresh replicaset
                     gather_shared_file_list()
-                    replicas_list = []
-                    fileset = set()
-                    with stats_updates:
-                        fileset = set(locations.keys())
-                        replicas_list = list(replicaset)
-                        stats_updates.notify_all()
+                    fileset = set(locations.keys())
+                    replicas_list = list(replicaset)
 
                     if len(replicas_list) == 0:
                         logerr("ERR!!!!!! All the replicas are dead!!!!!!!!!")
@@ -214,11 +430,8 @@ def handle_http_connection(conn):
                     replica_ip_port_tuple = random.choice(replicas_list)
                     replica_ip = replica_ip_port_tuple[0]
                     replica_port = replica_ip_port_tuple[1]
-                    url = 'http://' + replica_ip + ":" + replica_port + "/ping"
-                    r = requests.get(url)
-                    if r.status_code != 200:
-                        raise Exception("ping failure during upload !!!!!!")
-                    redirect_to_other_server(conn, "", replica_ip, replica_port, "/upload?filelist=" + ','.join(filtered_file_names))
+                    ping_replica(replica_ip_port_tuple)
+                    redirect_to_replica(conn, replica_ip, replica_port, "/upload?filelist=" + ','.join(filtered_file_names), "upload")
 
             # POST /delete (this version expects filename as an html form parameter)
             elif req.method == "POST" and req.path == "/delete":
@@ -228,38 +441,40 @@ def handle_http_connection(conn):
                     send_redirect_to_main_page(conn, "Missing html form or 'filename' form field?")
                 else:
                     replica_ip, replica_port = getFileReplicaTuple(filename)
-                    redirect_to_other_server(conn, "", replica_ip, replica_port, req.path)
+                    redirect_to_replica(conn, replica_ip, replica_port, req.path, "delete")
             
              # POST /delete/whatever.pdf (this version expects filename as part of URL)
             elif req.method == "POST" and req.path.startswith("/delete/"):
                 filename = req.path[8:]
                 replica_ip, replica_port = getFileReplicaTuple(filename)
-                redirect_to_other_server(conn, "", replica_ip, replica_port, req.path)
+                redirect_to_replica(conn, replica_ip, replica_port, req.path, "delete")
             
             # GET /view/somefile.pdf
             elif req.method == "GET" and req.path.startswith("/view/"):
                 filename = req.path[6:]
                 replica_ip, replica_port = getFileReplicaTuple(filename)
-                redirect_to_other_server(conn, "", replica_ip, replica_port, req.path)
+                redirect_to_replica(conn, replica_ip, replica_port, req.path, "view")
 
             # GET /download/somefile.pdf
             elif req.method == "GET" and req.path.startswith("/download/"):
                 filename = req.path[10:]
                 replica_ip, replica_port = getFileReplicaTuple(filename)
-                redirect_to_other_server(conn, "", replica_ip, replica_port, req.path)
+                redirect_to_replica(conn, replica_ip, replica_port, req.path, "download")
             
             else:
                 send_404_not_found(conn)
 
+            metrics.record_request(req.path, conn.last_status, start, static_file_names)
+            tracing.end_trace(conn.last_status)
+
     except Exception as err:
         logerr("Front-end connection failed: %s" % (err))
         raise err
 
     finally:
-        log("Closing socket connection with %s:%d" % (conn.client_addr))
-        with stats_updates:
-            num_connections_now -= 1
-            stats_updates.notify_all()
+        logdebug("Closing socket connection with %s:%d", conn.client_addr[0], conn.client_addr[1])
+        http.connection_reaper.forget(conn)
+        server_stats.add("connections_now", -1)
         conn.sock.close()
 
 # Given a socket listening on the browser-facing front-end port, wait for and
@@ -271,6 +486,7 @@ def accept_http_connections(listening_sock):
         while True:
             c, a = listening_sock.accept()
             conn = http.HTTPConnection(SmartSocket(c), a)
+            http.connection_reaper.watch(conn)
             t = threading.Thread(target=handle_http_connection, args=(conn,))
             t.daemon = True
             t.start()
@@ -304,8 +520,12 @@ def run_central_server(name, region, frontend_port, backend_port):
     if listening_addr == "localhost":
         listening_addr = "" # when IP isn't known, blank is better than "localhost"
 
+    s1 = None
     s2 = None
     try:
+        # First socket is our backend socket, for diagnostics and monitoring
+        s1 = start_backend_listener(listening_addr, backend_port, crash_updates)
+
         # Second socket is our frontend socket listening for browser connections
         s2 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s2.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -325,6 +545,8 @@ def run_central_server(name, region, frontend_port, backend_port):
         raise err
     finally:
         log("Some thread crashed, cleaning up...")
+        if s1 is not None:
+            s1.close()
         if s2 is not None:
             s2.close()
         log("Finished!")
@@ -0,0 +1,125 @@
+# Change notifications pushed from a replica to the central coordinator, so the
+# coordinator's catalog stays up to date without polling every replica on every
+# page view. Intended usage, on a replica:
+#   feed = change_feed.Publisher(share, central_host, rpc_port, my_ip, my_port, my_backend_port)
+#   feed.start()
+#   ...
+#   share.store(name, data)
+#   feed.notify()          # after every change to the share index
+# and on the central coordinator, see the rpc_handlers in central.py.
+#
+# The publisher keeps an rpc connection (see rpc.py) open to the coordinator's
+# back-end port, which the coordinator tells it when it registers, and all the
+# control traffic between the two goes over it:
+#   hello    call, "<ip> <port> <backend port>", the reply is the version of
+#            this replica's share index the coordinator has, or empty if it
+#            has none
+#   changes  notification, an inventory in the binary format from
+#            inventory_wire.py, either the changes since the last one (a
+#            delta) or, if the share index's change log doesn't go back far
+#            enough for that, the whole listing
+#   ping     call, "<version>", sent every ping_interval seconds when nothing
+#            is changing, so each end can tell the other is still there
+#   peers    call, the reply has a "<ip> <backend port>" line for each of the
+#            other replicas connected to the coordinator, see anti_entropy.py
+# and the coordinator can call "ping" on the replica too, to check it is alive
+# before sending a browser's upload to it.
+#
+# After a change, the publisher waits batch_delay seconds so that a burst of
+# changes goes out as one notification, then sends everything that changed
+# since the last one, taken from the share index's change log. Notifications
+# are handled in order, on a single connection, so none can be lost or applied
+# out of order. If the connection breaks, the publisher reconnects, and the
+# hello reply says where to carry on from.
+#
+# The coordinator gives up on the connection after missing a few pings, and
+# goes back to polling that replica.
+
+import threading  # for the publisher thread
+import time       # for time.sleep()
+
+import inventory_wire                    # for encoding changes
+import rpc                               # for the connection to the coordinator
+from multithread_logging import *        # for log() and logerr()
+
+batch_delay = 0.002     # seconds to wait after a change, for more changes to batch with it
+ping_interval = 5.0     # seconds between pings when nothing is changing
+reconnect_delay = 1.0   # seconds to wait before reconnecting, doubling up to max_reconnect_delay
+max_reconnect_delay = 30.0
+
+# Publisher sends changes from a replica's share index to the coordinator, and
+# answers the coordinator's calls.
+class Publisher:
+    def __init__(self, share, central_host, rpc_port, my_ip, my_port, my_backend_port):
+        self.share = share
+        self.addr = (central_host, int(rpc_port))
+        self.my_ip = my_ip
+        self.my_port = my_port
+        self.my_backend_port = my_backend_port
+        self.link = None           # the connection to the coordinator, while there is one
+        self.changed = threading.Event()
+        self.sent_version = None   # share index version as of the last notification sent
+        self.handlers = { "ping": self.answer_ping }
+
+    # Start sending, in a background thread.
+    def start(self):
+        t = threading.Thread(target=self.run, name="ChangeFeed")
+        t.daemon = True
+        t.start()
+
+    # Call after changing the share index.
+    def notify(self):
+        self.changed.set()
+
+    def run(self):
+        delay = reconnect_delay
+        while True:
+            link = None
+            try:
+                link = rpc.connect(self.addr, self.handlers)
+                known = link.call("hello", ("%s %s %s" % (self.my_ip, self.my_port, self.my_backend_port)).encode())
+                self.sent_version = int(known) if known else None
+                log("Sending change notifications to %s:%d" % self.addr)
+                delay = reconnect_delay
+                self.send_changes(link)  # anything the coordinator doesn't have yet
+                self.link = link
+                while True:
+                    if self.changed.wait(ping_interval):
+                        time.sleep(batch_delay)
+                        self.send_changes(link)
+                    else:
+                        link.call("ping", str(self.share.version).encode())
+            except (OSError, rpc.RPCError) as err:
+                logerr("Change notifications to %s:%d failed: %s" % (self.addr[0], self.addr[1], err))
+            finally:
+                self.link = None
+                if link is not None:
+                    link.close()
+            time.sleep(delay)
+            delay = min(delay * 2, max_reconnect_delay)
+
+    # Send one notification with everything that changed since the last one, if
+    # anything, or the whole listing if the change log doesn't go back that far.
+    def send_changes(self, link):
+        self.changed.clear()
+        records = None
+        if self.sent_version is not None:
+            records, version = self.share.changes_since(self.sent_version, as_records=True)
+        delta = records is not None
+        if not delta:
+            records, version = self.share.records()
+        elif len(records) == 0:
+            return
+        link.notify("changes", inventory_wire.encode_inventory(version, records, delta))
+        self.sent_version = version
+
+    def answer_ping(self, link, payload):
+        return b"pong"
+
+    # Return the (ip, port) back-end addresses of the other replicas, as the
+    # coordinator knows them, or an empty list if we aren't connected to it.
+    def peers(self):
+        link = self.link
+        if link is None:
+            return []
+        return [(ip, int(port)) for ip, port in (line.split() for line in link.call("peers").decode().splitlines())]
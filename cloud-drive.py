@@ -8,8 +8,8 @@
 # This program is meant to make it easier to start the central coordinator and
 # replicas. For the central coordinator, we assume there is a function:
 #
-#    run_central_coordinator(dns_name, region,
-#                            central_frontend_port, central_backend_port)
+#    run_central_server(dns_name, region,
+#                       central_frontend_port, central_backend_port)
 #
 # And for the replicas, we assume there is a function
 #
@@ -47,9 +47,7 @@
 
 
 import sys            # for sys.argv
-import aws            # for aws.region_for_zone
-import gcp            # for gcp.region_for_zone
-import cloud          # for cloud.region_cities, etc.
+import metadata       # for finding our own name, address, and region
 
 # Get the central_host name and various port number arguments from the command line.
 central_host = sys.argv[1]
@@ -58,19 +56,13 @@ central_backend_port = int(sys.argv[3])
 replica_frontend_port = int(sys.argv[4])
 replica_backend_port = int(sys.argv[5])
 
-# Figure out our own host name. 
-try:
-    # First try AWS meta-data service to figure out our own ec2 availability zone and region.
-    dns_name = aws.get_my_dns_hostname()
-    ipaddr = aws.get_my_external_ip()
-    zone = aws.get_my_zone()
-    region = aws.region_for_zone(zone)
-except:
-    # Next try GCP meta-data service.
-    dns_name = gcp.get_my_internal_hostname()
-    ipaddr = gcp.get_my_external_ip()
-    zone = gcp.get_my_zone()
-    region = gcp.region_for_zone(zone)
+# Figure out our own host name, using the AWS or GCP meta-data service (or
+# whatever CLOUD_METADATA and CLOUD_METADATA_URL say to use, see metadata.py).
+me = metadata.get_identity()
+dns_name = me.dns_name
+ipaddr = me.ip
+zone = me.zone
+region = me.region
 
 if dns_name == central_host or ipaddr == central_host:
     # If we are the central coordinator host...
@@ -78,11 +70,12 @@ if dns_name == central_host or ipaddr == central_host:
     # coordinator. 
     print(("Starting central coordinator at http://%s:%s/" % (dns_name, central_frontend_port)))
     from central import *
-    run_central_coordinator(dns_name, region,
+    run_central_server(dns_name, region,
             central_frontend_port, central_backend_port)
 else:
     # Otherwise, we are one of the replica server hosts...
     # then call some function that implements the replica server.
+    import cloud      # for cloud.region_cities, etc.
     print(("Starting replica server within region %s (city: %s, coordinates: %s)" % (
             region, cloud.region_cities[region], cloud.region_coords[region])))
     from replica import *
@@ -61,6 +61,18 @@ def second_element_of_pair(elt):
 #   filesizes = [ 415, 150512, 22500 ]
 #   html = make_pretty_main_page(my_city, my_addr, list(zip(filenames, filesizes)) )
 def make_pretty_main_page(my_city, my_addr, listing, extra_message=None):
+    return "".join(generate_pretty_main_page(my_city, my_addr, listing, extra_message))
+
+# How many table rows generate_pretty_main_page() puts in each piece it yields.
+rows_per_piece = 200
+
+# This is just like make_pretty_main_page(), but instead of returning the whole
+# page as one (possibly huge) string, it yields the page a piece at a time, so
+# the pieces can be sent to the browser as they are generated.
+# Example:
+#   for piece in generate_pretty_main_page(my_city, my_addr, listing):
+#       send_some_text(piece)
+def generate_pretty_main_page(my_city, my_addr, listing, extra_message=None):
 
     # Sort the listing alphabetically
     listing = sorted(listing, key = first_element_of_pair)
@@ -147,13 +159,18 @@ def make_pretty_main_page(my_city, my_addr, listing, extra_message=None):
         html += "<td></td><td></td><td><i>Sorry, you have no files. Try uploading?</i></td><td></td>\n"
         html += "\n"
     else:
+        yield html
+        html = ""
+        rows = []
         for name, size in listing:
             row = table_row_template
             row = row.replace("FILENAME", name)
             row = row.replace("FILESIZE", pretty_size(size))
-            html += "\n"
-            html += row
-            html += "\n"
+            rows.append("\n" + row + "\n")
+            if len(rows) >= rows_per_piece:
+                yield "".join(rows)
+                rows = []
+        html = "".join(rows)
 
     html += """
         </table>
@@ -167,4 +184,4 @@ def make_pretty_main_page(my_city, my_addr, listing, extra_message=None):
       </html>
     """
 
-    return html
+    yield html
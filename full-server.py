@@ -11,7 +11,9 @@
 # an example of how to have two listening sockets).
 #
 # There should be a subfolder named "./share/" in the current directory. This is
-# used to hold all files to be shared (e.g. uploaded files from users).
+# used to hold all files to be shared (e.g. uploaded files from users). A new,
+# empty ./share/ spreads them over subfolders, see share_layout.py. Small files
+# are kept together in pack files in ./share.packs/ instead, see pack_store.py.
 
 # There should be a subfolder named "./static/" in the current directory. This is
 # used to hold a few permanent, static files like icons and css style sheets.
@@ -65,11 +67,18 @@ from fileshare_helpers import *     # for csci356 filesharing helper code
 from multithread_logging import *   # for csci356 logging helper code
 from smartsocket import *           # for SmartSocket class
 import http_helpers as http         # for csci356 http helper code
+import metrics                      # for prometheus-style metrics
+import stats                        # for contention-free statistics counters
+import tracing                      # for per-request phase timings
+import profiling                    # for profiling from the back-end port
+import blob_store                   # for storing each distinct file contents once
+import share_layout                 # for where each shared file is in ./share/
+import mapped_files                 # for sending big shared files straight from the page cache
+import pack_store                   # for storing small shared files together
 import mimetypes                    # for guessing mime type of files
 import os                           # for listing files, opening files, etc.
 import random                       # for random.choice() and random numbers
 import socket                       # for socket stuff
-import ssl                          # for tls sockets (used by https)
 import sys                          # for exiting and command-line args
 import threading                    # for threading.Thread()
 import time                         # for time.time()
@@ -86,15 +95,27 @@ my_region = None          # geographic region where this server is located
 static_file_names = []    # list of static files stored in the ./static/ directory
 
 file_updates = threading.Condition() # used to synchronize access to file-related variables
+blobs = blob_store.BlobStore("./share.blobs", "./share.tmp")  # the contents of the files in ./share/
+layout = None  # where each file is in ./share/, see share_layout.py, set at startup
+packs = pack_store.open_store("./share.packs")  # the small files
 local_file_names = []     # list of shared files stored locally on this server
 local_file_sizes = []     # size of each of those files
 
-stats_updates = threading.Condition() # used to synchronize access to statistics variables
-num_connections_so_far = 0  # how many browser connections we have handled so far
-num_connections_now = 0     # how many browser connections we are handling right now
-num_local_files = 0         # number of shared files stored locally on this server
-num_uploads = 0             # how many uploads of shared files we have handled so far
-num_downloads = 0           # how many downloads of shared files we have handled so far
+# Statistics counters. Use server_stats.snapshot() to read them all at once.
+server_stats = stats.StatsGroup([
+    "connections_so_far",  # how many browser connections we have handled so far
+    "connections_now",     # how many browser connections we are handling right now
+    "local_files",         # number of shared files stored locally on this server
+    "uploads",             # how many uploads of shared files we have handled so far
+    "downloads",           # how many downloads of shared files we have handled so far
+])
+server_stats.export_metrics({
+    "connections_so_far": ("http_connections_total", "counter", "Browser connections handled so far."),
+    "connections_now": ("http_connections_open", "gauge", "Browser connections being handled right now."),
+    "local_files": ("shared_files", "gauge", "Shared files stored in this server's ./share/ folder."),
+    "uploads": ("uploads_total", "counter", "Shared files uploaded to this server."),
+    "downloads": ("downloads_total", "counter", "Shared files downloaded from this server."),
+})
 
 # This last condition variable is used to signal that one of our listening sockets
 # crashed, in which case it is time to close all sockets and exit the program.
@@ -115,16 +136,16 @@ def remove_file(filename):
             # remove from our lists
             del local_file_names[i]
             del local_file_sizes[i]
+            server_stats.add("local_files", -1)
             try:
-                os.remove("./share/" + filename)
+                with tracing.phase("disk_io", filename):
+                    if not packs.remove(filename):
+                        blobs.remove(layout.path(filename))
+                        mapped_files.cache.invalidate(layout.path(filename))
                 status = "Success, removed file '%s'." % (filename)
             except:
                 status = "Problem removing file '%s'." % (filename)
             file_updates.notify_all()
-    global num_local_files
-    with stats_updates:
-        num_local_files -= 1
-        stats_updates.notify_all()
     return status
 
 # Given a file and some data, adds this file to our local shared directory and
@@ -138,19 +159,18 @@ def add_file(filename, data):
         else:
             # Try to store the data in a file in our "./share/" directory
             try:
-                with open("./share/" + filename, "wb") as f:
-                    f.write(data)
+                with tracing.phase("disk_io", filename):
+                    if len(data) <= pack_store.small_file_limit:
+                        packs.put(filename, data, time.time_ns(), blob_store.content_digest(data))
+                    else:
+                        blobs.put(data, layout.make_path(filename))
                 local_file_names.append(filename)
                 local_file_sizes.append(len(data))
+                server_stats.update(local_files=1, uploads=1)
                 file_updates.notify_all()
                 status = "Success, added file '%s'." % (filename)
             except:
                 status = "Problem storing data in local file named '%s'." % (filename)
-    global num_local_files, num_uploads
-    with stats_updates:
-        num_local_files += 1
-        num_uploads += 1
-        stats_updates.notify_all()
     return status
 
 
@@ -165,9 +185,13 @@ def add_file(filename, data):
 # For example:
 #   netcat localhost 6000  # connects to socket 6000
 # You can then type various commands. Try it!
+# Monitoring tools can also fetch http://localhost:6000/metrics from this port.
 def handle_backend_connection(sock, peer_addr):
     logwarn("New connection to back-end diagnostic port")
     try:
+        if http.looks_like_http(sock):
+            http.serve_backend_http(sock, peer_addr, backend_http_pages)
+            return
         sock.sendall(("Hello! Welcome to the secret diagnostic port!\n").encode())
         sock.sendall(("  Your address is %s:%d\n" % (peer_addr)).encode())
         sock.sendall(("  my_name = '%s'\n" % (my_name)).encode())
@@ -175,6 +199,11 @@ def handle_backend_connection(sock, peer_addr):
         sock.sendall(("Here are the things I know how to do:\n").encode())
         sock.sendall(("  list-files    -- get list of local shared files\n").encode())
         sock.sendall(("  stats         -- get load statistics\n").encode())
+        sock.sendall(("  metrics       -- get prometheus-style metrics\n").encode())
+        sock.sendall(("  slowest [N]   -- show timings for the N slowest recent requests\n").encode())
+        sock.sendall(("  slowest ID    -- show timings for one trace ID\n").encode())
+        for help_line in profiling.profiling_help:
+            sock.sendall((help_line + "\n").encode())
         sock.sendall(("  bye           -- disconnect from diagnostic port\n").encode())
         sock.sendall(("  die           -- causes entire server to exit\n").encode()) 
 
@@ -189,13 +218,24 @@ def handle_backend_connection(sock, peer_addr):
                 for filename, filesize in files_and_sizes:
                     sock.sendall(("  %s (%d bytes)\n" % (filename, filesize)).encode())
             elif line.startswith("stats"):
-                with stats_updates:
-                    sock.sendall(("Here are some statistics:\n").encode())
-                    sock.sendall(("   %6d http connections so far\n" % (num_connections_so_far)).encode())
-                    sock.sendall(("   %6d http connections right now\n" % (num_connections_now)).encode())
-                    sock.sendall(("   %6d shared files in this server's ./share/ folder\n" % (num_local_files)).encode())
-                    sock.sendall(("   %6d shared files uploaded to this server\n" % (num_uploads)).encode())
-                    sock.sendall(("   %6d shared files downloaded from this server\n" % (num_downloads)).encode())
+                snap = server_stats.snapshot()
+                sock.sendall(("Here are some statistics:\n").encode())
+                sock.sendall(("   %6d http connections so far\n" % (snap["connections_so_far"])).encode())
+                sock.sendall(("   %6d http connections right now\n" % (snap["connections_now"])).encode())
+                sock.sendall(("   %6d shared files in this server's ./share/ folder\n" % (snap["local_files"])).encode())
+                sock.sendall(("   %6d shared files uploaded to this server\n" % (snap["uploads"])).encode())
+                sock.sendall(("   %6d shared files downloaded from this server\n" % (snap["downloads"])).encode())
+            elif line.startswith("metrics"):
+                sock.sendall(metrics.render_metrics().encode())
+            elif line.startswith("slowest"):
+                words = line.split()
+                if len(words) > 1 and words[1].isdigit():
+                    report = tracing.slowest_report(int(words[1]))
+                elif len(words) > 1:
+                    report = tracing.slowest_report(tracing.max_traces, words[1])
+                else:
+                    report = tracing.slowest_report(10)
+                sock.sendall(report.encode())
             elif line.startswith("bye"):
                 sock.sendall(b"See you later!\n")
                 return
@@ -204,7 +244,10 @@ def handle_backend_connection(sock, peer_addr):
                 with crash_updates:
                     crash_updates.notify_all()
             else:
-                sock.sendall(("I don't understand '%s'\n" % (line)).encode())
+                reply = profiling.handle_profiling_command(line)
+                if reply is None:
+                    reply = "I don't understand '%s'\n" % (line)
+                sock.sendall(reply.encode())
     except Exception as err:
         logerr("Back-end connection failed: %s" % (err))
         raise err
@@ -212,6 +255,18 @@ def handle_backend_connection(sock, peer_addr):
         logwarn("Closing back-end diagnostic port connection.")
         sock.close()
 
+# Pages served to HTTP clients of the back-end diagnostic port.
+def metrics_page():
+    return "text/plain; version=0.0.4", metrics.render_metrics()
+
+def slowest_page():
+    return "text/plain", tracing.slowest_report(20)
+
+def threads_page():
+    return "text/plain", profiling.dump_thread_stacks()
+
+backend_http_pages = { "/metrics": metrics_page, "/slowest": slowest_page, "/threads": threads_page }
+
 #### Front-end code for handling web requests ####
 
 # Create a list of all known shared files, along with their sizes.
@@ -232,13 +287,16 @@ def is_shared_file_stored_locally(filename):
     return exists
 
 # Given a filename of a shared file that is stored locally, get the data from
-# the file.
+# the file. Small files are in ./share.packs/, and cost only one read. Big files
+# come back as a memoryview of a shared memory mapping, see mapped_files.py.
 def get_share_file_locally(filename):
     try:
-        log("Opening locally-stored shared file '%s'..." % (filename))
-        with open("./share/" + filename, "rb") as f:
-            data = f.read()
-            return data
+        logdebug("Opening locally-stored shared file '%s'...", filename)
+        with tracing.phase("disk_io", filename):
+            data = packs.get(filename)
+            if data is not None:
+                return data
+            return mapped_files.cache.read(layout.path(filename))
     except OSError as err:
         logerr("problem opening shared file '%s' locally: %s" % (filename, err))
         return None
@@ -267,44 +325,25 @@ def accept_backend_connections(listening_sock):
 
 # Send a generic HTTP 404 NOT FOUND response to the client.
 def send_404_not_found(conn):
-    logwarn("Responding with 404 not found")
+    logdebug("Responding with 404 not found")
     content = "Sorry, the page you requested could not be found :)"
-    content_len = len(content)
-
-    resp = "HTTP/1.1 404 NOT FOUND\r\n"
-    resp += "Date: %s\r\n" % (http.http_date_now())
-    if conn.keep_alive:
-        resp += "Connection: keep-alive\r\n"
-    else:
-        resp += "Connection: close\r\n"
-    resp += "Content-Length: %d\r\n" % (content_len)
-    resp += "Content-Type: text/plain\r\n"
-    log(resp)
-    conn.sock.sendall(resp.encode() + b"\r\n" + content.encode())
+    resp = http.HTTPResponse("404 NOT FOUND", "text/plain", content)
+    http.send_response(conn, resp)
 
 # Send the dynamically-generated main page to the client.
 def send_main_page(conn, status=None):
-    logwarn("Responding with main page")
+    logdebug("Responding with main page")
     listing = gather_shared_file_list()
-    content = make_pretty_main_page(my_region, my_name, listing, status)
-    content_len = len(content)
-
-    resp = "HTTP/1.1 200 OK\r\n"
-    resp += "Date: %s\r\n" % (http.http_date_now())
-    if conn.keep_alive:
-        resp += "Connection: keep-alive\r\n"
-    else:
-        resp += "Connection: close\r\n"
-    resp += "Content-Length: %d\r\n" % (content_len)
-    resp += "Content-Type: text/html\r\n"
-    log(resp)
-    conn.sock.sendall(resp.encode() + b"\r\n" + content.encode())
+    content = generate_pretty_main_page(my_region, my_name, listing, status)
+    resp = http.HTTPResponse("200 OK", "text/html", content)
+    resp.compress(conn.accept_encoding)
+    http.send_response(conn, resp)
 
 # Send an HTTP 302 TEMPORARY REDIRECT to bounce client towards the main page,
 # with a status message embedded into the url (so the status message will
 # display on the page).
 def send_redirect_to_main_page(conn, status):
-    logwarn("Responding with redirect to main page")
+    logdebug("Responding with redirect to main page")
     if status is None:
         url = "/shared-files.html"
         content = "You should go to the main page please!"
@@ -312,25 +351,15 @@ def send_redirect_to_main_page(conn, status):
         url = "/shared-files.html?status=%s" % (urllib.parse.quote(status))
         content = "Status of your last request... %s\n" % (status)
         content += "Now go back to the main page please!"
-    content_len = len(content)
-
-    resp = "HTTP/1.1 302 TEMPORARY REDIRECT\r\n"
-    resp += "Date: %s\r\n" % (http.http_date_now())
-    if conn.keep_alive:
-        resp += "Connection: keep-alive\r\n"
-    else:
-        resp += "Connection: close\r\n"
-    resp += "Content-Length: %d\r\n" % (content_len)
-    resp += "Content-Type: text/plain\r\n"
-    resp += "Location: %s\r\n" % (url)
-    log(resp)
-    conn.sock.sendall(resp.encode() + b"\r\n" + content.encode())
+    resp = http.HTTPResponse("302 TEMPORARY REDIRECT", "text/plain", content)
+    resp.add_header("Location", url)
+    http.send_response(conn, resp)
 
 # Send a static local file (like a css file) to the browser.
 def send_static_local_file(conn, filename):
-    log("Browser asked for a local, static file")
+    logdebug("Browser asked for a local, static file")
     try:
-        with open("./static/" + filename, "rb") as f:
+        with tracing.phase("disk_io", filename), open("./static/" + filename, "rb") as f:
             filedata = f.read()
     except OSError as err:
         logerr("problem opening local file '%s': %s" % (filename, err))
@@ -341,34 +370,23 @@ def send_static_local_file(conn, filename):
     if mime_type is None:
         mime_type = "application/octet-stream"
 
-    content = filedata
-    content_len = len(content)
-
-    resp = "HTTP/1.1 200 OK\r\n"
-    resp += "Date: %s\r\n" % (http.http_date_now())
-    if conn.keep_alive:
-        resp += "Connection: keep-alive\r\n"
-    else:
-        resp += "Connection: close\r\n"
-    resp += "Content-Length: %d\r\n" % (content_len)
-    resp += "Content-Type: %s\r\n" % (mime_type)
-    log(resp)
-    conn.sock.sendall(resp.encode() + b"\r\n" + content)
+    resp = http.HTTPResponse("200 OK", mime_type, filedata)
+    resp.compress(conn.accept_encoding, http.file_etag("./static/" + filename))
+    http.send_response(conn, resp)
 
 # Send a shared file to the browser. This will first locate the file by checking
 # if it is stored locally. If not found, we send a 404 NOT FOUND response. If
 # the file is found, we send it back to the client. When the as_attachment
 # parameter is True, then we include in the HTTP response a
 # "Content-Disposition: attachment" header, which causes most browsers to bring
-# up a "Save-As" popup, rather than displaying the file.
+# up a "Save-As" popup, rather than displaying the file. If the browser asks
+# for just part of the file, with a Range header, only that part is sent.
 def send_share_file(conn, filename, as_attachment):
-    log("Browser asked for shared file")
-    global num_downloads
-    with stats_updates:
-        num_downloads += 1
-        stats_updates.notify_all()
+    logdebug("Browser asked for shared file")
+    server_stats.add("downloads")
 
     # first, see if we can find the file on this local server
+    filedata = None
     if is_shared_file_stored_locally(filename):
         filedata = get_share_file_locally(filename)
 
@@ -382,26 +400,20 @@ def send_share_file(conn, filename, as_attachment):
     if mime_type is None:
         mime_type = "application/octet-stream"
 
-    content = filedata
-    content_len = len(content)
-
-    resp = "HTTP/1.1 200 OK\r\n"
-    resp += "Date: %s\r\n" % (http.http_date_now())
-    if conn.keep_alive:
-        resp += "Connection: keep-alive\r\n"
-    else:
-        resp += "Connection: close\r\n"
+    resp = http.HTTPResponse("200 OK", mime_type, filedata)
+    etag = packs.etag(filename)
+    if etag is None:
+        etag = http.file_etag(layout.path(filename))
+    if not http.apply_range(resp, conn.range, conn.if_range):
+        resp.compress(conn.accept_encoding, etag)
     if as_attachment:
-        resp += 'Content-Disposition: attachment; filename="%s"\r\n' % (filename)
-    resp += "Content-Length: %d\r\n" % (content_len)
-    resp += "Content-Type: %s\r\n" % (mime_type)
-    log(resp)
-    conn.sock.sendall(resp.encode() + b"\r\n" + content)
+        resp.add_header("Content-Disposition", 'attachment; filename="%s"' % (filename))
+    http.send_response(conn, resp)
 
 # Generate an html page with some diagnostics and statistics, and send
 # it as a response to the client.
 def send_dashboard_html(conn):
-    logwarn("Responding with dashboard page")
+    logdebug("Responding with dashboard page")
     html = "<html><head><title>Non-replicated Cloud File Storage Service, by kwalsh</title></head>"
     html += "<body>"
 
@@ -409,54 +421,40 @@ def send_dashboard_html(conn):
 
     html += "<p><a href=\"/dashboard.html\">REFRESH</a></p>"
 
-    with stats_updates:
-        html += "Here are some statistics:<br>"
-        html += " %6d http connections so far<br>" % (num_connections_so_far)
-        html += " %6d http connections right now<br>" % (num_connections_now)
-        html += " %6d shared files stored this server's ./share/ folder<br>" % (num_local_files)
-        html += " %6d shared files uploaded<br>" % (num_uploads)
-        html += " %6d shared files downloaded<br>" % (num_downloads)
+    snap = server_stats.snapshot()
+    html += "Here are some statistics:<br>"
+    html += " %6d http connections so far<br>" % (snap["connections_so_far"])
+    html += " %6d http connections right now<br>" % (snap["connections_now"])
+    html += " %6d shared files stored this server's ./share/ folder<br>" % (snap["local_files"])
+    html += " %6d shared files uploaded<br>" % (snap["uploads"])
+    html += " %6d shared files downloaded<br>" % (snap["downloads"])
 
     html += "<p>Click <a href=\"/shared-files.html\">HERE</a> to go to the main page.</p>"
     html += "</body></html>"
 
-    content = html
-    content_len = len(content)
-
-    resp = "HTTP/1.1 200 OK\r\n"
-    resp += "Date: %s\r\n" % (http.http_date_now())
-    if conn.keep_alive:
-        resp += "Connection: keep-alive\r\n"
-    else:
-        resp += "Connection: close\r\n"
-    resp += "Content-Length: %d\r\n" % (content_len)
-    resp += "Content-Type: text/html\r\n"
-    log(resp)
-    conn.sock.sendall(resp.encode() + b"\r\n" + content.encode())
-
+    resp = http.HTTPResponse("200 OK", "text/html", html)
+    resp.compress(conn.accept_encoding)
+    http.send_response(conn, resp)
 
 # Handle one browser connection. This will receive an HTTP request, handle it,
 # and repeat this as long as the browser says to keep-alive. If there are any
 # errors, or if the browser says to close, the connection is closed.
 def handle_http_connection(conn):
-    log("New browser connection from %s:%d" % (conn.client_addr))
-    global num_connections_so_far, num_connections_now
-    with stats_updates:
-        num_connections_so_far += 1
-        num_connections_now += 1
-        stats_updates.notify_all()
+    log_sampled("new-conn", "New browser connection from %s:%d", conn.client_addr[0], conn.client_addr[1])
+    server_stats.update(connections_so_far=1, connections_now=1)
     try:
         conn.keep_alive = True
         while conn.keep_alive:
-            log("Waiting for next request!!!")
+            logdebug("Waiting for next request!!!")
             # handle one HTTP request from browser
-            req = http.recv_one_request_from_client(conn.sock)
+            req = http.recv_next_request(conn)
             if req is None:
-                logerr("No request?! Something went terribly wrong, dropping connection.")
+                logdebug("No more requests, dropping connection.")
                 break
-            log(req)
-            conn.num_requests += 1
-            conn.keep_alive = req.keep_alive
+            log_sampled("request", "%s %s", req.method, req.urlpath)
+            logdebug(req)
+            start = time.perf_counter()
+            tracing.begin_trace(req, "full-server")
 
             # GET /index.html
             # GET /
@@ -526,15 +524,16 @@ def handle_http_connection(conn):
                 logerr("Unrecognized HTTP request (%s %s)" % (req.method, req.path))
                 send_404_not_found(conn)
 
-            log("Done processing request, connection keep_alive is %s" % (conn.keep_alive))
+            metrics.record_request(req.path, conn.last_status, start, static_file_names)
+            tracing.end_trace(conn.last_status)
+            logdebug("Done processing request, connection keep_alive is %s", conn.keep_alive)
     except Exception as err:
         logerr("Front-end connection failed: %s" % (err))
         raise err
     finally:
-        log("Closing socket connection with %s:%d" % (conn.client_addr))
-        with stats_updates:
-            num_connections_now -= 1
-            stats_updates.notify_all()
+        logdebug("Closing socket connection with %s:%d", conn.client_addr[0], conn.client_addr[1])
+        http.connection_reaper.forget(conn)
+        server_stats.add("connections_now", -1)
         conn.sock.close()
 
 # Given a socket listening on the browser-facing front-end port, wait for and
@@ -546,6 +545,7 @@ def accept_http_connections(listening_sock):
         while True:
             c, a = listening_sock.accept()
             conn = http.HTTPConnection(SmartSocket(c), a)
+            http.connection_reaper.watch(conn)
             t = threading.Thread(target=handle_http_connection, args=(conn,))
             t.daemon = True
             t.start()
@@ -584,12 +584,21 @@ def run_full_server(name, region, frontend_port, backend_port):
     static_file_names = os.listdir("./static/")  # list of static files we can serve
     log("This server can serve the following static files:\n%s\n" % ("\n".join(static_file_names)))
 
-    global local_file_names, num_local_files, local_file_sizes
-    log("Scanning ./share/")
-    local_file_names = os.listdir("./share/")  # list of shared user files we have locally
+    global local_file_names, local_file_sizes, layout
+    blobs.open()
+    log("Removed %d unused blobs from ./share.blobs/" % (blobs.sweep()))
+    layout = share_layout.open_layout("./share")
+    log("Scanning ./share/, which uses the %s layout" % (layout.name))
+    for entry in layout.files():  # shared user files we have locally
+        local_file_names.append(entry.name)
+        local_file_sizes.append(entry.stat(follow_symlinks=False).st_size)
+    log("Reading ./share.packs/: %s" % (packs.open()))
+    for name, (size, mtime_ns, digest) in packs.entries().items():
+        local_file_names.append(name)
+        local_file_sizes.append(size)
+    packs.start_compaction()
     num_local_files = len(local_file_names)
-    for f in local_file_names:
-        local_file_sizes.append(os.path.getsize("./share/" + f))
+    server_stats.add("local_files", num_local_files)
     log("There are %d shared user files stored locally on this server." % (num_local_files))
     for i in range(num_local_files):
         log("   %10d  %s" % (local_file_sizes[i], local_file_names[i]))
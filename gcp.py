@@ -120,23 +120,19 @@ region_coords = {
 
 metadata_flavor = {'Metadata-Flavor' : 'Google'}
 
+# These ask the GCE metadata service directly. See metadata.py for a version
+# that works in either cloud, or on a laptop.
 def get_my_internal_hostname():
-    import requests
-    r = requests.get('http://metadata.google.internal/computeMetadata/v1/instance/name', headers = metadata_flavor)
-    r.raise_for_status()
-    return r.text
+    import metadata
+    return metadata.GCPMetadata().get_my_dns_hostname()
 
 def get_my_external_ip():
-    import requests
-    r = requests.get('http://metadata.google.internal/computeMetadata/v1/instance/network-interfaces/0/access-configs/0/external-ip', headers = metadata_flavor)
-    r.raise_for_status()
-    return r.text
+    import metadata
+    return metadata.GCPMetadata().get_my_external_ip()
 
 def get_my_zone():
-    import requests
-    r = requests.get('http://metadata.google.internal/computeMetadata/v1/instance/zone', headers = metadata_flavor)
-    r.raise_for_status()
-    return r.text.split('/')[-1]
+    import metadata
+    return metadata.GCPMetadata().get_my_zone()
 
 # test code
 if __name__ == "__main__":
@@ -3,33 +3,32 @@ from fileshare_helpers import *     # for csci356 filesharing helper code
 from multithread_logging import *   # for csci356 logging helper code
 from smartsocket import *           # for SmartSocket class
 import http_helpers as http         # for csci356 http helper code
+import metrics                      # for prometheus-style metrics
+import tracing                      # for per-request phase timings
+import profiling                    # for profiling from the back-end port
+import share_layout                 # for where each shared file is in ./share/
+import mapped_files                 # for sending big shared files straight from the page cache
+import pack_store                   # for small shared files, kept in ./share.packs/
 import mimetypes                    # for guessing mime type of files
 import os                           # for listing files, opening files, etc.
 import random                       # for random.choice() and random numbers
 import socket                       # for socket stuff
-import ssl                          # for tls sockets (used by https)
 import sys                          # for exiting and command-line args
 import threading                    # for threading.Thread()
 import time                         # for time.time()
 import urllib.parse                 # for quoting and unquoting url paths
 
 def send_ok(conn, content):
-    logwarn("Responding with content")
-    content_len = len(content)
-    resp = "HTTP/1.1 200 OK\r\n"
-    resp += "Date: %s\r\n" % (http.http_date_now())
-    resp += "Connection: close\r\n"
-    resp += "Content-Length: %d\r\n" % (content_len)
-    resp += "Content-Type: text/plain\r\n"
-    log(resp)
-    log(content)
-    conn.sock.sendall(resp.encode() + b"\r\n" + content.encode())
+    logdebug("Responding with content")
+    logdebug(content)
+    resp = http.HTTPResponse("200 OK", "text/plain", content)
+    http.send_response(conn, resp)
 
 # Send an HTTP 302 TEMPORARY REDIRECT to bounce client towards the main page,
 # with a status message embedded into the url (so the status message will
 # display on the page).
 def send_redirect_to_main_page(conn, status):
-    logwarn("Responding with redirect to main page")
+    logdebug("Responding with redirect to main page")
     if status is None:
         url = "/shared-files.html"
         content = "You should go to the main page please!"
@@ -37,99 +36,51 @@ def send_redirect_to_main_page(conn, status):
         url = "/shared-files.html?status=%s" % (urllib.parse.quote(status))
         content = "Status of your last request... %s\n" % (status)
         content += "Now go back to the main page please!"
-    content_len = len(content)
-
-    resp = "HTTP/1.1 302 TEMPORARY REDIRECT\r\n"
-    resp += "Date: %s\r\n" % (http.http_date_now())
-    if conn.keep_alive:
-        resp += "Connection: keep-alive\r\n"
-    else:
-        resp += "Connection: close\r\n"
-    resp += "Content-Length: %d\r\n" % (content_len)
-    resp += "Content-Type: text/plain\r\n"
-    resp += "Location: %s\r\n" % (url)
-    log(resp)
-    conn.sock.sendall(resp.encode() + b"\r\n" + content.encode())
+    resp = http.HTTPResponse("302 TEMPORARY REDIRECT", "text/plain", content)
+    resp.add_header("Location", url)
+    http.send_response(conn, resp)
 
 # Send an HTTP 307 TEMPORARY REDIRECT to bounce client towards replica
 def redirect_to_other_server(conn, content, ip, port, req_path, seeOther=False):
     port = str(port)
-    logwarn("Responding with redirect to main page")
+    logdebug("Responding with redirect to other server")
     url = 'http://' + ip + ":" + port + req_path
-    content_len = len(content)
-
-    resp = ""
     if seeOther:
-        resp += "HTTP/1.1 303 See Other\r\n"
-    else:
-        resp += "HTTP/1.1 307 Temporary Redirect\r\n"
-    resp += "Date: %s\r\n" % (http.http_date_now())
-    if conn.keep_alive:
-        resp += "Connection: keep-alive\r\n"
-    else:
-        resp += "Connection: close\r\n"
-    resp += "Content-Length: %d\r\n" % (content_len)
-    resp += "Content-Type: text/plain\r\n"
-    resp += "Location: %s\r\n" % (url)
-    log(resp)
-    conn.sock.sendall(resp.encode() + b"\r\n" + content.encode())
-
-def send_filenames_and_sizes(conn):
-    resp = "HTTP/1.1 200 OK\r\n"
-    resp += "Date: %s\r\n" % (http.http_date_now())
-    if conn.keep_alive:
-        resp += "Connection: keep-alive\r\n"
+        resp = http.HTTPResponse("303 See Other", "text/plain", content)
     else:
-        resp += "Connection: close\r\n"
-
-    local_file_names = os.listdir("./share/")  # list of shared user files we have locally
-    num_local_files = len(local_file_names)
-
-    retval_list = []
-    for filename in local_file_names:
-        size = os.path.getsize("./share/" + filename)
-        retval_list.append((filename + "," + str(size)))
-    
-    content = "&".join(retval_list)
-    resp += "Content-Length: %d\r\n" % (len(content))
-    resp += "Content-Type: text/plain\r\n"
-    conn.sock.sendall(resp.encode() + b"\r\n" + content.encode())
+        resp = http.HTTPResponse("307 Temporary Redirect", "text/plain", content)
+    resp.add_header("Location", url)
+    http.send_response(conn, resp)
 
 # Given a filename of a shared file that is stored locally, get the data from
-# the file.
+# the file. Small files are in ./share.packs/, and cost only one read. Big files
+# come back as a memoryview of a shared memory mapping, see mapped_files.py.
 def get_share_file_locally(filename):
     try:
-        log("Opening locally-stored shared file '%s'..." % (filename))
-        with open("./share/" + filename, "rb") as f:
-            data = f.read()
-            return data
+        logdebug("Opening locally-stored shared file '%s'...", filename)
+        with tracing.phase("disk_io", filename):
+            data = pack_store.open_store("./share.packs").get(filename)
+            if data is not None:
+                return data
+            return mapped_files.cache.read(share_layout.open_layout("./share").path(filename))
     except OSError as err:
         logerr("problem opening shared file '%s' locally: %s" % (filename, err))
         return None
 
 # Send a generic HTTP 404 NOT FOUND response to the client.
 def send_404_not_found(conn):
-    logwarn("Responding with 404 not found")
+    logdebug("Responding with 404 not found")
     content = "Sorry, the page you requested could not be found :)"
-    content_len = len(content)
-
-    resp = "HTTP/1.1 404 NOT FOUND\r\n"
-    resp += "Date: %s\r\n" % (http.http_date_now())
-    if conn.keep_alive:
-        resp += "Connection: keep-alive\r\n"
-    else:
-        resp += "Connection: close\r\n"
-    resp += "Content-Length: %d\r\n" % (content_len)
-    resp += "Content-Type: text/plain\r\n"
-    log(resp)
-    conn.sock.sendall(resp.encode() + b"\r\n" + content.encode())
+    resp = http.HTTPResponse("404 NOT FOUND", "text/plain", content)
+    http.send_response(conn, resp)
 
 # Send a shared file to the browser. This will first locate the file by checking
 # if it is stored locally. If not found, we send a 404 NOT FOUND response. If
 # the file is found, we send it back to the client. When the as_attachment
 # parameter is True, then we include in the HTTP response a
 # "Content-Disposition: attachment" header, which causes most browsers to bring
-# up a "Save-As" popup, rather than displaying the file.
+# up a "Save-As" popup, rather than displaying the file. If the browser asks
+# for just part of the file, with a Range header, only that part is sent.
 def send_share_file(conn, filename, as_attachment):
     # first, see if we can find the file on this local server
     filedata = get_share_file_locally(filename)
@@ -144,26 +95,20 @@ def send_share_file(conn, filename, as_attachment):
     if mime_type is None:
         mime_type = "application/octet-stream"
 
-    content = filedata
-    content_len = len(content)
-
-    resp = "HTTP/1.1 200 OK\r\n"
-    resp += "Date: %s\r\n" % (http.http_date_now())
-    if conn.keep_alive:
-        resp += "Connection: keep-alive\r\n"
-    else:
-        resp += "Connection: close\r\n"
+    resp = http.HTTPResponse("200 OK", mime_type, filedata)
+    etag = pack_store.open_store("./share.packs").etag(filename)
+    if etag is None:
+        etag = http.file_etag(share_layout.open_layout("./share").path(filename))
+    if not http.apply_range(resp, conn.range, conn.if_range):
+        resp.compress(conn.accept_encoding, etag)
     if as_attachment:
-        resp += 'Content-Disposition: attachment; filename="%s"\r\n' % (filename)
-    resp += "Content-Length: %d\r\n" % (content_len)
-    resp += "Content-Type: %s\r\n" % (mime_type)
-    log(resp)
-    conn.sock.sendall(resp.encode() + b"\r\n" + content)
+        resp.add_header("Content-Disposition", 'attachment; filename="%s"' % (filename))
+    http.send_response(conn, resp)
 
 def send_static_local_file(conn, filename):
-    log("Browser asked for a local, static file")
+    logdebug("Browser asked for a local, static file")
     try:
-        with open("./static/" + filename, "rb") as f:
+        with tracing.phase("disk_io", filename), open("./static/" + filename, "rb") as f:
             filedata = f.read()
     except OSError as err:
         logerr("problem opening local file '%s': %s" % (filename, err))
@@ -174,16 +119,124 @@ def send_static_local_file(conn, filename):
     if mime_type is None:
         mime_type = "application/octet-stream"
 
-    content = filedata
-    content_len = len(content)
+    resp = http.HTTPResponse("200 OK", mime_type, filedata)
+    resp.compress(conn.accept_encoding, http.file_etag("./static/" + filename))
+    http.send_response(conn, resp)
+
+#### Back-end diagnostic port, used by both the central coordinator and replicas ####
+
+# Pages served to HTTP clients of the back-end diagnostic port.
+def metrics_page():
+    return "text/plain; version=0.0.4", metrics.render_metrics()
+
+def slowest_page():
+    return "text/plain", tracing.slowest_report(20)
+
+def threads_page():
+    return "text/plain", profiling.dump_thread_stacks()
 
-    resp = "HTTP/1.1 200 OK\r\n"
-    resp += "Date: %s\r\n" % (http.http_date_now())
-    if conn.keep_alive:
-        resp += "Connection: keep-alive\r\n"
+backend_http_pages = { "/metrics": metrics_page, "/slowest": slowest_page, "/threads": threads_page }
+
+# Other programs can talk to the back-end port too, like replicas sending change
+# notifications to the central coordinator. They say who they are by the first
+# word they send, which picks a function from this dictionary to handle the
+# whole connection. The function is called as fn(sock, peer_addr, first_line).
+backend_protocols = {}
+
+# Handle the "slowest" command on the back-end diagnostic port, which looks like
+# "slowest", "slowest 50" (how many to show), or "slowest 3f2a9c0e17d4b865"
+# (everything recorded for one trace ID).
+def slowest_command(line):
+    words = line.split()
+    if len(words) > 1 and words[1].isdigit():
+        return tracing.slowest_report(int(words[1]))
+    elif len(words) > 1:
+        return tracing.slowest_report(tracing.max_traces, words[1])
     else:
-        resp += "Connection: close\r\n"
-    resp += "Content-Length: %d\r\n" % (content_len)
-    resp += "Content-Type: %s\r\n" % (mime_type)
-    log(resp)
-    conn.sock.sendall(resp.encode() + b"\r\n" + content)
\ No newline at end of file
+        return tracing.slowest_report(10)
+
+# Handle one connection to the back-end diagnostic port. This receives one line
+# of text at a time from the socket, and sends back a response. Connect to it
+# with "netcat localhost 6000" or similar, or fetch
+# http://localhost:6000/metrics with a monitoring tool. The crash_updates
+# condition variable is notified if someone asks the server to die.
+def handle_backend_connection(sock, peer_addr, crash_updates):
+    logwarn("New connection to back-end diagnostic port")
+    try:
+        first = sock.peek(0.25)
+        if http.looks_like_http(sock, first=first):
+            http.serve_backend_http(sock, peer_addr, backend_http_pages)
+            return
+        protocol = backend_protocols.get(first.split(b" ", 1)[0].decode(errors="replace"))
+        if protocol is not None:
+            protocol(sock, peer_addr, sock.recv_until(b"\n").decode())
+            return
+        sock.sendall(("Hello! Welcome to the secret diagnostic port!\n").encode())
+        sock.sendall(("  Your address is %s:%d\n" % (peer_addr)).encode())
+        sock.sendall(("Here are the things I know how to do:\n").encode())
+        sock.sendall(("  metrics       -- get prometheus-style metrics\n").encode())
+        sock.sendall(("  slowest [N]   -- show timings for the N slowest recent requests\n").encode())
+        sock.sendall(("  slowest ID    -- show timings for one trace ID\n").encode())
+        for help_line in profiling.profiling_help:
+            sock.sendall((help_line + "\n").encode())
+        sock.sendall(("  bye           -- disconnect from diagnostic port\n").encode())
+        sock.sendall(("  die           -- causes entire server to exit\n").encode())
+
+        while True:
+            sock.sendall(("What do you want to do?\n").encode())
+            line = sock.recv_until(b"\n")
+            if line is None:
+                return
+            line = line.decode().strip()
+            log("You said: '%s'\n" % (line))
+            if line.startswith("metrics"):
+                sock.sendall(metrics.render_metrics().encode())
+            elif line.startswith("slowest"):
+                sock.sendall(slowest_command(line).encode())
+            elif line.startswith("bye"):
+                sock.sendall(b"See you later!\n")
+                return
+            elif line.startswith("die"):
+                sock.sendall(b"This server is shutting down now!\n")
+                with crash_updates:
+                    crash_updates.notify_all()
+            else:
+                reply = profiling.handle_profiling_command(line)
+                if reply is None:
+                    reply = "I don't understand '%s'\n" % (line)
+                sock.sendall(reply.encode())
+    except Exception as err:
+        logerr("Back-end connection failed: %s" % (err))
+    finally:
+        logwarn("Closing back-end diagnostic port connection.")
+        sock.close()
+
+# Given a socket listening on the backend port, wait for and accept connections
+# and spawn a thread for each one. This code normally runs forever, but if it
+# crashes, it will notify the crash_updates variable.
+def accept_backend_connections(listening_sock, crash_updates):
+    try:
+        while True:
+            c, a = listening_sock.accept()
+            t = threading.Thread(target=handle_backend_connection, args=(SmartSocket(c), a, crash_updates))
+            t.daemon = True
+            t.start()
+    except Exception as err:
+        logerr("Back-end listening thread failed: %s" % (err))
+        raise err
+    finally:
+        listening_sock.close()
+        with crash_updates:
+            crash_updates.notify_all()
+
+# Create a socket listening on the given address and port, and spawn a thread
+# running accept_backend_connections() for it. Returns the listening socket.
+def start_backend_listener(listening_addr, backend_port, crash_updates):
+    s1 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s1.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s1.bind((listening_addr, backend_port))
+    s1.listen(5)
+    t1 = threading.Thread(target=accept_backend_connections, args=(s1, crash_updates))
+    t1.daemon = True
+    t1.start()
+    return s1
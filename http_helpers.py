@@ -14,9 +14,17 @@ import traceback
 import sys
 import time
 import string
+import os
+import threading
+import socket
+import hashlib
+import gzip
+import zlib
+import tracing
+from collections import OrderedDict
+from collections.abc import Mapping, MutableMapping
 from dataclasses import dataclass
 from multithread_logging import *
-from requests.structures import CaseInsensitiveDict
 
 # HTTPConnection objects are used to hold information associated with a single HTTP
 # connection socket, like the socket itself, statistics, a keep-alive flag, and
@@ -27,19 +35,134 @@ class HTTPConnection:
         self.client_addr = addr   # address of the client
         self.keep_alive = True    # whether this is a persistent connection
         self.num_requests = 0     # number of HTTP requests from client handled so far
+        self.accept_encoding = "" # Accept-Encoding header from the most recent request
+        self.range = None         # Range header from the most recent request, if any
+        self.if_range = None      # If-Range header from the most recent request, if any
+        self.idle_since = time.monotonic() # when we started waiting for a request, or None if busy
+        self.reaped = False       # whether the reaper closed this connection for being idle
+        self.head_request = False # whether the current request is a HEAD, so no body is sent
+        self.pending = []         # buffers for pipelined responses that haven't been sent yet
+        self.pending_bytes = 0    # total size of those buffers
+        self.http_version = "HTTP/1.1" # version from the most recent request
+        self.last_status = None   # status code of the most recent response, like "200"
 
-## NOTE: This next data type isn't used anywhere, but it could be useful I guess?
-## # HTTPResponse objects are used to hold information associated with a single
-## # HTTP response that will be sent to a client. The code is required, and should
-## # be something like "200 OK" or "404 NOT FOUND". The mime_type and body are
-## # optional and can be None if not needed. If present, the mime_type should be
-## # something like "text/plain" or "image/png", and the body should be a string or
-## # raw bytes object containing contents appropriate for that mime type.
-## class HTTPResponse:
-##     def __init__(self, code, mime_type=None, body=None):
-##         self.code = code
-##         self.mime_type = mime_type
-##         self.body = body
+#### Persistent connection limits ####
+
+# How long, in seconds, a persistent connection may sit idle waiting for the
+# client's next request before the reaper closes it.
+idle_timeout = 15.0
+
+# How many requests we handle on one persistent connection before asking the
+# client to open a new one (by sending "Connection: close").
+max_requests_per_connection = 1000
+
+# ConnectionReaper keeps track of open connections, and periodically closes any
+# that have been idle for longer than idle_timeout. Closing the socket wakes up
+# the thread blocked in recv(), which then finishes up normally, so the thread
+# is freed to exit. Use it like this:
+#   connection_reaper.watch(conn)   # when a connection is accepted
+#   connection_reaper.forget(conn)  # when the connection is closed
+class ConnectionReaper:
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.conns = set()
+        self.thread = None
+
+    def watch(self, conn):
+        with self.lock:
+            self.conns.add(conn)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="ConnectionReaper")
+                self.thread.daemon = True
+                self.thread.start()
+
+    def forget(self, conn):
+        with self.lock:
+            self.conns.discard(conn)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.monotonic()
+            with self.lock:
+                conns = list(self.conns)
+            for conn in conns:
+                since = conn.idle_since
+                if since is not None and now - since > idle_timeout:
+                    log_sampled("idle-conn", "Closing idle connection with %s:%d", conn.client_addr[0], conn.client_addr[1])
+                    conn.reaped = True
+                    self.forget(conn)
+                    try:
+                        conn.sock.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+
+connection_reaper = ConnectionReaper()
+
+# HTTPResponse objects are used to hold information associated with a single
+# HTTP response that will be sent to a client. The code is required, and should
+# be something like "200 OK" or "404 NOT FOUND". The mime_type and body are
+# optional and can be None if not needed. If present, the mime_type should be
+# something like "text/plain" or "image/png", and the body should be a string or
+# raw bytes object containing contents appropriate for that mime type. The body
+# can also be a generator (or any other iterable) of strings or bytes, in which
+# case the pieces are sent as they are produced, using chunked transfer-encoding.
+# Extra headers, like "Location", can be added with add_header(). Use
+# send_response() to send it.
+# Example:
+#   resp = HTTPResponse("302 TEMPORARY REDIRECT", "text/plain", "Go away!")
+#   resp.add_header("Location", "/shared-files.html")
+#   send_response(conn, resp)
+class HTTPResponse:
+    def __init__(self, code, mime_type=None, body=None):
+        self.code = code
+        self.mime_type = mime_type
+        self.chunks = None    # iterable of body pieces, for a streamed body
+        if body is None:
+            body = b""
+        elif isinstance(body, str):
+            body = body.encode()
+        elif not isinstance(body, (bytes, bytearray, memoryview)):
+            self.chunks = body
+            body = b""
+        self.body = body
+        self.encoding = None  # content-coding applied to body, e.g. "gzip"
+        self.headers = []     # extra (key, value) header pairs
+
+    # Add an extra header to this response.
+    def add_header(self, key, value):
+        self.headers.append((key, value))
+
+    # Compress the body, if the client accepts it and the mime type is worth
+    # compressing. See compress_content() for details.
+    # A streamed body is compressed on the fly, a piece at a time.
+    def compress(self, accept_encoding, etag=None):
+        if self.chunks is None:
+            with tracing.phase("compress"):
+                self.body, self.encoding = compress_content(self.body, self.mime_type, accept_encoding, etag)
+        elif is_compressible(self.mime_type):
+            self.encoding = choose_content_encoding(accept_encoding)
+            if self.encoding is not None:
+                self.chunks = compress_pieces(self.chunks, self.encoding)
+
+    # Build the status line and all the headers, including the blank line at the
+    # end, as a single bytes object.
+    def encode_headers(self, keep_alive):
+        parts = [status_line(self.code), http_date_header()]
+        parts.append(keep_alive_header if keep_alive else close_header)
+        if self.mime_type is not None:
+            parts.append(content_type_header(self.mime_type))
+        if self.chunks is not None:
+            parts.append(b"Transfer-Encoding: chunked\r\n")
+        else:
+            parts.append(b"Content-Length: %d\r\n" % (len(self.body)))
+        if self.encoding is not None:
+            parts.append(b"Content-Encoding: %s\r\n" % (self.encoding.encode()))
+        for key, val in self.headers:
+            parts.append(("%s: %s\r\n" % (key, val)).encode())
+        parts.append(b"\r\n")
+        return b"".join(parts)
 
 # An HTTPRequest object holds all data associated with one http request received
 # from a client (i.e. web browser). It stores the raw request bytes, and it also
@@ -62,8 +185,9 @@ class HTTPRequest:
 
     # After the first line of the HTTP request comes some headers
     headers: dict = None     # a python dictionary of all headers
-    keep_alive: bool = False # taken from headers['Keep-Alive'], or False if missing header
+    keep_alive: bool = False # from headers['Connection'], defaulting to True for HTTP/1.1 and False for HTTP/1.0
     content_length: int = 0  # taken from headers['Content-Length'], or 0 if missing header
+    accept_encoding: str = "" # taken from headers['Accept-Encoding'], or "" if missing header
 
     # Most HTTP requests end here, but PUT and POST requests often have a body too.
     # The remainder of the variables are only relevant when method is "POST" or "PUT".
@@ -78,15 +202,13 @@ class HTTPRequest:
     # mimetype.
     form_content: dict = None   # decoded content as dictionary of key-value pairs
 
+    # When each step of receiving the request finished, as a list of (step,
+    # time.perf_counter()) pairs, starting with ("received", ...) for when the
+    # headers arrived. Used for tracing, see tracing.py.
+    timings: list = None
+
     def __repr__(self):
-        if len(self.content) > 0 and len(self.plaintext_content) > 0:
-            return self.summary + self.plaintext_content
-        elif len(self.content) > 0 and len(self.content) <= 500:
-            try:
-                return self.summary + self.content.decode()
-            except:
-                return self.summary + "[%d bytes of binary payload, not shown here]" % (len(self.content))
-        elif len(self.content) > 0:
+        if len(self.content) > 0:
             return self.summary + "[%d bytes of payload, not shown here]" % (len(self.content))
         else:
             return self.summary
@@ -196,7 +318,7 @@ def parse_multipart_form_data(ctype, contents):
             mimetype = headers["Content-Type"]
         # grab the content-disposition header, which has the field name and filename
         name, filename = parse_content_disposition(headers["Content-Disposition"])
-        log("Request has multipart segment with name '%s', filename '%s', mimetype '%s', body=%dbytes" % (name, filename, mimetype, len(data)))
+        logdebug("Request has multipart segment with name '%s', filename '%s', mimetype '%s', body=%dbytes", name, filename, mimetype, len(data))
         # if disp is None:
         #     continue
         # name = disp["name"]
@@ -255,12 +377,17 @@ def recv_one_request_from_client(client_sock):
     try:
         req = client_sock.recv_until(b"\r\n\r\n")
         if not req:
-            logerr("Error receiving HTTP request: maybe connection was closed prematurely?")
+            if len(client_sock.recvd) == 0:
+                # normal for a persistent connection, the client is done with it
+                logdebug("Connection closed by client.")
+            else:
+                logerr("Error receiving HTTP request: maybe connection was closed prematurely?")
             return None
     except Exception as err:
         logerr("Error receiving HTTP request: %s" % (str(err)))
         traceback.print_exception(*sys.exc_info())
         return None
+    received = time.perf_counter()
 
     try:
         reqstring = req.decode() # convert bytes to string
@@ -272,7 +399,7 @@ def recv_one_request_from_client(client_sock):
         req.summary = reqstring
         req.method = method
         req.urlpath = urlpath
-        req.version
+        req.version = version
         req.headers = parse_http_headers(headers)
 
         # decode the urlpath
@@ -283,15 +410,28 @@ def recv_one_request_from_client(client_sock):
         else:
             req.path = urllib.parse.unquote(urlpath)
             req.params = {}
+        req.timings = [("received", received), ("header_parse", time.perf_counter())]
 
         # grab the keepalive and content-length headers, and the content if present
-        req.keep_alive = "Connection" in req.headers and req.headers["Connection"].lower() == "keep-alive"
-        if "Content-Length" in req.headers:
+        # HTTP/1.1 connections are persistent unless the client says "close",
+        # but HTTP/1.0 connections are only persistent if the client asks.
+        conn_opts = [opt.strip() for opt in req.headers.get("Connection", "").lower().split(",")]
+        if version.upper() in ["HTTP/1.0", "HTTP/0.9"]:
+            req.keep_alive = "keep-alive" in conn_opts
+        else:
+            req.keep_alive = "close" not in conn_opts
+        req.accept_encoding = req.headers.get("Accept-Encoding", "")
+        if "chunked" in req.headers.get("Transfer-Encoding", "").lower():
+            req.content = b"".join(recv_chunked_body(client_sock))
+            req.content_length = len(req.content)
+        elif "Content-Length" in req.headers:
             req.content_length = int(req.headers["Content-Length"])
             req.content = client_sock.recv_exactly(req.content_length)
         else:
             req.content_length = 0
             req.content = b""
+        if req.content_length > 0:
+            req.timings.append(("body_read", time.perf_counter()))
 
         # for POST requests, decode the uploaded files and form data
         req.form_content = { }
@@ -304,6 +444,7 @@ def recv_one_request_from_client(client_sock):
                 req.form_content = parse_multipart_form_data(ctype, req.content)
             if "text/plain" in ctype.lower() or "text/html" in ctype.lower():
                 req.plaintext_content = req.content.decode()
+            req.timings.append(("body_parse", time.perf_counter()))
 
         return req
 
@@ -312,9 +453,544 @@ def recv_one_request_from_client(client_sock):
         traceback.print_exception(*sys.exc_info())
         return None
 
+# Given a socket connected to some http client, just after the headers of a
+# request that uses "Transfer-Encoding: chunked", this receives the body and
+# yields it one chunk at a time, as bytes. The body looks like:
+#   1a;optional-extensions\r\n
+#   ...26 bytes of data...\r\n
+#   5\r\n
+#   ...5 bytes of data...\r\n
+#   0\r\n
+#   optional-trailer: headers\r\n
+#   \r\n
+# A ValueError is raised if the body is malformed or the connection closes early.
+def recv_chunked_body(client_sock):
+    while True:
+        line = client_sock.recv_until(b"\r\n")
+        if line is None:
+            raise ValueError("connection closed in the middle of a chunked body")
+        size = int(line.split(b";", 1)[0].strip(), 16)
+        if size < 0:
+            raise ValueError("negative chunk size in chunked body")
+        if size == 0:
+            break
+        data = client_sock.recv_exactly(size)
+        if data is None or client_sock.recv_exactly(2) != b"\r\n":
+            raise ValueError("bad chunk in chunked body")
+        yield data
+    # skip over any trailers, up to the final blank line
+    while True:
+        line = client_sock.recv_until(b"\r\n")
+        if line is None:
+            raise ValueError("connection closed in the middle of chunked body trailers")
+        if line == b"\r\n":
+            break
+
+# Returns True if the whole of the next request on a SmartSocket, body included,
+# is already sitting in its receive buffer, so it can be read without waiting on
+# the network. A chunked body never counts, since finding its end would mean
+# walking every chunk, and neither does a malformed Content-Length, which the
+# request parser will complain about.
+def has_buffered_request(sock):
+    end = sock.recvd.find(b"\r\n\r\n")
+    if end < 0:
+        return False
+    length = 0
+    for line in sock.recvd[:end].split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        if name == b"transfer-encoding":
+            return False
+        if name == b"content-length":
+            if not value.strip().isdigit():
+                return False
+            length = int(value)
+    return len(sock.recvd) >= end + 4 + length
+
+# Given an HTTPConnection, wait for and receive the next HTTP request on it. This
+# marks the connection as idle while waiting (so the reaper can close it if the
+# client takes too long), and updates the connection's keep-alive flag and other
+# per-request variables. It returns the HTTPRequest, or None if the connection
+# was closed or anything went wrong.
+# A HEAD request is handed back as a GET, since the response is exactly the same
+# except that send_response() will leave off the body.
+def recv_next_request(conn):
+    if not has_buffered_request(conn.sock):
+        # we might block, for the headers or the body, so send any pipelined
+        # responses we held back first. A client that sent "Expect: 100-continue"
+        # waits for those before it sends the body.
+        flush_responses(conn)
+    conn.idle_since = time.monotonic()
+    req = recv_one_request_from_client(conn.sock)
+    conn.idle_since = None
+    if req is None:
+        flush_responses(conn)
+        return None
+    conn.num_requests += 1
+    conn.keep_alive = req.keep_alive and conn.num_requests < max_requests_per_connection
+    conn.accept_encoding = req.accept_encoding
+    conn.range = req.headers.get("Range")
+    conn.if_range = req.headers.get("If-Range")
+    conn.http_version = req.version
+    conn.head_request = (req.method == "HEAD")
+    if conn.head_request:
+        req.method = "GET"
+    return req
+
+#### Response writing ####
+
+# Status lines are built once per status code and reused after that.
+status_lines = {}
+
+# Returns the status line for a code like "200 OK", as bytes.
+def status_line(code):
+    line = status_lines.get(code)
+    if line is None:
+        line = ("HTTP/1.1 %s\r\n" % (code)).encode()
+        status_lines[code] = line
+    return line
+
+keep_alive_header = b"Connection: keep-alive\r\n"
+close_header = b"Connection: close\r\n"
+
+# The header block for each content type is also built once and reused. For
+# compressible types it includes "Vary: Accept-Encoding", since the body we send
+# depends on that request header.
+content_type_headers = {}
+
+# Returns the Content-Type header block for a mime type, as bytes.
+def content_type_header(mime_type):
+    block = content_type_headers.get(mime_type)
+    if block is None:
+        block = "Content-Type: %s\r\n" % (mime_type)
+        if is_compressible(mime_type):
+            block += "Vary: Accept-Encoding\r\n"
+        block = block.encode()
+        content_type_headers[mime_type] = block
+    return block
+
+# The Date header only changes once per second, so we cache it as a
+# (second, header) pair, and rebuild it only when the second changes.
+date_cache = (0, b"")
+
+# Returns the "Date: ..." header line, as bytes.
+def http_date_header():
+    global date_cache
+    now = int(time.time())
+    cached = date_cache
+    if cached[0] != now:
+        hdr = ("Date: %s\r\n" % (time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(now)))).encode()
+        cached = (now, hdr)
+        date_cache = cached
+    return cached[1]
+
 # Get the current date in the format needed for the HTTP "Date:" response header.
 def http_date_now():
-    return time.strftime("%a, %d %b %Y %H:%M:%S %Z")
+    return http_date_header()[6:-2].decode()
+
+# Pipelined responses are held back until at most this many bytes are waiting.
+max_pipelined_bytes = 256 * 1024
+
+# Send an HTTPResponse to the client. The headers and body are handed to the
+# socket as separate buffers, so the (possibly large) body never gets copied
+# just to stick the headers on the front of it.
+# If the client has pipelined another whole request behind this one (i.e. it is
+# already sitting in our receive buffer, body and all), the response is held
+# back instead, so the responses to a whole batch of requests go out in a single
+# vectored write.
+def send_response(conn, resp):
+    conn.last_status = resp.code.split(" ", 1)[0]
+    if resp.chunks is not None:
+        if conn.http_version.upper() not in ["HTTP/1.0", "HTTP/0.9"]:
+            send_chunked_response(conn, resp)
+            return
+        # older clients don't understand chunked encoding, so collect the whole body
+        resp.body = b"".join([piece_bytes(p) for p in resp.chunks])
+        resp.chunks = None
+    header = resp.encode_headers(conn.keep_alive)
+    logdebug(header)
+    conn.pending.append(header)
+    conn.pending_bytes += len(header)
+    if not conn.head_request and len(resp.body) > 0:
+        conn.pending.append(resp.body)
+        conn.pending_bytes += len(resp.body)
+    if conn.keep_alive and conn.pending_bytes < max_pipelined_bytes and has_buffered_request(conn.sock):
+        return
+    flush_responses(conn)
+
+# Streamed bodies are sent in chunks of at least this many bytes, so we don't
+# make a separate send() call for every little piece the generator yields.
+min_chunk_size = 16 * 1024
+
+# Convert a piece of a streamed body to bytes.
+def piece_bytes(piece):
+    if isinstance(piece, str):
+        return piece.encode()
+    return piece
+
+# Given an iterable of body pieces, yield them as bytes, gathering small pieces
+# together until there are at least min_chunk_size bytes.
+def coalesce_pieces(pieces):
+    batch = []
+    n = 0
+    for piece in pieces:
+        piece = piece_bytes(piece)
+        if len(piece) == 0:
+            continue
+        batch.append(piece)
+        n += len(piece)
+        if n >= min_chunk_size:
+            yield b"".join(batch)
+            batch = []
+            n = 0
+    if n > 0:
+        yield b"".join(batch)
+
+# Send an HTTPResponse with a streamed body, using chunked transfer-encoding.
+# Each chunk is sent as soon as the body generator produces it.
+def send_chunked_response(conn, resp):
+    header = resp.encode_headers(conn.keep_alive)
+    logdebug(header)
+    conn.pending.append(header)
+    conn.pending_bytes += len(header)
+    if conn.head_request:
+        flush_responses(conn)
+        return
+    # The headers (and anything held back from earlier requests) go out with the
+    # first chunk, and the final zero-length chunk goes out with the last one,
+    # so each chunk is held back until we know whether another one follows.
+    # Sending the headers or the end marker on their own would be a small write
+    # right after another write, which Nagle's algorithm holds back until the
+    # client ACKs, and clients delay their ACKs by up to 40ms.
+    with tracing.phase("send", "chunked"):
+        bufs = conn.pending
+        conn.pending = []
+        conn.pending_bytes = 0
+        held = None
+        for chunk in coalesce_pieces(resp.chunks):
+            if held is not None:
+                bufs.extend([b"%x\r\n" % (len(held)), held, b"\r\n"])
+                conn.sock.sendmsg_all(bufs)
+                bufs = []
+            held = chunk
+        if held is not None:
+            bufs.extend([b"%x\r\n" % (len(held)), held, b"\r\n"])
+        bufs.append(b"0\r\n\r\n")
+        conn.sock.sendmsg_all(bufs)
+
+# Send any responses that were held back by send_response().
+def flush_responses(conn):
+    if len(conn.pending) == 0:
+        return
+    bufs = conn.pending
+    conn.pending = []
+    conn.pending_bytes = 0
+    with tracing.phase("send"):
+        conn.sock.sendmsg_all(bufs)
+
+#### Range requests ####
+
+# Given the value of a Range request header, like "bytes=0-499", "bytes=500-",
+# or "bytes=-500" (the last 500 bytes), and the size of the whole body, return
+# the (start, end) of the range, with end exclusive. Returns None if the whole
+# body should be sent instead, for a header we don't handle, like one asking
+# for several ranges at once, or False if the range is past the end.
+def parse_range(header, size):
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, dash, last = spec.strip().partition("-")
+    try:
+        if dash == "" or (first == "" and last == ""):
+            return None
+        if first == "":
+            n = int(last)
+            if n == 0 or size == 0:
+                return False
+            return (max(0, size - n), size)
+        start = int(first)
+        if last != "" and int(last) < start:
+            return None   # not a valid range, so it is ignored
+        if start >= size:
+            return False
+        return (start, size if last == "" else min(int(last) + 1, size))
+    except ValueError:
+        return None
+
+# Turn a 200 OK response into a 206 Partial Content response with just the
+# range the client asked for, given the request's Range and If-Range headers,
+# or into a 416 Range Not Satisfiable response if it asked for a range past the
+# end. The body is sliced as a memoryview, so nothing is copied, even for a
+# memory-mapped file. Returns True if the response was changed, and False if
+# the whole body should be sent as usual. We don't send validators, so a
+# request with If-Range (only resume if the file didn't change) always gets
+# the whole body, which is what it asks for when in doubt.
+def apply_range(resp, range_header, if_range=None):
+    resp.add_header("Accept-Ranges", "bytes")
+    if range_header is None or if_range is not None or resp.chunks is not None:
+        return False
+    size = len(resp.body)
+    r = parse_range(range_header, size)
+    if r is None:
+        return False
+    if r is False:
+        resp.code = "416 Range Not Satisfiable"
+        resp.body = b""
+        resp.add_header("Content-Range", "bytes */%d" % (size))
+        return True
+    start, end = r
+    resp.code = "206 Partial Content"
+    resp.body = memoryview(resp.body)[start:end]
+    resp.add_header("Content-Range", "bytes %d-%d/%d" % (start, end - 1, size))
+    return True
+
+#### HTTP on the back-end diagnostic port ####
+
+# The back-end diagnostic port normally speaks a simple line-based protocol for
+# humans using netcat or telnet. But monitoring tools, like Prometheus, speak
+# HTTP to it instead. An HTTP client sends its request right away, whereas a
+# human waits for the welcome message, so we can tell them apart by waiting a
+# moment to see if anything arrives. A caller that has already peeked at what
+# arrived can pass that as first, so it doesn't wait a second time.
+def looks_like_http(sock, timeout=0.25, first=None):
+    if first is None:
+        first = sock.peek(timeout)
+    return first.startswith(b"GET ") or first.startswith(b"HEAD ")
+
+# Serve HTTP requests on a back-end diagnostic port connection. The pages
+# parameter is a dictionary mapping paths, like "/metrics", to functions that
+# return a (mime_type, content) pair.
+def serve_backend_http(sock, peer_addr, pages):
+    conn = HTTPConnection(sock, peer_addr)
+    while conn.keep_alive:
+        req = recv_next_request(conn)
+        if req is None:
+            break
+        if req.method == "GET" and req.path in pages:
+            mime_type, content = pages[req.path]()
+            resp = HTTPResponse("200 OK", mime_type, content)
+            resp.compress(conn.accept_encoding)
+        else:
+            resp = HTTPResponse("404 NOT FOUND", "text/plain", "No such diagnostic page.")
+        send_response(conn, resp)
+
+#### Response compression ####
+
+# Responses with these mime types are worth compressing: mostly text, plus a few
+# text-based application formats. Anything else (video, zip, jpeg, png, pdf,
+# etc.) is either already compressed or not worth the cpu, so it is sent as-is.
+compressible_mime_types = [
+    "application/javascript", "application/json", "application/xml",
+    "application/xhtml+xml", "application/x-javascript", "image/svg+xml",
+]
+
+# Bodies smaller than this aren't compressed, since the savings would be lost in
+# the packet headers anyway.
+min_compress_size = 1024
+
+# Upper bound on the total size of all cached compressed variants.
+max_compression_cache_bytes = 64 * 1024 * 1024
+
+# Bigger bodies are sent as-is. Their compressed variants are too big to cache,
+# so each request would have to compress the whole thing again, and hold all of
+# the result in memory, which matters most for memory-mapped files (see
+# mapped_files.py).
+max_compress_size = 16 * 1024 * 1024
+
+# Content-codings we know how to produce, in order of preference.
+supported_encodings = ["gzip", "deflate"]
+
+# Returns True if a response with the given mime type should be compressed.
+def is_compressible(mime_type):
+    if mime_type is None:
+        return False
+    mime_type = mime_type.split(";", 1)[0].strip().lower()
+    return mime_type.startswith("text/") or mime_type in compressible_mime_types
+
+# Given the value of an Accept-Encoding request header, like
+# "gzip, deflate;q=0.5, br", pick the best content-coding we support, or return
+# None if the client doesn't accept any of them. The q parameter can be
+# anywhere among a coding's parameters, and "*" stands for every coding that
+# isn't listed by name, so "gzip;q=0, *" rules out gzip but not deflate.
+def choose_content_encoding(accept_encoding):
+    if not accept_encoding:
+        return None
+    named = {}      # coding -> q
+    star_q = 0.0    # q for codings not listed by name
+    for part in accept_encoding.split(","):
+        coding, *params = [p.strip() for p in part.split(";")]
+        coding = coding.lower()
+        if coding == "x-gzip":
+            coding = "gzip"
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value.strip())
+                except ValueError:
+                    q = 0.0
+        if coding == "*":
+            star_q = q
+        elif coding in supported_encodings:
+            named[coding] = q
+    best = None
+    best_q = 0.0
+    for c in supported_encodings:
+        # ties go to whichever coding we prefer, which comes first
+        q = named.get(c, star_q)
+        if q > best_q:
+            best = c
+            best_q = q
+    return best
+
+# Returns an ETag-style identifier for some content, for use as a cache key
+# when the content doesn't come from a file (e.g. a dynamically generated page).
+def content_etag(data):
+    return '"%s"' % (hashlib.blake2b(data, digest_size=16).hexdigest())
+
+# Returns an ETag-style identifier for a file, based on its size and
+# modification time, or None if the file can't be stat'ed.
+def file_etag(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return '"%x-%x"' % (st.st_mtime_ns, st.st_size)
+
+# CompressionCache holds compressed variants of response bodies, keyed by
+# (etag, encoding). It is bounded by total size, and evicts the least recently
+# used variants first. A cached value of None means "compression didn't help
+# for this body", so we don't keep trying.
+class CompressionCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+
+    def lookup(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return False, None
+            self.entries.move_to_end(key)
+            return True, self.entries[key]
+
+    def insert(self, key, data):
+        n = 0 if data is None else len(data)
+        if n > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = data
+            self.total_bytes += n
+            while self.total_bytes > self.max_bytes:
+                _, old = self.entries.popitem(last=False)
+                self.total_bytes -= 0 if old is None else len(old)
+
+compression_cache = CompressionCache(max_compression_cache_bytes)
+
+# Compress some data using the given content-coding.
+def compress_bytes(data, encoding):
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=6, mtime=0)
+    else:
+        return zlib.compress(data, 6)
+
+# Given an iterable of body pieces (strings or bytes), yield them compressed
+# using the given content-coding. This is used for streamed responses, where we
+# can't cache the compressed result.
+def compress_pieces(pieces, encoding):
+    if encoding == "gzip":
+        z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    else:
+        z = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS)
+    for piece in pieces:
+        data = z.compress(piece_bytes(piece))
+        if len(data) > 0:
+            yield data
+    yield z.flush()
+
+# Given a response body, its mime type, and the client's Accept-Encoding header,
+# this returns a (body, encoding) pair. The encoding is "gzip" or "deflate" if
+# the body was compressed, or None if the original body should be sent as-is.
+# The compressed variant is cached under the etag so later responses for the
+# same content can skip the compression work. If no etag is given (e.g. for
+# dynamically generated pages), one is computed from the content itself, which
+# is much cheaper than compressing it again.
+def compress_content(content, mime_type, accept_encoding, etag=None):
+    if len(content) < min_compress_size or len(content) > max_compress_size or not is_compressible(mime_type):
+        return content, None
+    encoding = choose_content_encoding(accept_encoding)
+    if encoding is None:
+        return content, None
+    if etag is None:
+        etag = content_etag(content)
+    found, data = compression_cache.lookup((etag, encoding))
+    if not found:
+        data = compress_bytes(content, encoding)
+        if len(data) >= len(content):
+            data = None
+        compression_cache.insert((etag, encoding), data)
+    if data is None:
+        return content, None
+    return data, encoding
+
+# CaseInsensitiveDict is like dict, the built-in python dictionary type, but it
+# ignores case for the keys, which is what HTTP headers need. It remembers the
+# case each key was last set with, for printing. This does the same job as
+# requests.structures.CaseInsensitiveDict, without importing all of requests
+# (and urllib3, and more) into every server just for this.
+# Expected usage:
+#   d = CaseInsensitiveDict()
+#   d["CoNTeNt-LENGtH"] = "25"
+#   if "content-length" in d: ...   # this condition will be true
+#   print(d.get("Content-Length"))  # prints 25
+class CaseInsensitiveDict(MutableMapping):
+    def __init__(self, data=None, **kwargs):
+        self._store = {}  # lowercase key -> (key, value)
+        if data is not None:
+            self.update(data)
+        self.update(kwargs)
+
+    def __setitem__(self, key, value):
+        self._store[key.lower()] = (key, value)
+
+    def __getitem__(self, key):
+        return self._store[key.lower()][1]
+
+    def __delitem__(self, key):
+        del self._store[key.lower()]
+
+    def __contains__(self, key):
+        return key.lower() in self._store
+
+    # get() is used for almost every header lookup, so it is written out here
+    # rather than using the slower one that MutableMapping provides.
+    def get(self, key, default=None):
+        pair = self._store.get(key.lower())
+        return default if pair is None else pair[1]
+
+    def __iter__(self):
+        return (key for key, value in self._store.values())
+
+    def __len__(self):
+        return len(self._store)
+
+    def lower_items(self):
+        return ((lower, pair[1]) for lower, pair in self._store.items())
+
+    def __eq__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return dict(self.lower_items()) == dict(CaseInsensitiveDict(other).lower_items())
+
+    def copy(self):
+        return CaseInsensitiveDict(self._store.values())
+
+    def __repr__(self):
+        return str(dict(self.items()))
 
 # CaseInsensitiveDictWithDefault is just like dict, the built-in python
 # dictionary type, but it ignores case for the keys, and when getting the value
@@ -0,0 +1,179 @@
+# A compact binary format for sending a replica's file listing to the central
+# coordinator, as an alternative to the "name,size&name,size" text format.
+# Intended usage, on the sending side:
+#   body = inventory_wire.encode_inventory(version, records)   # a generator of bytes
+# and on the receiving side:
+#   decoder = inventory_wire.InventoryDecoder()
+#   for piece in pieces_from_the_socket:
+#       for name, size, mtime_ns, digest in decoder.feed(piece):
+#           ...
+#   decoder.finish()   # raises ValueError if the stream was cut short
+# where each record is a (name, size, mtime_ns, digest) tuple. The size is None
+# for a file that was removed (only in a delta, see below), and the mtime_ns
+# and digest are None unless they were asked for and known.
+#
+# The text format can't handle filenames that contain "," or "&", and has to
+# be built and split as one big string on both ends. This one is sent and
+# parsed a block at a time, and is a lot smaller and faster to parse, because
+# each block stores its records column by column and compresses them:
+#
+#   stream header, 16 bytes:
+#     magic "CDINV", format_version (1 byte), flags (1 byte), fields (1 byte),
+#     inventory version (8 bytes, little-endian)
+#   then any number of blocks, each with a 9-byte header:
+#     kind (1 byte), count (4 bytes), payload length (4 bytes)
+#   followed by the payload, zlib-compressed. For a block of present files
+#   (kind 1) the payload holds:
+#     count sizes, 8 bytes each, little-endian
+#     count mtimes in nanoseconds, 8 bytes each, if fields has field_mtime
+#     count digests, 16 bytes each (all zero if unknown), if fields has field_digest
+#     the names, utf-8, separated by "\0"
+#   A block of removed files (kind 2) holds only the names. A final block of
+#   kind 0 has the total number of records as its count and no payload.
+#
+# Filenames can't contain "\0", so the names can be split apart in one go, and
+# the numbers are unpacked with struct, so almost nothing happens a record at a
+# time in python. The flags say whether the stream is a whole listing or just
+# the changes since some earlier version (flag_delta).
+
+import struct     # for packing and unpacking numbers
+import zlib       # for compressing blocks
+
+mime_type = "application/x-cloud-inventory"
+
+magic = b"CDINV"
+format_version = 1
+flag_delta = 0x01    # the records are changes, not a whole listing
+field_mtime = 0x01   # records include modification times
+field_digest = 0x02  # records include content digests
+digest_size = 16
+
+kind_end = 0
+kind_present = 1
+kind_removed = 2
+
+stream_header = struct.Struct("<5sBBBQ")
+block_header = struct.Struct("<BII")
+
+records_per_block = 8192
+compress_level = 1   # level 6 is only about 7% smaller, and twice as slow
+
+# Return the value of the "fields" bits for a comma-separated list of field
+# names, like "mtime,digest", as given in a url parameter.
+def parse_fields(names):
+    fields = 0
+    for name in (names or "").split(","):
+        name = name.strip()
+        if name == "mtime":
+            fields |= field_mtime
+        elif name == "digest":
+            fields |= field_digest
+    return fields
+
+# Encode one block of records, all of the same kind.
+def encode_block(kind, records, fields):
+    parts = []
+    if kind == kind_present:
+        parts.append(struct.pack("<%dQ" % (len(records)), *[r[1] for r in records]))
+        if fields & field_mtime:
+            parts.append(struct.pack("<%dQ" % (len(records)), *[r[2] or 0 for r in records]))
+        if fields & field_digest:
+            parts.append(b"".join([(r[3] or bytes(digest_size))[:digest_size].ljust(digest_size, b"\0")
+                    for r in records]))
+    parts.append("\0".join([r[0] for r in records]).encode("utf-8", "surrogateescape"))
+    payload = zlib.compress(b"".join(parts), compress_level)
+    return block_header.pack(kind, len(records), len(payload)) + payload
+
+# Encode records, given as (name, size, mtime_ns, digest) tuples with size None
+# for removed files, and yield the encoded stream a block at a time. The
+# version is the inventory version these records bring the receiver up to.
+def encode_inventory(version, records, delta=False, fields=0):
+    yield stream_header.pack(magic, format_version, flag_delta if delta else 0, fields, version)
+    total = 0
+    batch = []
+    batch_kind = None
+    for r in records:
+        kind = kind_removed if r[1] is None else kind_present
+        if kind != batch_kind or len(batch) == records_per_block:
+            if len(batch) > 0:
+                yield encode_block(batch_kind, batch, fields)
+                total += len(batch)
+            batch = []
+            batch_kind = kind
+        batch.append(r)
+    if len(batch) > 0:
+        yield encode_block(batch_kind, batch, fields)
+        total += len(batch)
+    yield block_header.pack(kind_end, total, 0)
+
+# InventoryDecoder decodes a stream made by encode_inventory(), given to it in
+# pieces of any size. After the stream header has arrived, the version, delta,
+# and fields attributes say what the stream holds.
+class InventoryDecoder:
+    def __init__(self):
+        self.buf = bytearray()
+        self.version = None
+        self.delta = None
+        self.fields = None
+        self.count = 0       # records decoded so far
+        self.done = False    # True once the end block arrives
+
+    # Add some more bytes of the stream, and return a list of the records that
+    # are now complete. Raises ValueError if the stream isn't valid.
+    def feed(self, data):
+        self.buf += data
+        records = []
+        pos = 0
+        if self.version is None:
+            if len(self.buf) < stream_header.size:
+                return records
+            m, fmt, flags, self.fields, self.version = stream_header.unpack_from(self.buf, 0)
+            if m != magic or fmt != format_version:
+                raise ValueError("not an inventory stream, or an unknown format version")
+            self.delta = bool(flags & flag_delta)
+            pos = stream_header.size
+        while not self.done and len(self.buf) - pos >= block_header.size:
+            kind, count, length = block_header.unpack_from(self.buf, pos)
+            if len(self.buf) - pos - block_header.size < length:
+                break
+            start = pos + block_header.size
+            pos = start + length
+            if kind == kind_end:
+                if count != self.count:
+                    raise ValueError("inventory stream has %d records, expected %d" % (self.count, count))
+                self.done = True
+            else:
+                records.extend(self.decode_block(kind, count, zlib.decompress(self.buf[start:pos])))
+        if self.done and pos < len(self.buf):
+            raise ValueError("extra bytes after the end of the inventory stream")
+        del self.buf[:pos]
+        return records
+
+    def decode_block(self, kind, count, payload):
+        pos = 0
+        if kind == kind_present:
+            sizes = struct.unpack_from("<%dQ" % (count), payload, pos)
+            pos += 8 * count
+            mtimes = digests = [None] * count
+            if self.fields & field_mtime:
+                mtimes = struct.unpack_from("<%dQ" % (count), payload, pos)
+                pos += 8 * count
+            if self.fields & field_digest:
+                zero = bytes(digest_size)
+                digests = [payload[i:i+digest_size] for i in range(pos, pos + digest_size * count, digest_size)]
+                digests = [None if d == zero else d for d in digests]
+                pos += digest_size * count
+        elif kind == kind_removed:
+            sizes = mtimes = digests = [None] * count
+        else:
+            raise ValueError("unknown inventory block kind %d" % (kind))
+        names = payload[pos:].decode("utf-8", "surrogateescape").split("\0")
+        if len(names) != count:
+            raise ValueError("inventory block has %d names, expected %d" % (len(names), count))
+        self.count += count
+        return list(zip(names, sizes, mtimes, digests))
+
+    # Check that the whole stream arrived.
+    def finish(self):
+        if not self.done or len(self.buf) > 0:
+            raise ValueError("inventory stream was cut short")
@@ -0,0 +1,237 @@
+#!/usr/bin/python3
+
+# Launcher for running the whole cloud file storage service on one machine: a
+# central coordinator plus some replicas, each as its own local process, on its
+# own ports, in its own scratch folder, and each pretending to be in a different
+# cloud region. Run it like this:
+#   ./local_cluster.py 3                   # central plus 3 replicas, on random free ports
+#   ./local_cluster.py 3 --base-port 8000  # central on 8000/8001, replicas on 8002/8003, ...
+# Then browse to the central coordinator's url, which is printed out. Press
+# Control-C to stop everything.
+#
+# The replicas find out their IP address from the cloud metadata service, like
+# they do in the cloud. Here, a stand-in metadata service (see metadata_stub.py)
+# is started first, and each replica is pointed at its own pretend instance in
+# it using the CLOUD_METADATA_URL environment variable. Half of the pretend
+# instances are AWS and half are GCP.
+#
+# This can also be used from python, as the benchmarks in bench/ do:
+#   cluster = local_cluster.start_cluster(3)
+#   print(cluster.url)
+#   ...
+#   cluster.stop()
+
+import argparse     # for command-line options
+import os           # for paths and os.environ
+import sys          # for sys.executable
+import shutil       # for copying the static folder and removing scratch folders
+import socket       # for finding free ports and waiting for servers to start
+import subprocess   # for starting the servers
+import tempfile     # for scratch folders
+import threading    # for waiting for Control-C
+import time         # for time.sleep() and time.monotonic()
+
+import aws            # for aws.region_for_zone
+import gcp            # for gcp.region_for_zone
+import cloud          # for cloud.region_cities
+import metadata_stub  # for the stand-in metadata service
+
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Servers are started with this log level, so logging doesn't slow them down
+# or fill up the disk during a benchmark. Override it with LOG_LEVEL.
+default_server_log_level = "warn"
+
+# Pretend locations for the replicas, as (cloud, zone), used round-robin.
+fake_zones = [
+    ("gcp", "us-east1-b"),
+    ("aws", "us-west-2a"),
+    ("gcp", "europe-west1-b"),
+    ("aws", "ap-northeast-1a"),
+    ("gcp", "australia-southeast1-a"),
+    ("aws", "sa-east-1a"),
+    ("gcp", "asia-east1-a"),
+    ("aws", "eu-central-1a"),
+]
+
+# Return a TCP port number that nobody is listening on right now.
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+# Wait until something is listening on the given port, or raise an exception.
+def wait_for_port(port, proc, timeout=15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("server process exited early with status %d" % (proc.returncode))
+        try:
+            s = socket.create_connection(("127.0.0.1", port), timeout=0.5)
+            s.close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("server did not start listening on port %d" % (port))
+
+# ServerProcess is one running server, with its ports and scratch folder.
+class ServerProcess:
+    def __init__(self, role, name, region, proc, workdir, frontend_port, backend_port):
+        self.role = role                   # "full", "central", or "replica"
+        self.name = name
+        self.region = region
+        self.proc = proc
+        self.workdir = workdir
+        self.frontend_port = frontend_port
+        self.backend_port = backend_port
+
+    def stop(self):
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(5)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+
+# Cluster is the whole set of servers, the front-end server first.
+class Cluster:
+    def __init__(self, kind, scratch, keep=False):
+        self.kind = kind          # "full" or "central"
+        self.servers = []
+        self.scratch = scratch    # scratch folder holding all the servers' folders
+        self.keep = keep          # if True, don't remove the scratch folder at the end
+        self.stub = None          # the stand-in metadata service, if any
+        self.url = None
+
+    # A description of the cluster, for benchmark reports.
+    def describe(self):
+        return {
+            "kind": self.kind,
+            "servers": [{ "role": s.role, "name": s.name, "region": s.region,
+                          "frontend_port": s.frontend_port, "backend_port": s.backend_port }
+                        for s in self.servers],
+        }
+
+    def stop(self):
+        for s in reversed(self.servers):
+            s.stop()
+        if self.stub is not None:
+            self.stub.shutdown()
+            self.stub.server_close()
+        if not self.keep:
+            shutil.rmtree(self.scratch, ignore_errors=True)
+
+# Make a folder for one server, with an empty ./share/ and a copy of ./static/.
+def make_workdir(scratch, name):
+    workdir = os.path.join(scratch, name)
+    os.mkdir(workdir)
+    os.mkdir(os.path.join(workdir, "share"))
+    shutil.copytree(os.path.join(repo_dir, "static"), os.path.join(workdir, "static"))
+    return workdir
+
+# Start one server process, running the given python program and arguments in
+# its own folder, and wait for it to start listening.
+def launch(cluster, role, name, region, args, frontend_port, backend_port, extra_env={}):
+    workdir = make_workdir(cluster.scratch, name)
+    env = dict(os.environ)
+    env.setdefault("LOG_LEVEL", default_server_log_level)
+    env.update(extra_env)
+    logfile = open(os.path.join(workdir, "server.log"), "wb")
+    proc = subprocess.Popen([sys.executable] + args, cwd=workdir, env=env,
+            stdout=logfile, stderr=subprocess.STDOUT)
+    logfile.close()
+    server = ServerProcess(role, name, region, proc, workdir, frontend_port, backend_port)
+    cluster.servers.append(server)
+    wait_for_port(frontend_port, proc)
+    return server
+
+# Return a function that hands out port numbers: consecutive ones starting from
+# base_port, or random free ones if base_port is None.
+def port_allocator(base_port):
+    next_port = [base_port]
+    def allocate():
+        if next_port[0] is None:
+            return free_port()
+        port = next_port[0]
+        next_port[0] += 1
+        return port
+    return allocate
+
+# Start the single, non-replicated full-server.
+def start_full_server(keep=False, base_port=None):
+    cluster = Cluster("full", tempfile.mkdtemp(prefix="cloud-drive-"), keep)
+    allocate = port_allocator(base_port)
+    try:
+        fport, bport = allocate(), allocate()
+        launch(cluster, "full", "full", "Narnia",
+                [os.path.join(repo_dir, "full-server.py"), str(fport), str(bport)], fport, bport)
+    except Exception:
+        cluster.stop()
+        raise
+    cluster.url = "http://localhost:%d" % (cluster.servers[0].frontend_port)
+    return cluster
+
+# Start the stand-in metadata service, a central coordinator, and some number
+# of replicas.
+def start_cluster(num_replicas, keep=False, base_port=None):
+    cluster = Cluster("central", tempfile.mkdtemp(prefix="cloud-drive-"), keep)
+    allocate = port_allocator(base_port)
+    try:
+        central_fport, central_bport = allocate(), allocate()
+        launch(cluster, "central", "central", "us-east-1",
+                [os.path.join(repo_dir, "central.py"), "localhost", "us-east-1",
+                    str(central_fport), str(central_bport)],
+                central_fport, central_bport)
+
+        instances = {}
+        for i in range(num_replicas):
+            name = "replica%d" % (i + 1)
+            cloud_name, zone = fake_zones[i % len(fake_zones)]
+            instances[name] = { "cloud": cloud_name, "name": name, "ip": "127.0.0.1", "zone": zone }
+        cluster.stub = metadata_stub.start_stub(0, instances)
+        stub_url = "http://127.0.0.1:%d" % (cluster.stub.server_address[1])
+
+        for name, inst in instances.items():
+            fport, bport = allocate(), allocate()
+            region = cloud_region(inst["cloud"], inst["zone"])
+            launch(cluster, "replica", name, region,
+                    [os.path.join(repo_dir, "replica.py"), "localhost", region,
+                        str(fport), str(bport), "localhost", str(central_fport)],
+                    fport, bport,
+                    { "CLOUD_METADATA_URL": stub_url + "/" + name })
+    except Exception:
+        cluster.stop()
+        raise
+    cluster.url = "http://localhost:%d" % (central_fport)
+    return cluster
+
+# Return the region name for a zone in the given cloud.
+def cloud_region(cloud_name, zone):
+    if cloud_name == "aws":
+        return aws.region_for_zone(zone)
+    return gcp.region_for_zone(zone)
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Run a central coordinator plus replicas on this machine.")
+    p.add_argument("replicas", type=int, help="number of replicas")
+    p.add_argument("--base-port", type=int, default=None,
+            help="use consecutive ports starting here, instead of random free ones")
+    p.add_argument("--keep", action="store_true", help="keep the servers' scratch folders, for looking at their logs")
+    args = p.parse_args()
+
+    cluster = start_cluster(args.replicas, args.keep, args.base_port)
+    print("Scratch folder (with each server's log): %s" % (cluster.scratch))
+    for s in cluster.servers:
+        print("  %-8s %-10s %-24s http://localhost:%d/  (back-end port %d)" % (
+            s.role, s.name, "%s (%s)" % (s.region, cloud.region_cities.get(s.region, "?")),
+            s.frontend_port, s.backend_port))
+    print("Browse to %s/ and press Control-C to stop." % (cluster.url))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        print("Stopping...")
+    finally:
+        cluster.stop()
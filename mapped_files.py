@@ -0,0 +1,87 @@
+# Memory-mapped reads of big shared files, so that a big file is sent straight
+# from the kernel's page cache, instead of being read into a new bytes object
+# for every request. Intended usage:
+#   data = mapped_files.cache.read(path)     # bytes, or a memoryview for a big file
+#   ...send data, or a slice of it...
+#   mapped_files.cache.invalidate(path)      # after removing or replacing the file
+#
+# Files of at least min_size bytes are mapped with mmap, and read() returns a
+# memoryview of the whole mapping. Sending that, or a slice of it for a range
+# request, copies nothing in python: the socket reads the file's pages right out
+# of the page cache, so any number of requests for the same 2 GB file share one
+# copy of it in memory, instead of each holding its own. Smaller files are just
+# read, which is quicker for them.
+#
+# The most recently used max_mapped mappings are kept, keyed by path, so a
+# popular file is only mapped once. Each read() checks that the path still
+# refers to the same file, by inode number and size, and maps it again if not.
+#
+# A mapping is never closed explicitly. The cache only drops its reference,
+# when the file is evicted, replaced, or invalidated, and the mapping goes away
+# by itself once the last memoryview of it is released, after the last response
+# using it is sent. Removing or replacing a file that is still mapped is safe:
+# files in ./share/ are only ever replaced by renaming a new file over them, or
+# removed, never changed in place (see share_index.py), and on unix the old
+# file's data stays around for as long as something has it mapped. So an
+# invalidated file can still be finished off by requests that already started,
+# and its disk space is freed after that. What is NOT safe is truncating a
+# mapped file in place, which would make reading the missing pages crash the
+# server with SIGBUS, so never edit files in ./share/ by hand while it runs.
+
+import mmap       # for mmap.mmap()
+import os         # for os.stat(), os.open(), etc.
+import threading  # for threading.Lock()
+from collections import OrderedDict
+
+import metrics    # for prometheus-style metrics
+
+min_size = 1024 * 1024   # files at least this big are mapped
+max_mapped = 256         # how many mappings to keep
+
+lookups = metrics.Counter("mapped_file_lookups_total",
+        "Reads of big shared files, by whether the file was already mapped.", ["result"])
+
+# MappedFileCache keeps the most recently used mappings, see above.
+class MappedFileCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()   # path -> (inode, size, mmap)
+
+    # Return the contents of a file, as bytes for a small file, or as a
+    # memoryview of a shared mapping for a big one. Raises OSError if the file
+    # can't be read.
+    def read(self, path):
+        st = os.stat(path)
+        if st.st_size < min_size:
+            with open(path, "rb") as f:
+                return f.read()
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == st.st_ino and entry[1] == st.st_size:
+                self.entries.move_to_end(path)
+                lookups.inc(("hit",))
+                return memoryview(entry[2])
+        lookups.inc(("miss",))
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            st = os.fstat(fd)   # it could have been replaced since the stat() above
+            m = mmap.mmap(fd, st.st_size, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        if hasattr(m, "madvise"):
+            m.madvise(mmap.MADV_SEQUENTIAL)
+        with self.lock:
+            self.entries[path] = (st.st_ino, st.st_size, m)
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return memoryview(m)
+
+    # Forget the mapping for a path, if there is one, after the file is
+    # removed or replaced, so it doesn't keep the old file's space in use.
+    def invalidate(self, path):
+        with self.lock:
+            self.entries.pop(path, None)
+
+cache = MappedFileCache(max_mapped)
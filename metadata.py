@@ -0,0 +1,271 @@
+# Finding out where this server is running: its DNS name, public IP address,
+# availability zone, and region, using the cloud provider's metadata service.
+# Intended usage:
+#   import metadata
+#   me = metadata.get_identity()
+#   print(me.cloud, me.dns_name, me.ip, me.zone, me.region)
+#
+# Each cloud has its own metadata service, at a special address that only works
+# from inside that cloud:
+#   AWS: http://169.254.169.254/latest/meta-data/...
+#   GCP: http://metadata.google.internal/computeMetadata/v1/instance/...
+# There is a provider class for each. By default, get_identity() asks AWS and
+# GCP at the same time, each in its own thread with short timeouts, and uses the
+# first complete answer. It gives up after probe_timeout seconds, so a server
+# on the wrong cloud (or no cloud) doesn't hang at startup. This can be changed
+# with the CLOUD_METADATA environment variable, which can be "aws" or "gcp" to
+# skip the guessing.
+#
+# The answer is saved in a small cache file (metadata-cache.json in the current
+# folder, or wherever CLOUD_METADATA_CACHE says; set it to "" for no cache) and
+# reused for cache_ttl seconds, so restarting a server doesn't need the metadata
+# service at all. The cache is ignored if CLOUD_METADATA or CLOUD_METADATA_URL
+# have changed since it was saved, or if it was saved on a different host, or
+# before the machine last rebooted (which on a cloud can come with a new IP
+# address), so a cache file copied along with a server's folder, or baked into
+# a machine image, isn't trusted.
+#
+# Any of the answers can also be given directly with environment variables,
+# which take priority over both the cache and the metadata service:
+#   CLOUD_DNS_NAME, CLOUD_IP, CLOUD_ZONE, CLOUD_REGION
+# If CLOUD_IP and CLOUD_ZONE are both given, no metadata service is asked.
+#
+# When running on a laptop or CI box, neither service exists. Instead, the
+# CLOUD_METADATA_URL environment variable can point at a stand-in, like the one
+# in metadata_stub.py, which answers the same requests the real services do.
+# For example, with CLOUD_METADATA_URL=http://127.0.0.1:9100/replica1 the AWS
+# provider asks http://127.0.0.1:9100/replica1/latest/meta-data/public-ipv4 for
+# the public IP address. See local_cluster.py, which sets this up.
+
+import json       # for the cache file
+import os         # for os.environ
+import queue      # for collecting answers from the probing threads
+import socket     # for socket.gethostname()
+import threading  # for threading.Lock() and the probing threads
+import time       # for time.time() and time.monotonic()
+from dataclasses import dataclass
+
+# Requests to the metadata service normally take a millisecond or two. Outside
+# the cloud, the address usually doesn't answer at all, so don't wait long.
+metadata_timeout = (0.5, 1.0)  # (connect, read) seconds, for each request
+probe_timeout = 2.0            # seconds, for all the providers together
+
+default_cache_file = "metadata-cache.json"
+cache_ttl = 6 * 3600           # seconds
+
+# Identity describes the machine we are running on.
+@dataclass
+class Identity:
+    cloud: str      # "aws" or "gcp"
+    dns_name: str   # DNS name, or the instance name on GCP
+    ip: str         # public IP address
+    zone: str       # availability zone, like "us-east-1a" or "us-east1-b"
+    region: str     # region, like "us-east-1" or "us-east1"
+
+# AWSMetadata talks to the EC2 instance metadata service.
+class AWSMetadata:
+    name = "aws"
+    default_base_url = "http://169.254.169.254"
+
+    def __init__(self, base_url=None):
+        self.base_url = base_url or self.default_base_url
+
+    def fetch(self, path):
+        import requests
+        r = requests.get(self.base_url + "/latest/meta-data/" + path, timeout=metadata_timeout)
+        r.raise_for_status()
+        return r.text
+
+    def get_my_dns_hostname(self):
+        return self.fetch("public-hostname")
+
+    def get_my_external_ip(self):
+        return self.fetch("public-ipv4")
+
+    def get_my_zone(self):
+        return self.fetch("placement/availability-zone/")
+
+    def region_for_zone(self, zone):
+        import aws
+        return aws.region_for_zone(zone)
+
+# GCPMetadata talks to the GCE instance metadata service.
+class GCPMetadata:
+    name = "gcp"
+    default_base_url = "http://metadata.google.internal"
+
+    def __init__(self, base_url=None):
+        self.base_url = base_url or self.default_base_url
+
+    def fetch(self, path):
+        import requests
+        import gcp
+        r = requests.get(self.base_url + "/computeMetadata/v1/instance/" + path,
+                headers=gcp.metadata_flavor, timeout=metadata_timeout)
+        r.raise_for_status()
+        return r.text
+
+    def get_my_dns_hostname(self):
+        return self.fetch("name")
+
+    def get_my_external_ip(self):
+        return self.fetch("network-interfaces/0/access-configs/0/external-ip")
+
+    def get_my_zone(self):
+        return self.fetch("zone").split("/")[-1]
+
+    def region_for_zone(self, zone):
+        import gcp
+        return gcp.region_for_zone(zone)
+
+provider_classes = { "aws": AWSMetadata, "gcp": GCPMetadata }
+
+# Return the providers to try, in order, according to the environment.
+def candidate_providers():
+    base_url = os.environ.get("CLOUD_METADATA_URL")
+    choice = os.environ.get("CLOUD_METADATA", "").strip().lower()
+    if choice in provider_classes:
+        return [provider_classes[choice](base_url)]
+    elif choice not in ["", "auto"]:
+        raise ValueError("CLOUD_METADATA should be aws, gcp, or auto, not '%s'" % (choice))
+    return [AWSMetadata(base_url), GCPMetadata(base_url)]
+
+# Ask one provider for everything about this machine.
+def identity_from(provider):
+    zone = provider.get_my_zone()
+    return Identity(provider.name, provider.get_my_dns_hostname(), provider.get_my_external_ip(),
+            zone, provider.region_for_zone(zone))
+
+# Ask all the providers at once, each in its own thread, and return the first
+# complete answer. Raises an exception if none of them answer within
+# probe_timeout seconds. Threads that are still waiting when we return are
+# left to finish (or time out) on their own.
+def probe(providers):
+    answers = queue.Queue()
+    def ask(provider):
+        try:
+            answers.put((provider, identity_from(provider), None))
+        except Exception as err:
+            answers.put((provider, None, err))
+    for provider in providers:
+        t = threading.Thread(target=ask, args=(provider,), name="Probe-%s" % (provider.name))
+        t.daemon = True
+        t.start()
+    deadline = time.monotonic() + probe_timeout
+    errors = []
+    while len(errors) < len(providers):
+        try:
+            provider, ident, err = answers.get(timeout=max(0, deadline - time.monotonic()))
+        except queue.Empty:
+            errors.append("gave up after %.1f seconds" % (probe_timeout))
+            break
+        if ident is not None:
+            return ident
+        errors.append("%s: %s" % (provider.name, err))
+    raise RuntimeError("no cloud metadata service answered (%s)" % ("; ".join(errors)))
+
+# The cache is only good for the same CLOUD_METADATA and CLOUD_METADATA_URL, on
+# the same host, since it last booted.
+def cache_key():
+    return "%s|%s|%s|%s" % (os.environ.get("CLOUD_METADATA", ""), os.environ.get("CLOUD_METADATA_URL", ""),
+            socket.gethostname(), boot_id())
+
+# Return an id that changes every time the machine boots, or "" if there isn't
+# one, as on systems other than linux.
+def boot_id():
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+def cache_path():
+    return os.environ.get("CLOUD_METADATA_CACHE", default_cache_file)
+
+# Return the cached identity, or None if there isn't a fresh one.
+def load_cached_identity():
+    path = cache_path()
+    if not path:
+        return None
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+        if saved["key"] != cache_key() or time.time() - saved["saved"] > cache_ttl:
+            return None
+        return Identity(**saved["identity"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+# Save the identity in the cache file. Failing to save it is not a problem, the
+# next startup just has to ask the metadata service again.
+def save_cached_identity(ident):
+    path = cache_path()
+    if not path:
+        return
+    saved = { "key": cache_key(), "saved": time.time(), "identity": ident.__dict__ }
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        with open(tmp, "w") as f:
+            json.dump(saved, f)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+# Guess the cloud from the shape of a zone name: GCP zones are like
+# "us-east1-b", AWS zones are like "us-east-1a".
+def cloud_for_zone(zone):
+    return "gcp" if zone[-2:-1] == "-" else "aws"
+
+# Return the region for a zone, in the given cloud.
+def region_for_zone(cloud_name, zone):
+    return provider_classes[cloud_name]().region_for_zone(zone)
+
+# Apply CLOUD_DNS_NAME, CLOUD_IP, CLOUD_ZONE, and CLOUD_REGION on top of ident,
+# which can be None if CLOUD_IP and CLOUD_ZONE are both given.
+def apply_overrides(ident):
+    env = os.environ
+    if ident is None:
+        zone = env["CLOUD_ZONE"]
+        choice = env.get("CLOUD_METADATA", "").strip().lower()
+        cloud_name = choice if choice in provider_classes else cloud_for_zone(zone)
+        ident = Identity(cloud_name, env["CLOUD_IP"], env["CLOUD_IP"], zone, region_for_zone(cloud_name, zone))
+    if "CLOUD_ZONE" in env and env["CLOUD_ZONE"] != ident.zone:
+        ident = Identity(ident.cloud, ident.dns_name, ident.ip, env["CLOUD_ZONE"],
+                region_for_zone(ident.cloud, env["CLOUD_ZONE"]))
+    return Identity(ident.cloud,
+            env.get("CLOUD_DNS_NAME", ident.dns_name),
+            env.get("CLOUD_IP", ident.ip),
+            ident.zone,
+            env.get("CLOUD_REGION", ident.region))
+
+identity_lock = threading.Lock()
+my_identity = None   # filled in by get_identity(), then reused
+
+# Find out where we are running: from the environment, the cache file, or by
+# probing the metadata services. The answer doesn't change while we run, so it
+# is only looked up once. Raises an exception if no provider answers.
+def get_identity():
+    global my_identity
+    with identity_lock:
+        if my_identity is not None:
+            return my_identity
+        ident = None
+        if "CLOUD_IP" not in os.environ or "CLOUD_ZONE" not in os.environ:
+            ident = load_cached_identity()
+            if ident is None:
+                ident = probe(candidate_providers())
+                save_cached_identity(ident)
+        my_identity = apply_overrides(ident)
+        return my_identity
+
+def get_my_dns_hostname():
+    return get_identity().dns_name
+
+def get_my_external_ip():
+    return get_identity().ip
+
+def get_my_zone():
+    return get_identity().zone
+
+def get_my_region():
+    return get_identity().region
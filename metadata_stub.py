@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+
+# A stand-in for the AWS and GCP metadata services, for running the cloud file
+# storage service on a single machine. It answers the same requests that the
+# real services do (see metadata.py), for any number of pretend instances, each
+# under its own url prefix. Run it like this:
+#   ./metadata_stub.py 9100 instances.json
+# where instances.json looks like:
+#   { "replica1": { "cloud": "gcp", "name": "replica1", "ip": "127.0.0.1", "zone": "europe-west1-b" },
+#     "replica2": { "cloud": "aws", "name": "replica2.local", "ip": "127.0.0.1", "zone": "us-east-1a" } }
+# Then a server started with CLOUD_METADATA_URL=http://127.0.0.1:9100/replica1
+# believes it is a GCP instance in europe-west1.
+#
+# Like the real thing, an "aws" instance only answers AWS-style requests, and a
+# "gcp" instance only answers GCP-style requests (which must have the
+# "Metadata-Flavor: Google" header), so the code that figures out which cloud
+# it is running in gets exercised too.
+
+import http.server  # for a simple threaded HTTP server
+import json         # for the instances file
+import sys          # for sys.argv
+import threading    # for running the server in the background
+
+# AWS paths, under /<instance>/latest/meta-data/, and what to answer
+aws_paths = {
+    "public-ipv4": lambda inst: inst["ip"],
+    "public-hostname": lambda inst: inst["name"],
+    "placement/availability-zone/": lambda inst: inst["zone"],
+    "placement/availability-zone": lambda inst: inst["zone"],
+}
+
+# GCP paths, under /<instance>/computeMetadata/v1/instance/, and what to answer
+gcp_paths = {
+    "name": lambda inst: inst["name"],
+    "network-interfaces/0/access-configs/0/external-ip": lambda inst: inst["ip"],
+    "zone": lambda inst: "projects/000000000000/zones/" + inst["zone"],
+}
+
+class MetadataHandler(http.server.BaseHTTPRequestHandler):
+    instances = {}   # instance name -> { "cloud", "name", "ip", "zone" }
+
+    def do_GET(self):
+        answer = self.lookup()
+        if answer is None:
+            self.send_error(404)
+            return
+        body = answer.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Return the answer for this request, or None if there isn't one.
+    def lookup(self):
+        parts = self.path.split("?", 1)[0].lstrip("/").split("/", 1)
+        if len(parts) != 2 or parts[0] not in self.instances:
+            return None
+        inst = self.instances[parts[0]]
+        rest = parts[1]
+        if inst["cloud"] == "aws" and rest.startswith("latest/meta-data/"):
+            fn = aws_paths.get(rest[len("latest/meta-data/"):])
+        elif inst["cloud"] == "gcp" and rest.startswith("computeMetadata/v1/instance/"):
+            if self.headers.get("Metadata-Flavor") != "Google":
+                return None
+            fn = gcp_paths.get(rest[len("computeMetadata/v1/instance/"):])
+        else:
+            fn = None
+        if fn is None:
+            return None
+        return fn(inst)
+
+    def log_message(self, format, *args):
+        pass  # be quiet
+
+# Start the stub on the given port, in a background thread, serving the given
+# instances. Returns the server; call server.shutdown() to stop it.
+def start_stub(port, instances, host="127.0.0.1"):
+    handler = type("Handler", (MetadataHandler,), { "instances": instances })
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    t = threading.Thread(target=server.serve_forever, name="MetadataStub")
+    t.daemon = True
+    t.start()
+    return server
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("usage: python3 metadata_stub.py port instances.json")
+        sys.exit(1)
+    port = int(sys.argv[1])
+    with open(sys.argv[2]) as f:
+        instances = json.load(f)
+    server = start_stub(port, instances, "")
+    print("Metadata stub serving %d instances on port %d" % (len(instances), port))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,245 @@
+# Prometheus-style metrics for the cloud file storage servers.
+# Intended usage:
+#   import metrics
+#   downloads = metrics.Counter("downloads_total", "Shared files downloaded.", ["status"])
+#   downloads.inc(("200",))
+#   latency = metrics.Histogram("thing_seconds", "How long things take.")
+#   latency.observe(0.0123)
+#   text = metrics.render_metrics()  # the Prometheus text exposition format
+#
+# Recording a value has to be cheap enough to leave on all the time, so nothing
+# is shared between threads when recording. Instead, each thread gets its own
+# "shard", a plain dictionary holding that thread's counts, and only the thread
+# itself ever writes to it. When someone asks for the metrics, all the shards
+# are added up. Shards of threads that have exited are folded into a single
+# "retired" shard, so they don't pile up with one thread per connection. That
+# happens when the metrics are collected, and also whenever the number of
+# shards has doubled since the last time, so it happens even if nobody ever
+# asks for the metrics.
+
+import threading  # for threading.local() and threading.Lock()
+import bisect     # for finding the histogram bucket for a value
+import time       # for time.perf_counter()
+
+# Default histogram buckets, in seconds, suitable for request latencies.
+default_latency_buckets = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+all_metrics = []        # every metric that has been created, in order
+collectors = []         # functions returning extra metrics, see register_collector()
+shard_local = threading.local()
+shards_lock = threading.Lock()
+live_shards = []        # (thread, shard) pairs, one per thread that has recorded anything
+retired_shard = {}      # combined values from shards of threads that have exited
+retire_at = 16          # retire shards again when there are this many
+
+# Get the current thread's shard, creating it the first time.
+def my_shard():
+    try:
+        return shard_local.shard
+    except AttributeError:
+        shard = {}
+        shard_local.shard = shard
+        global retire_at
+        with shards_lock:
+            live_shards.append((threading.current_thread(), shard))
+            if len(live_shards) >= retire_at:
+                retire_shards_locked()
+                retire_at = max(16, 2 * len(live_shards))
+        return shard
+
+# Fold the shards of threads that have exited into the retired shard. The
+# shards lock must be held.
+def retire_shards_locked():
+    live = []
+    for pair in live_shards:
+        if pair[0].is_alive():
+            live.append(pair)
+        else:
+            merge_shard(retired_shard, pair[1])
+    live_shards[:] = live
+
+# Add the values from one shard into another.
+def merge_shard(dest, src):
+    for key, val in list(src.items()):
+        if isinstance(val, list):
+            old = dest.get(key)
+            if old is None:
+                dest[key] = list(val)
+            else:
+                for i in range(len(val)):
+                    old[i] += val[i]
+        else:
+            dest[key] = dest.get(key, 0) + val
+
+# Add up all the shards, returning one combined dictionary, keyed by
+# (metric, label_values).
+def collect_shards():
+    with shards_lock:
+        retire_shards_locked()
+        total = {}
+        merge_shard(total, retired_shard)
+        for thread, shard in live_shards:
+            merge_shard(total, shard)
+    return total
+
+# Counter is a number that only goes up, like a count of requests. Each counter
+# can have labels, like "route" and "status", and the values for those labels
+# are passed as a tuple when incrementing.
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        all_metrics.append(self)
+
+    def inc(self, labels=(), amount=1):
+        shard = my_shard()
+        key = (self, labels)
+        shard[key] = shard.get(key, 0) + amount
+
+# Gauge is a number that can go up or down, like the number of open connections.
+# Like a counter, it is recorded with inc() and dec(). Alternatively, it can be
+# given a function that returns the current value, which is called whenever the
+# metrics are rendered.
+class Gauge(Counter):
+    kind = "gauge"
+
+    def __init__(self, name, help, labelnames=(), fn=None):
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+# Histogram counts observed values, like request latencies, in a fixed set of
+# buckets. It also keeps the total count and sum of all values.
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=default_latency_buckets):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = list(buckets)
+        all_metrics.append(self)
+
+    def observe(self, value, labels=()):
+        shard = my_shard()
+        key = (self, labels)
+        counts = shard.get(key)
+        if counts is None:
+            # one slot per bucket, one for +Inf, and the sum at the end
+            counts = [0] * (len(self.buckets) + 1) + [0.0]
+            shard[key] = counts
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+# Register a function to be called each time the metrics are rendered. It
+# should return a list of (name, kind, help, value), where kind is "counter" or
+# "gauge". This is useful for exporting values that are kept elsewhere.
+def register_collector(fn):
+    collectors.append(fn)
+
+# Format a set of labels like {route="view",status="200"}.
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ""
+    parts = []
+    for name, val in pairs:
+        val = str(val).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        parts.append('%s="%s"' % (name, val))
+    return "{" + ",".join(parts) + "}"
+
+# Format a number for the text exposition format.
+def format_value(v):
+    if isinstance(v, float):
+        if v == float("inf"):
+            return "+Inf"
+        return repr(v)
+    return str(v)
+
+# Render all metrics in the Prometheus text exposition format.
+def render_metrics():
+    values = collect_shards()
+    by_metric = {}
+    for (metric, labels), val in values.items():
+        by_metric.setdefault(metric, []).append((labels, val))
+    lines = []
+    for metric in all_metrics:
+        lines.append("# HELP %s %s" % (metric.name, metric.help))
+        lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+        series = sorted(by_metric.get(metric, []), key=lambda pair: pair[0])
+        if metric.kind == "histogram":
+            for labels, counts in series:
+                cumulative = 0
+                for i, bound in enumerate(metric.buckets + [float("inf")]):
+                    cumulative += counts[i]
+                    lbl = format_labels(metric.labelnames, labels, ("le", format_value(float(bound))))
+                    lines.append("%s_bucket%s %d" % (metric.name, lbl, cumulative))
+                lbl = format_labels(metric.labelnames, labels)
+                lines.append("%s_sum%s %s" % (metric.name, lbl, format_value(counts[-1])))
+                lines.append("%s_count%s %d" % (metric.name, lbl, cumulative))
+        elif getattr(metric, "fn", None) is not None:
+            lines.append("%s %s" % (metric.name, format_value(metric.fn())))
+        else:
+            if len(series) == 0 and len(metric.labelnames) == 0:
+                series = [((), 0)]
+            for labels, val in series:
+                lines.append("%s%s %s" % (metric.name, format_labels(metric.labelnames, labels), format_value(val)))
+    for fn in collectors:
+        for name, kind, help, val in fn():
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            lines.append("%s %s" % (name, format_value(val)))
+    return "\n".join(lines) + "\n"
+
+#### Metrics shared by all of the servers ####
+
+http_requests = Counter("http_requests_total",
+        "HTTP requests handled, by route and response status code.", ["route", "status"])
+http_request_seconds = Histogram("http_request_duration_seconds",
+        "Time to handle an HTTP request, from parsed headers to response sent, by route.", ["route"])
+replica_requests = Counter("replica_requests_total",
+        "Requests sent or redirected to replicas, by replica and route.", ["replica", "route"])
+replica_request_seconds = Histogram("replica_request_duration_seconds",
+        "Time for internal requests from central to a replica, by replica and route.", ["replica", "route"])
+
+# Given an HTTP request path, return a short name for its route, for labelling.
+# This keeps the number of distinct label values small, no matter how many
+# different files there are.
+def route_for_path(path, static_file_names=()):
+    if path.startswith("/view/"):
+        return "view"
+    elif path.startswith("/download/"):
+        return "download"
+    elif path.startswith("/upload"):
+        return "upload"
+    elif path.startswith("/delete"):
+        return "delete"
+    elif path in ["/shared-files.html", "/index.html", "/"]:
+        return "listing"
+    elif path.startswith("/filenames"):
+        return "filenames"
+    elif path.startswith("/register") or path.startswith("/ping"):
+        return "internal"
+    elif path == "/dashboard.html":
+        return "dashboard"
+    elif path == "/metrics":
+        return "metrics"
+    elif path[1:] in static_file_names:
+        return "static"
+    else:
+        return "other"
+
+# Record one handled HTTP request. The start time should come from
+# time.perf_counter(), taken after the request was received.
+def record_request(path, status, start, static_file_names=()):
+    route = route_for_path(path, static_file_names)
+    http_requests.inc((route, status))
+    http_request_seconds.observe(time.perf_counter() - start, (route,))
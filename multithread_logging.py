@@ -2,36 +2,218 @@
 # Date: 15 October 2022
 
 import threading # for getting current thread name
+import queue     # for queue.SimpleQueue
+import sys       # for sys.stdout and sys._getframe
+import os        # for reading LOG_LEVEL from the environment
+import time      # for time.monotonic()
+import atexit    # for flushing the log when the program exits
 
-# log(msg) prints a message to standard output. Since multi-threading can jumble
-# up the order of output on the screen, we print out the current thread's name
-# on each line of output along with the message.
-# Example usage:
+# Messages are not printed by the thread that logs them. Instead, each message
+# is put on a queue, and a background writer thread takes them off the queue and
+# prints them, in order. This way, worker threads never wait on the console. The
+# message is also only formatted by the writer thread, so arguments are passed
+# separately, printf-style:
+#   log("Hello %s, you are customer number %d, have a nice day!", name, n)
+# The old style, with the formatting done up front, works too:
 #   log("Hello %s, you are customer number %d, have a nice day!" % (name, n))
-def log(msg):
+# But then the formatting happens even if the message ends up being filtered
+# out, so the first style is better for messages that are usually disabled.
+
+# Log levels. Messages below the current level are dropped before they are even
+# formatted, so a disabled logdebug() call costs almost nothing.
+DEBUG = 10
+INFO = 20
+WARN = 30
+ERROR = 40
+
+level_names = { "debug": DEBUG, "info": INFO, "warn": WARN, "warning": WARN, "error": ERROR }
+
+log_level = INFO    # messages below this level are dropped
+module_levels = {}  # per-module overrides, like { "http_helpers": WARN }
+
+# Set the log level, either for everything, or for just one module. The level
+# can be one of the constants above, or a name like "debug" or "warn".
+# Example usage:
+#   set_log_level("warn")                   # only warnings and errors
+#   set_log_level("debug", "http_helpers")  # but everything from http_helpers
+def set_log_level(level, module=None):
+    global log_level
+    if isinstance(level, str):
+        level = level_names[level.strip().lower()]
+    if module is None:
+        log_level = level
+    else:
+        module_levels[module] = level
+
+# Configure the log levels from a string like "info,http_helpers=debug,central=warn",
+# which is how the LOG_LEVEL environment variable is interpreted.
+def configure_log_levels(spec):
+    for part in spec.split(","):
+        part = part.strip()
+        if len(part) == 0:
+            continue
+        if "=" in part:
+            module, level = part.split("=", 1)
+            set_log_level(level, module.strip())
+        else:
+            set_log_level(part)
+
+# Check whether a message at the given level should be logged. When there are
+# per-module overrides, we look at the module of whoever called the log function.
+def is_enabled(level, depth=2):
+    if len(module_levels) > 0:
+        module = sys._getframe(depth).f_globals.get("__name__")
+        if module in module_levels:
+            return level >= module_levels[module]
+    return level >= log_level
+
+log_queue = queue.SimpleQueue()
+
+# Put a message on the queue for the writer thread. The thread name is grabbed
+# now, since by the time the message is printed we will be in a different thread.
+def enqueue(level, msg, args):
+    log_queue.put((threading.current_thread().name, level, msg, args))
+
+ANSI_BLACK_BG = '\033[40m'
+ANSI_RED = '\033[31m'
+ANSI_ORANGE = '\033[33m'
+ANSI_GRAY = '\033[90m'
+ANSI_RESET = '\033[0m'
+
+level_colors = { DEBUG: ANSI_GRAY, WARN: ANSI_ORANGE + ANSI_BLACK_BG, ERROR: ANSI_RED + ANSI_BLACK_BG }
+
+# Turn one queued message into the text to print. Since multi-threading can
+# jumble up the order of output on the screen, we print out the thread's name
+# on each line of output along with the message.
+def format_record(record):
+    myname, level, msg, args = record
     # Convert msg to a string, if it is not already
-    if not isinstance(msg, str):
+    if isinstance(msg, bytes):
+        msg = msg.decode(errors="replace")
+    elif not isinstance(msg, str):
         msg = str(msg)
-    # Each python thread has a name. Use current thread's in the output message.
-    myname = threading.current_thread().name
+    if args:
+        try:
+            msg = msg % args
+        except (TypeError, ValueError):
+            msg = msg + " " + " ".join(str(a) for a in args)
+    if level in level_colors:
+        msg = level_colors[level] + msg + ANSI_RESET
     # When printing multiple lines, indent each line a bit
     indent = (" " * len(myname))
     linebreak = "\n" + indent + ": "
     lines = msg.splitlines()
     msg = linebreak.join(lines)
-    # Print it all out, prefixed by this thread's name.
-    print(myname + ": " + msg)
+    # Print it all out, prefixed by the thread's name.
+    return myname + ": " + msg + "\n"
 
-ANSI_BLACK_BG = '\033[40m'
-ANSI_RED = '\033[31m'
-ANSI_ORANGE = '\033[33m'
-ANSI_RESET = '\033[0m'
+# The writer thread takes messages off the queue and prints them. It grabs
+# whatever else is waiting on the queue too, so a burst of messages becomes a
+# single write to the console.
+def writer_loop():
+    while True:
+        record = log_queue.get()
+        batch = []
+        done = []
+        while True:
+            if record[1] is None:
+                # a flush marker, from flush_logs()
+                done.append(record[2])
+            else:
+                try:
+                    batch.append(format_record(record))
+                except Exception as err:
+                    batch.append("%s: [unprintable log message: %s]\n" % (record[0], err))
+            if len(batch) >= 1000:
+                break
+            try:
+                record = log_queue.get_nowait()
+            except queue.Empty:
+                break
+        if len(batch) > 0:
+            try:
+                sys.stdout.write("".join(batch))
+                sys.stdout.flush()
+            except Exception:
+                pass
+        for event in done:
+            event.set()
+
+writer_thread = threading.Thread(target=writer_loop, name="LogWriter")
+writer_thread.daemon = True
+writer_thread.start()
+
+# Wait until everything logged so far has been printed.
+def flush_logs(timeout=5.0):
+    if not writer_thread.is_alive():
+        return
+    event = threading.Event()
+    log_queue.put((None, None, event, None))
+    event.wait(timeout)
+
+atexit.register(flush_logs)
+
+# log(msg) prints a message to standard output. Since multi-threading can jumble
+# up the order of output on the screen, we print out the current thread's name
+# on each line of output along with the message.
+# Example usage:
+#   log("Hello %s, you are customer number %d, have a nice day!", name, n)
+def log(msg, *args):
+    if is_enabled(INFO):
+        enqueue(INFO, msg, args)
+
+# logdebug(msg) is the same as log(msg), but only printed when the log level is
+# set to debug. Use it for the noisy per-request details.
+def logdebug(msg, *args):
+    if is_enabled(DEBUG):
+        enqueue(DEBUG, msg, args)
 
 # logerr(msg) is the same as log(msg), but prints in red.
-def logerr(msg):
-    log(ANSI_RED + ANSI_BLACK_BG + msg + ANSI_RESET)
+def logerr(msg, *args):
+    if is_enabled(ERROR):
+        enqueue(ERROR, msg, args)
 
 # logwarn(msg) is the same as log(msg), but prints in yellow.
-def logwarn(msg):
-    log(ANSI_ORANGE + ANSI_BLACK_BG + msg + ANSI_RESET)
+def logwarn(msg, *args):
+    if is_enabled(WARN):
+        enqueue(WARN, msg, args)
+
+# Rate limits for log_sampled(), keyed by the caller's chosen key. Each value is
+# a list [window_start, count_in_window, suppressed_count]. These are updated
+# without a lock, so log_sampled() never makes one thread wait for another.
+# Threads racing on the same key can miscount by a few, letting a message or
+# two too many through, or reporting a few too few as suppressed, which is fine
+# for a rate limit.
+sample_windows = {}
+
+# How many messages per key log_sampled() lets through each second.
+max_sampled_per_second = 10
+
+# log_sampled(key, msg) is the same as log(msg), but rate-limited: at most
+# max_sampled_per_second messages with the same key are printed each second,
+# and the rest are just counted. The count is reported with the next message
+# that gets through. Use it for lines printed once per request or connection.
+# Example usage:
+#   log_sampled("new-conn", "New browser connection from %s:%d", host, port)
+def log_sampled(key, msg, *args):
+    if not is_enabled(INFO):
+        return
+    now = time.monotonic()
+    w = sample_windows.get(key)
+    if w is None:
+        w = sample_windows.setdefault(key, [now, 0, 0])
+    if now - w[0] >= 1.0:
+        w[0] = now
+        w[1] = 0
+    if w[1] >= max_sampled_per_second:
+        w[2] += 1
+        return
+    w[1] += 1
+    suppressed = w[2]
+    if suppressed > 0:
+        w[2] -= suppressed   # not = 0, to keep any counted since we looked
+        enqueue(INFO, "(%d similar messages suppressed)", (suppressed,))
+    enqueue(INFO, msg, args)
 
+if "LOG_LEVEL" in os.environ:
+    configure_log_levels(os.environ["LOG_LEVEL"])
@@ -0,0 +1,297 @@
+# A store for small shared files, which keeps many of them together in a few
+# big "pack" files, instead of giving each one its own file. Intended usage:
+#   packs = pack_store.open_store("./share.packs")
+#   packs.open()                                      # at startup
+#   packs.put("notes.txt", data, mtime_ns, digest)    # for files up to small_file_limit bytes
+#   data = packs.get("notes.txt")                     # or None if it isn't here
+#   packs.remove("notes.txt")
+#   packs.start_compaction()                          # reclaim space now and then
+#
+# Most shared files are small, and as separate files each one costs an inode,
+# a folder entry, and an open(), read() and close() to serve it. Here, each
+# small file is a record appended to the end of the newest pack file, like
+# ./share.packs/pack-000003, and an index in memory says where each one is:
+# name -> (pack, offset, length). Reading a file is then a lookup in the index
+# and a single os.pread() on a pack file that is already open. Packs are never
+# changed in place, only appended to: storing a file again appends a new record,
+# and removing one appends a tombstone record, a record with no data. So the
+# older record becomes dead space. A pack over max_pack_size is left alone and
+# a new one is started, and compaction rewrites the live records of any old
+# pack that is mostly dead space at the end of the newest pack, and then
+# removes it.
+#
+# Each record has a header:
+#   crc32 (4 bytes), data length (4), name length (2), kind (1), unused (1),
+#   modification time in nanoseconds (8), content digest (16)
+# all little-endian, followed by the name in utf-8 and then the data. The kind
+# is kind_put or kind_remove. The crc32 covers everything after itself, so a
+# record cut short by a crash is noticed, and dropped, at the next startup.
+#
+# The index is rebuilt at startup by reading the records in order, oldest pack
+# first, so later records win. Reading every pack would take a while for a big
+# store, so open() can be given the index as it was at some earlier time, from
+# state(), along with how long each pack was then. Only the records after that
+# are read. The share index saves this in its snapshot, see share_index.py.
+
+import os         # for os.pread(), os.pwrite(), etc.
+import struct     # for record headers
+import threading  # for threading.Lock() and the compaction thread
+import time       # for time.sleep()
+import zlib       # for zlib.crc32()
+
+import metrics                           # for prometheus-style metrics
+from multithread_logging import *        # for log() and logerr()
+
+small_file_limit = 64 * 1024       # files up to this many bytes go in packs
+max_pack_size = 64 * 1024 * 1024   # bytes, before starting a new pack
+compact_ratio = 0.5                # compact packs where at least this much is dead space
+compact_interval = 10.0            # seconds between looking for packs to compact
+
+record_header = struct.Struct("<IIHBxQ16s")
+kind_put = 1
+kind_remove = 2
+
+compactions = metrics.Counter("pack_store_compactions_total",
+        "Pack files rewritten to reclaim the space of removed or replaced small files.")
+reclaimed_bytes = metrics.Counter("pack_store_reclaimed_bytes_total",
+        "Bytes of pack files reclaimed by compaction.")
+
+# Pack holds what is known about one pack file.
+class Pack:
+    def __init__(self, num, path, fd, size):
+        self.num = num
+        self.path = path
+        self.fd = fd
+        self.size = size   # bytes of records in the file
+        self.dead = 0      # bytes of those which are old versions, removed files, or tombstones
+
+class PackStore:
+    def __init__(self, pack_dir):
+        self.pack_dir = pack_dir.rstrip("/")
+        self.lock = threading.Lock()
+        self.packs = {}    # number -> Pack
+        self.index = {}    # name -> [pack number, data offset, length, mtime_ns, digest hex]
+        # Packs removed by compaction stay open until the next compaction, so a
+        # get() that found a record just before can still read it.
+        self.retired = []
+
+    def pack_path(self, num):
+        return os.path.join(self.pack_dir, "pack-%06d" % (num))
+
+    # Read the packs and build the index, creating the folder if needed. The
+    # saved state, from state(), saves reading records that were already read.
+    # Returns a short description of what was done, for logging.
+    def open(self, saved=None):
+        os.makedirs(self.pack_dir, exist_ok=True)
+        nums = sorted(int(n[5:]) for n in os.listdir(self.pack_dir) if n.startswith("pack-") and n[5:].isdigit())
+        with self.lock:
+            for pack in self.packs.values():
+                os.close(pack.fd)
+            self.packs = {}
+            self.index = {}
+            starts = {}
+            if saved is not None and self.usable(saved, nums):
+                for num_text, (size, dead) in saved["packs"].items():
+                    if int(num_text) in nums:
+                        starts[int(num_text)] = (size, dead)
+                # records in packs removed since then were copied to later packs
+                self.index = { name: loc for name, loc in saved["index"].items() if loc[0] in starts }
+            read = 0
+            for num in nums:
+                path = self.pack_path(num)
+                pack = Pack(num, path, os.open(path, os.O_RDWR), 0)
+                self.packs[num] = pack
+                pack.size, pack.dead = starts.get(num, (0, 0))
+                read += self.scan(pack, num == nums[-1])
+            return "%d files in %d packs, read %d bytes of records" % (len(self.index), len(self.packs), read)
+
+    # Check that saved state matches the packs on disk, which it won't if a pack
+    # lost its end in a crash.
+    def usable(self, saved, nums):
+        try:
+            for num_text, (size, dead) in saved["packs"].items():
+                if int(num_text) in nums and os.path.getsize(self.pack_path(int(num_text))) < size:
+                    return False
+            return isinstance(saved["index"], dict)
+        except (OSError, KeyError, TypeError, ValueError):
+            return False
+
+    # Read the records in a pack from pack.size onwards, adding them to the
+    # index. A record that is cut short or corrupt ends the scan, and if this
+    # is the newest pack, which is the one appended to, it is cut off there.
+    # Returns how many bytes were read.
+    def scan(self, pack, newest):
+        start = pack.size
+        with open(pack.path, "rb") as f:
+            f.seek(start)
+            while True:
+                header = f.read(record_header.size)
+                if len(header) == 0:
+                    break
+                if len(header) == record_header.size:
+                    crc, length, name_len, kind, mtime_ns, digest = record_header.unpack(header)
+                    rest = f.read(name_len + length)
+                    if len(rest) == name_len + length and zlib.crc32(rest, zlib.crc32(header[4:])) == crc:
+                        name = rest[:name_len].decode("utf-8", "surrogateescape")
+                        self.apply(pack, name, kind, pack.size + record_header.size + name_len, length,
+                                mtime_ns, digest.hex())
+                        pack.size += record_header.size + name_len + length
+                        continue
+                if newest:
+                    logerr("Pack %s ends with a broken record at offset %d, cutting it off" % (pack.path, pack.size))
+                    os.ftruncate(pack.fd, pack.size)
+                else:
+                    logerr("Pack %s has a broken record at offset %d, ignoring the rest" % (pack.path, pack.size))
+                    pack.dead += os.path.getsize(pack.path) - pack.size
+                break
+        return pack.size - start
+
+    # Update the index for one record, which was just appended or read.
+    def apply(self, pack, name, kind, data_offset, length, mtime_ns, digest):
+        old = self.index.pop(name, None)
+        if old is not None:
+            self.packs[old[0]].dead += self.record_size(name, old[2])
+        if kind == kind_put:
+            self.index[name] = [pack.num, data_offset, length, mtime_ns, digest]
+        else:
+            pack.dead += self.record_size(name, 0)
+
+    def record_size(self, name, length):
+        return record_header.size + len(name.encode("utf-8", "surrogateescape")) + length
+
+    # Append one record to the newest pack, starting a new one if needed, and
+    # update the index. The lock must be held.
+    def append_locked(self, name, kind, data, mtime_ns, digest):
+        name_bytes = name.encode("utf-8", "surrogateescape")
+        header = record_header.pack(0, len(data), len(name_bytes), kind, mtime_ns, bytes.fromhex(digest))
+        crc = zlib.crc32(data, zlib.crc32(name_bytes, zlib.crc32(header[4:])))
+        record = struct.pack("<I", crc) + header[4:] + name_bytes + data
+        pack = self.packs[max(self.packs)] if len(self.packs) > 0 else None
+        if pack is None or (pack.size > 0 and pack.size + len(record) > max_pack_size):
+            num = 1 if pack is None else pack.num + 1
+            path = self.pack_path(num)
+            pack = Pack(num, path, os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644), 0)
+            self.packs[num] = pack
+        os.pwrite(pack.fd, record, pack.size)
+        self.apply(pack, name, kind, pack.size + record_header.size + len(name_bytes), len(data), mtime_ns, digest)
+        pack.size += len(record)
+
+    # Store a file, replacing any file in the store with the same name.
+    def put(self, name, data, mtime_ns, digest):
+        with self.lock:
+            self.append_locked(name, kind_put, data, mtime_ns, digest)
+
+    # Remove a file, returning False if there was no such file in the store.
+    def remove(self, name):
+        with self.lock:
+            if name not in self.index:
+                return False
+            self.append_locked(name, kind_remove, b"", 0, "00" * 16)
+            return True
+
+    # Return the contents of a file, or None if there is no such file here.
+    def get(self, name):
+        with self.lock:
+            loc = self.index.get(name)
+            if loc is None:
+                return None
+            fd = self.packs[loc[0]].fd
+        return os.pread(fd, loc[2], loc[1])
+
+    # Return an ETag-style identifier for a file, or None if there is no such
+    # file here. Every record is at a different place, so that is enough.
+    def etag(self, name):
+        with self.lock:
+            loc = self.index.get(name)
+        if loc is None:
+            return None
+        return '"p%x-%x-%x"' % (loc[0], loc[1], loc[2])
+
+    # Return {name: (size, mtime_ns, digest hex)} for every file here.
+    def entries(self):
+        with self.lock:
+            return { name: (loc[2], loc[3], loc[4]) for name, loc in self.index.items() }
+
+    # Return the index and the size of each pack, for open() to start from
+    # later, as something that can be saved as json.
+    def state(self):
+        with self.lock:
+            return { "packs": { str(num): [pack.size, pack.dead] for num, pack in self.packs.items() },
+                     "index": { name: list(loc) for name, loc in self.index.items() } }
+
+    # Compact every pack, other than the newest, that is at least compact_ratio
+    # dead space. Returns how many bytes were reclaimed.
+    def compact(self):
+        with self.lock:
+            retired, self.retired = self.retired, []
+            newest = max(self.packs) if len(self.packs) > 0 else None
+            todo = [num for num, pack in self.packs.items()
+                    if num != newest and pack.dead >= compact_ratio * pack.size]
+        for fd in retired:
+            os.close(fd)
+        reclaimed = 0
+        for num in sorted(todo):
+            reclaimed += self.compact_pack(num)
+        return reclaimed
+
+    # Copy the live records in one pack to the end of the newest one, and then
+    # remove it. Tombstones are copied too, unless there are no older packs for
+    # them to hide records in. A crash part way through leaves some records in
+    # both packs, which is harmless, since the copies come later.
+    def compact_pack(self, num):
+        pack = self.packs[num]
+        copied = 0
+        with open(pack.path, "rb") as f:
+            while True:
+                header = f.read(record_header.size)
+                if len(header) < record_header.size:
+                    break
+                crc, length, name_len, kind, mtime_ns, digest = record_header.unpack(header)
+                rest = f.read(name_len + length)
+                if len(rest) < name_len + length:
+                    break
+                name = rest[:name_len].decode("utf-8", "surrogateescape")
+                data_offset = f.tell() - length
+                with self.lock:
+                    loc = self.index.get(name)
+                    if kind == kind_put and loc is not None and loc[0] == num and loc[1] == data_offset:
+                        self.append_locked(name, kind_put, rest[name_len:], mtime_ns, digest.hex())
+                        copied += len(header) + len(rest)
+                    elif kind == kind_remove and loc is None and min(self.packs) < num:
+                        self.append_locked(name, kind_remove, b"", 0, "00" * 16)
+                        copied += len(header) + len(rest)
+        with self.lock:
+            del self.packs[num]
+            self.retired.append(pack.fd)
+            os.remove(pack.path)
+        compactions.inc()
+        reclaimed_bytes.inc((), pack.size - copied)
+        log("Compacted %s, kept %d of %d bytes" % (pack.path, copied, pack.size))
+        return pack.size - copied
+
+    # Compact now and then, in a background thread.
+    def start_compaction(self, interval=compact_interval):
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.compact()
+                except OSError as err:
+                    logerr("Pack compaction failed: %s" % (err))
+        t = threading.Thread(target=loop, name="PackCompaction")
+        t.daemon = True
+        t.start()
+
+opened = {}    # pack folder -> PackStore, see open_store()
+opened_lock = threading.Lock()
+
+# Return the PackStore for the given folder, the same one every time, so that
+# everything in a server that reads or writes the folder agrees on what is in it.
+def open_store(pack_dir):
+    pack_dir = pack_dir.rstrip("/")
+    with opened_lock:
+        store = opened.get(pack_dir)
+        if store is None:
+            store = PackStore(pack_dir)
+            opened[pack_dir] = store
+        return store
@@ -0,0 +1,195 @@
+# On-demand profiling for the cloud file storage servers, used from the back-end
+# diagnostic port, so a live server can be examined without restarting it.
+# Intended usage:
+#   import profiling
+#   text = profiling.handle_profiling_command("profile 10")
+#   if text is not None:
+#       sock.sendall(text.encode())
+#
+# There are three tools here:
+#  - A sampling profiler. Every few milliseconds, it grabs the current stack of
+#    every thread, and counts how many times each distinct stack was seen. The
+#    result is printed in the "collapsed stacks" format, one line per stack:
+#       outer_function (file.py);inner_function (file.py) 123
+#    which can be fed straight into flamegraph.pl or speedscope. Since it only
+#    looks at stacks from the outside, it costs nothing when not running and
+#    very little when running. It samples wall-clock time, so threads blocked
+#    in recv() or accept() show up as well as threads using the CPU.
+#  - A dump of the current stack of every thread, for finding stuck threads.
+#  - A tracemalloc report of the source lines that have allocated the most
+#    memory still in use.
+
+import sys          # for sys._current_frames()
+import os           # for os.path.basename()
+import threading    # for threading.enumerate() and threading.Thread()
+import time         # for time.sleep() and time.monotonic()
+import traceback    # for traceback.format_stack()
+import tracemalloc  # for memory allocation snapshots
+
+default_sample_interval = 0.005  # seconds between samples, i.e. 200 per second
+max_profile_seconds = 300        # longest a single "profile N" may run
+
+# Sampler records stacks of all threads, in a background thread, until stopped.
+class Sampler:
+    def __init__(self, interval=default_sample_interval):
+        self.interval = interval
+        self.counts = {}        # collapsed stack string -> number of samples
+        self.num_samples = 0
+        self.started = None
+        self.elapsed = None
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="Profiler")
+        self.thread.daemon = True
+
+    def start(self):
+        self.started = time.monotonic()
+        self.thread.start()
+
+    def run(self):
+        me = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            self.num_samples += 1
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                key = collapse_stack(frame)
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        self.elapsed = time.monotonic() - self.started
+
+    # Return the collapsed stacks, most common first, as text.
+    def report(self):
+        lines = ["# %d samples of all threads over %.1f seconds, in collapsed-stack format" % (self.num_samples, self.elapsed)]
+        for key, n in sorted(self.counts.items(), key=lambda pair: pair[1], reverse=True):
+            lines.append("%s %d" % (key, n))
+        return "\n".join(lines) + "\n"
+
+# Given a stack frame, return the whole stack, outermost first, as a string like
+# "run (threading.py);handle_http_connection (central.py);recv (smartsocket.py)".
+def collapse_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("%s (%s)" % (code.co_name, os.path.basename(code.co_filename)))
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+# Only one sampler can run at a time.
+profiler_lock = threading.Lock()
+active_sampler = None
+
+# Start the sampling profiler. Returns False if it was already running.
+def start_profiler():
+    global active_sampler
+    with profiler_lock:
+        if active_sampler is not None:
+            return False
+        active_sampler = Sampler()
+        active_sampler.start()
+    return True
+
+# Stop the sampling profiler and return its report, or None if it wasn't running.
+def stop_profiler():
+    global active_sampler
+    with profiler_lock:
+        sampler = active_sampler
+        active_sampler = None
+    if sampler is None:
+        return None
+    sampler.stop()
+    return sampler.report()
+
+# Run the sampling profiler for some number of seconds and return its report,
+# or None if the profiler was already running.
+def profile_for(seconds):
+    if not start_profiler():
+        return None
+    time.sleep(min(seconds, max_profile_seconds))
+    return stop_profiler()
+
+# Return the current stack of every thread, as text.
+def dump_thread_stacks():
+    names = {}
+    for t in threading.enumerate():
+        names[t.ident] = t.name
+    frames = sys._current_frames()
+    lines = ["%d threads:" % (len(frames))]
+    for ident, frame in frames.items():
+        lines.append("")
+        lines.append("Thread %s (id %d):" % (names.get(ident, "?"), ident))
+        lines.append("".join(traceback.format_stack(frame)).rstrip())
+    return "\n".join(lines) + "\n"
+
+# Return the top n source lines by memory allocated and still in use. The first
+# time this is used, tracing allocations is turned on, which slows the server
+# down a little, so only allocations made after that point are counted.
+def top_allocations(n=20):
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        return "Started tracing memory allocations. Run this command again later to see the top allocation sites.\n"
+    snapshot = tracemalloc.take_snapshot()
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ])
+    stats = snapshot.statistics("lineno")
+    current, peak = tracemalloc.get_traced_memory()
+    lines = ["%.1f KB traced now, %.1f KB at peak. Top %d allocation sites:" % (current / 1024, peak / 1024, min(n, len(stats)))]
+    for stat in stats[0:n]:
+        frame = stat.traceback[0]
+        lines.append("  %10.1f KB in %7d blocks  %s:%d" % (stat.size / 1024, stat.count, frame.filename, frame.lineno))
+    return "\n".join(lines) + "\n"
+
+# Turn off tracing memory allocations.
+def stop_allocations():
+    if not tracemalloc.is_tracing():
+        return "Memory allocations aren't being traced.\n"
+    tracemalloc.stop()
+    return "Stopped tracing memory allocations.\n"
+
+# Help text for the commands below, shown by the back-end diagnostic port.
+profiling_help = [
+    "  profile N     -- sample all thread stacks for N seconds, show collapsed stacks",
+    "  profile-start -- start sampling all thread stacks",
+    "  profile-stop  -- stop sampling and show collapsed stacks",
+    "  threads       -- show the current stack of every thread",
+    "  allocs [N]    -- show the top N memory allocation sites (starts tracing the first time)",
+    "  allocs-stop   -- stop tracing memory allocations",
+]
+
+# Handle one line typed on the back-end diagnostic port. If it is one of the
+# profiling commands, this returns the text to send back, otherwise None.
+def handle_profiling_command(line):
+    words = line.split()
+    if len(words) == 0:
+        return None
+    cmd = words[0]
+    if cmd == "profile":
+        if len(words) < 2 or not words[1].isdigit():
+            return "Usage: profile N, where N is a number of seconds.\n"
+        report = profile_for(int(words[1]))
+        if report is None:
+            return "The profiler is already running.\n"
+        return report
+    elif cmd == "profile-start":
+        if not start_profiler():
+            return "The profiler is already running.\n"
+        return "Profiler started, use profile-stop to see the results.\n"
+    elif cmd == "profile-stop":
+        report = stop_profiler()
+        if report is None:
+            return "The profiler isn't running.\n"
+        return report
+    elif cmd == "threads":
+        return dump_thread_stacks()
+    elif cmd == "allocs":
+        if len(words) > 1 and words[1].isdigit():
+            return top_allocations(int(words[1]))
+        return top_allocations()
+    elif cmd == "allocs-stop":
+        return stop_allocations()
+    return None
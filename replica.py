@@ -12,10 +12,14 @@ import threading                  # for threading.Thread()
 import sys                        # for exiting and command-line args
 from fileshare_helpers import *   # for csci356 filesharing helper code
 from multithread_logging import * # for csci356 logging helper code
-import requests
-import shutil
 import os
-import gcp
+import metadata
+import tracing
+import share_index                # for keeping track of the files in ./share/
+import inventory_wire             # for the binary /filenames format
+import change_feed                # for telling central about changes right away
+import anti_entropy               # for repairing differences from other replicas
+import rpc                        # for talking to other replicas over the back-end port
 
 # This data type represents a collection of information about some other
 # replica. You can add or remove variables as you see fit. Use it like this:
@@ -37,7 +41,8 @@ my_frontend_port = None   # port number for the browser-facing listening socket
 my_backend_port = None    # port number for peer-facing listening socket
 my_region = None          # geographic region where this replica is located
 
-global_condition = threading.Condition() # used to synchronize access to statistics variables
+# These two are set once at startup, before any other threads exist, so they
+# can be read without any locking.
 global_central_host = None
 global_central_backend_port = None
 
@@ -45,14 +50,28 @@ global_central_backend_port = None
 # crashed, in which case it is time to cleanup and exit the program.
 crash_updates = threading.Condition()
 
+# The files we store, kept from one run to the next, see share_index.py.
+share = share_index.ShareIndex("./share", "./share-index.json")
+
+# Sends changes to the share index to the central coordinator, if it wants them.
+feed = None
+
+# Finds and repairs differences between our files and other replicas' files.
+# Other replicas can always ask us about ours, but we only ask them about theirs
+# if the ANTI_ENTROPY_INTERVAL environment variable says how often to, in seconds.
+repairer = anti_entropy.Repairer(share, lambda: feed.peers() if feed is not None else [],
+        lambda: feed.notify() if feed is not None else None)
+
 # Given a file and some data, adds this file to our local shared directory and
 # our global variable lists. Also updates the statistics about how many files we
 # have. Returns a user-friendly status message indicating success or failure.
 def add_file(filename, data):
     status = ""
     try:
-        with open("./share/" + filename, "wb") as f:
-            f.write(data)
+        with tracing.phase("disk_io", filename):
+            share.store(filename, data)
+        if feed is not None:
+            feed.notify()
         status = "Success, added file '%s'." % (filename)
     except:
         status = "Problem storing data in local file named '%s'." % (filename)
@@ -61,44 +80,118 @@ def add_file(filename, data):
 def remove_file(filename):
     status = ""
     try:
-        os.remove("./share/" + filename)
+        with tracing.phase("disk_io", filename):
+            share.remove(filename)
+        if feed is not None:
+            feed.notify()
         status = "Success, removed file '%s'." % (filename)
     except:
         status = "Problem removing file '%s'." % (filename)
     return status
 
 def getCentralInfo():
-    global global_central_host, global_central_backend_port
-    central_host, central_backend_port = None, None
-    with global_condition:
-        central_host = global_central_host
-        central_backend_port = global_central_backend_port
-        global_condition.notify_all()
-    return central_host, central_backend_port
+    return global_central_host, global_central_backend_port
 
+# Pick up whatever files we had last time we ran. Nothing is thrown away, so a
+# restarted replica doesn't need to have everything uploaded to it again.
 def initShareFolder():
-    if os.path.exists("./share/"):
-        shutil.rmtree("./share")
-    os.mkdir("./share")
-    
+    log("Loaded ./share/: %s" % (share.load()))
+    share.start_snapshots()
+
+# Send the list of files we have and their sizes, like "a.txt,12&b.pdf,3400",
+# straight from the index, without touching the disk. If the request has a
+# "since" parameter, with a version from an earlier response, and the index
+# still remembers what changed since then, only the changes are sent, like
+# "+c.txt,56&-a.txt" (see share_index.format_changes), with an
+# X-Inventory-Delta header to say so. Either way, the X-Inventory-Version
+# header has the version to ask with next time.
+# If the request's Accept header asks for it, the binary format from
+# inventory_wire.py is streamed instead, with modification times and digests
+# too if the "fields" parameter asks for them, like "fields=mtime,digest".
+def send_filenames_and_sizes(conn, req):
+    since = req.params.get("since")
+    if inventory_wire.mime_type in req.headers.get("Accept", ""):
+        send_inventory(conn, since, inventory_wire.parse_fields(req.params.get("fields")))
+        return
+    changes = None
+    if since is not None and since.isdigit():
+        changes, version = share.changes_since(int(since))
+    if changes is not None:
+        resp = http.HTTPResponse("200 OK", "text/plain", share_index.format_changes(changes))
+        resp.add_header("X-Inventory-Delta", "yes")
+        resp.compress(conn.accept_encoding)
+    else:
+        content, version = share.listing_text()
+        resp = http.HTTPResponse("200 OK", "text/plain", content)
+        resp.compress(conn.accept_encoding, "filenames-%d" % (version))
+    resp.add_header("X-Inventory-Version", str(version))
+    http.send_response(conn, resp)
+
+def send_inventory(conn, since, fields):
+    records = None
+    if since is not None and since.isdigit():
+        records, version = share.changes_since(int(since), as_records=True)
+    delta = records is not None
+    if not delta:
+        records, version = share.records()
+    body = inventory_wire.encode_inventory(version, records, delta, fields)
+    resp = http.HTTPResponse("200 OK", inventory_wire.mime_type, body)
+    resp.add_header("X-Inventory-Version", str(version))
+    if delta:
+        resp.add_header("X-Inventory-Delta", "yes")
+    http.send_response(conn, resp)
+
+# Tell the central coordinator we are here, along with the list of files we
+# have and its digest, so the coordinator can catch up in one request instead of
+# asking us for the list afterwards. The list is sent in the binary format from
+# inventory_wire.py, which copes with any filename, and has the listing's
+# version in it. An older coordinator only reads the text format, so it finds
+# the digest doesn't match, and having no version either, asks for the whole
+# list with /filenames later. If the coordinator says where to open an rpc
+# connection, open one and start sending change notifications over it.
+def register_with_central(central_host, central_port, myip, frontend_port, backend_port):
+    global feed
+    import requests  # only needed here, so don't make every import of replica pay for it
+    records, version = share.records()
+    listing = [(name, size) for name, size, mtime_ns, digest in records]
+    url = "http://%s:%s/register?ip=%s&port=%s&count=%d&digest=%s" % (
+            central_host, central_port, myip, frontend_port, len(listing), share_index.inventory_digest(listing))
+    log("Registering with url...%s" % url)
+    r = requests.post(url, data=b"".join(inventory_wire.encode_inventory(version, records)),
+            headers={ "Content-Type": inventory_wire.mime_type })
+    r.raise_for_status()
+    log("Registration at Central Coordinator completed: %s" % (r.text))
+    if "X-RPC-Port" in r.headers:
+        feed = change_feed.Publisher(share, central_host, r.headers["X-RPC-Port"], myip, frontend_port, backend_port)
+        feed.start()
+
+# Handle an rpc connection from another replica, on the back-end port, asking
+# about our files for anti-entropy repair.
+def handle_peer_rpc(sock, peer_addr, first_line):
+    rpc.check_hello(first_line)
+    rpc.Connection(sock, repairer.handlers).run()
+
+backend_protocols["RPC"] = handle_peer_rpc
+
 # Handle one browser connection. This will receive an HTTP request, handle it,
 # and repeat this as long as the browser says to keep-alive. If there are any
 # errors, or if the browser says to close, the connection is closed.
 def handle_http_connection(conn):
     global global_central_host, global_central_backend_port
 
-    log("New browser connection from %s:%d" % (conn.client_addr))
+    log_sampled("new-conn", "New browser connection from %s:%d", conn.client_addr[0], conn.client_addr[1])
     try:
         conn.keep_alive = True
         while conn.keep_alive:
             # handle one HTTP request from browser
-            req = http.recv_one_request_from_client(conn.sock)
+            req = http.recv_next_request(conn)
             if req is None:
-                logerr("No request?! Something went terribly wrong, dropping connection.")
+                logdebug("No more requests, dropping connection.")
                 break
-            log(req)
-            conn.num_requests += 1
-            conn.keep_alive = req.keep_alive
+            log_sampled("request", "%s %s", req.method, req.urlpath)
+            logdebug(req)
+            start = time.perf_counter()
+            tracing.begin_trace(req, "replica")
         
             # GET /index.html or PING
             if req.method == "GET" and req.path.startswith("/ping"):
@@ -107,17 +200,17 @@ def handle_http_connection(conn):
             # POST /upload (expects filename(s) and file(s) as html multipart-encoded form parameters)
             elif req.method == "POST" and req.path.startswith("/upload"):
                 params = req.params
-                log("Got filtered file list from central %s" % params["filelist"])
+                logdebug("Got filtered file list from central %s", params["filelist"])
                 uploaded_files = req.form_content.get("files", None)
                 filtered_file_list = params["filelist"].split(",")
                 for upload in uploaded_files:
                     if upload.filename in filtered_file_list:
                         add_file(upload.filename, upload.data)
                 central_host, central_backend_port = getCentralInfo()
-                redirect_to_other_server(conn, "", central_host, central_backend_port, "/shared-files.html", True)
+                redirect_to_other_server(conn, "", central_host, central_backend_port, tracing.add_trace_param("/shared-files.html"), True)
 
             elif req.method == "GET" and req.path.startswith("/filenames"):
-                send_filenames_and_sizes(conn)
+                send_filenames_and_sizes(conn, req)
 
             # POST /delete (this version expects filename as an html form parameter)
             elif req.method == "POST" and req.path == "/delete":
@@ -127,14 +220,14 @@ def handle_http_connection(conn):
                 else:
                     status = remove_file(filename)
                 central_host, central_backend_port = getCentralInfo()
-                redirect_to_other_server(conn, "", central_host, central_backend_port, "/shared-files.html", True)
+                redirect_to_other_server(conn, "", central_host, central_backend_port, tracing.add_trace_param("/shared-files.html"), True)
             
             # POST /delete/whatever.pdf (this version expects filename as part of URL)
             elif req.method == "POST" and req.path.startswith("/delete/"):
                 filename = req.path[8:]
                 status = remove_file(filename)
                 central_host, central_backend_port = getCentralInfo()
-                redirect_to_other_server(conn, "", central_host, central_backend_port, "/shared-files.html", True)
+                redirect_to_other_server(conn, "", central_host, central_backend_port, tracing.add_trace_param("/shared-files.html"), True)
             
             # GET /view/somefile.pdf
             elif req.method == "GET" and req.path.startswith("/view/"):
@@ -143,12 +236,19 @@ def handle_http_connection(conn):
             # GET /download/somefile.pdf
             elif req.method == "GET" and req.path.startswith("/download/"):
                 send_share_file(conn, req.path[10:], True)
-                    
+
+            else:
+                send_404_not_found(conn)
+
+            metrics.record_request(req.path, conn.last_status, start)
+            tracing.end_trace(conn.last_status)
+
     except Exception as err:
         logerr("Front-end connection failed: %s" % (err))
         raise err
     finally:
-        log("Closing socket connection with %s:%d" % (conn.client_addr))
+        logdebug("Closing socket connection with %s:%d", conn.client_addr[0], conn.client_addr[1])
+        http.connection_reaper.forget(conn)
         conn.sock.close()
 
 # Given a socket listening on the browser-facing front-end port, wait for and
@@ -160,6 +260,7 @@ def accept_http_connections(listening_sock):
         while True:
             c, a = listening_sock.accept()
             conn = http.HTTPConnection(SmartSocket(c), a)
+            http.connection_reaper.watch(conn)
             t = threading.Thread(target=handle_http_connection, args=(conn,))
             t.daemon = True
             t.start()
@@ -186,13 +287,9 @@ def run_replica_server(name, region, frontend_port, backend_port, central_host,
     log("Replica backend port: %s" % (backend_port))
     log("Central coordinator is on host %s port %s" % (central_host, central_port))
 
-    myip = gcp.get_my_external_ip()
+    myip = metadata.get_my_external_ip()
     log("My ip:port %s" % str(myip) + ":" + str(frontend_port))
-    url = 'http://' + central_host + ":" + str(central_backend_port) + "/register?" + "ip=" + str(myip) + "&port=" + str(frontend_port)
-    log("Registering with url...%s" % url)
-    r = requests.get(url)
-    r.raise_for_status()
-    log("Registration at Central Coordinator completed")
+    register_with_central(central_host, central_port, myip, frontend_port, backend_port)
 
     global my_name, my_region, my_frontend_port, my_backend_port, global_central_host, global_central_backend_port
     my_name = name
@@ -200,14 +297,21 @@ def run_replica_server(name, region, frontend_port, backend_port, central_host,
     my_frontend_port = frontend_port
     my_backend_port = backend_port
     global_central_host = central_host
-    global_central_backend_port = central_backend_port
+    global_central_backend_port = central_port
 
     listening_addr = my_name
     if listening_addr == "localhost":
         listening_addr = "" # when IP isn't known, blank is better than "localhost"
 
+    s1 = None
     s2 = None
     try:
+        # First socket is our backend socket, for diagnostics and monitoring
+        s1 = start_backend_listener(listening_addr, backend_port, crash_updates)
+        interval = float(os.environ.get("ANTI_ENTROPY_INTERVAL") or 0)
+        if interval > 0:
+            repairer.start(interval)
+
         # Second socket is our frontend socket listening for browser connections
         s2 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s2.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -227,6 +331,8 @@ def run_replica_server(name, region, frontend_port, backend_port, central_host,
         raise err
     finally:
         log("Some thread crashed, cleaning up...")
+        if s1 is not None:
+            s1.close()
         if s2 is not None:
             s2.close()
         log("Finished!")
@@ -0,0 +1,241 @@
+# A small framed RPC protocol, for the control traffic between the central
+# coordinator and its replicas, like heartbeats, file listings, and placement
+# checks. Each replica keeps one connection open to the coordinator's back-end
+# port, and both ends make calls to each other over it, instead of opening a
+# new HTTP connection for every request. Intended usage, on either end:
+#   link = rpc.Connection(smart_sock, { "ping": handle_ping, ... })
+#   link.start()                                # or link.run() in this thread
+#   reply = link.call("inventory", b"...")      # wait for the other end's reply
+#   link.notify("changes", b"...")              # no reply expected
+# where a handler is called as fn(link, payload) and returns the reply payload,
+# as bytes (or a generator of bytes, for a long reply). Payloads are bytes, and
+# what goes in them is up to the caller. A handler that raises an exception
+# makes call() raise RPCError on the other end, with the exception's message.
+#
+# The connection starts with a line of text, "RPC <version>\n", sent by the end
+# that connected, so the back-end port can tell this apart from its other
+# protocols (see backend_protocols in helpers.py). After that, everything is a
+# frame, with a 10-byte header:
+#   payload length (4 bytes), request id (4 bytes), kind (1 byte), flags (1 byte)
+# all little-endian, then the payload. The kind is one of kind_call,
+# kind_notify, kind_reply, or kind_error. A reply has the same request id as the
+# call it answers, so several calls can be waiting at once, from any number of
+# threads, and replies can come back in any order. Notifications get request
+# ids too, but nothing is sent back. For a call or notification, the message
+# starts with the method name and a "\n". Messages bigger than max_frame are
+# split across several frames, all but the last with flag_more set, and frames
+# from different messages can be mixed together, so one big reply doesn't hold
+# up everything behind it. A frame bigger than max_frame, or more than
+# max_partial_messages or max_partial_bytes of split messages still being put
+# back together, is a protocol error, and the connection is closed.
+#
+# Calls are handled in a separate thread each, so a slow one doesn't hold up
+# the others. Notifications are handled one at a time, in the order they were
+# sent, by the thread reading from the connection.
+
+import itertools  # for numbering requests
+import socket     # for socket stuff
+import struct     # for frame headers
+import threading  # for the reader thread and waiting for replies
+
+from multithread_logging import *        # for log() and logerr()
+from smartsocket import *                # for SmartSocket class
+
+protocol_version = 1
+hello = b"RPC %d\n" % (protocol_version)
+
+frame_header = struct.Struct("<IIBB")
+kind_call = 1
+kind_notify = 2
+kind_reply = 3
+kind_error = 4
+flag_more = 0x01     # more frames follow for the same message
+
+max_frame = 256 * 1024   # bytes of payload per frame
+max_partial_messages = 64              # split messages being put back together at once, per connection
+max_partial_bytes = 64 * 1024 * 1024   # bytes held for them, per connection
+call_timeout = 10.0      # seconds to wait for a reply, by default
+
+# RPCError is raised by call() when the handler on the other end failed.
+class RPCError(Exception):
+    pass
+
+# Open a connection to the given (host, port) address, send the hello line, and
+# return a started Connection.
+def connect(addr, handlers, timeout=call_timeout):
+    s = socket.create_connection(addr, timeout)
+    s.settimeout(None)
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    s.sendall(hello)
+    link = Connection(SmartSocket(s), handlers)
+    link.start()
+    return link
+
+# Check the hello line sent by the end that connected.
+def check_hello(line):
+    words = line.split()
+    if len(words) != 2 or words[0] != "RPC" or words[1] != str(protocol_version):
+        raise ValueError("unsupported rpc hello: %r" % (line[:100]))
+
+class Connection:
+    def __init__(self, sock, handlers):
+        self.sock = sock
+        self.handlers = handlers
+        self.send_lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.pending = {}       # request id -> [threading.Event, kind, payload]
+        self.partial = {}       # (request id, kind) -> list of payload pieces so far
+        self.partial_bytes = 0  # total length of the pieces in self.partial
+        self.closed = False
+        self.peer = None        # for the owner to say who is on the other end
+
+    # Read from the connection in a background thread.
+    def start(self):
+        t = threading.Thread(target=self.run, name="RPC")
+        t.daemon = True
+        t.start()
+
+    # Read frames and handle them until the connection closes or fails.
+    def run(self):
+        try:
+            while True:
+                header = self.sock.recv_exactly(frame_header.size)
+                if header is None:
+                    break
+                length, req_id, kind, flags = frame_header.unpack(header)
+                if length > max_frame:
+                    raise ValueError("rpc frame of %d bytes is bigger than the limit of %d" % (length, max_frame))
+                payload = self.sock.recv_exactly(length) if length > 0 else b""
+                if payload is None:
+                    break
+                if flags & flag_more:
+                    self.hold_partial(req_id, kind, payload)
+                    continue
+                pieces = self.partial.pop((req_id, kind), None)
+                if pieces is not None:
+                    self.partial_bytes -= sum(len(piece) for piece in pieces)
+                    pieces.append(payload)
+                    payload = b"".join(pieces)
+                self.received(req_id, kind, payload)
+        except (OSError, ValueError) as err:
+            if not self.closed:
+                logerr("RPC connection failed: %s" % (err))
+        finally:
+            self.close()
+
+    # Hold on to one frame of a split message until the rest of it arrives, as
+    # long as that stays within max_partial_messages and max_partial_bytes.
+    def hold_partial(self, req_id, kind, payload):
+        pieces = self.partial.get((req_id, kind))
+        if pieces is None:
+            if len(self.partial) >= max_partial_messages:
+                raise ValueError("more than %d split rpc messages at once" % (max_partial_messages))
+            pieces = self.partial[(req_id, kind)] = []
+        if self.partial_bytes + len(payload) > max_partial_bytes:
+            raise ValueError("more than %d bytes of split rpc messages at once" % (max_partial_bytes))
+        pieces.append(payload)
+        self.partial_bytes += len(payload)
+
+    def received(self, req_id, kind, payload):
+        if kind in (kind_reply, kind_error):
+            waiter = self.pending.pop(req_id, None)
+            if waiter is not None:   # else the caller gave up waiting
+                waiter[1] = kind
+                waiter[2] = payload
+                waiter[0].set()
+        elif kind == kind_call:
+            t = threading.Thread(target=self.handle, args=(req_id, payload), name="RPCCall")
+            t.daemon = True
+            t.start()
+        elif kind == kind_notify:
+            self.handle(req_id, payload, False)
+        else:
+            raise OSError("unknown rpc frame kind %d" % (kind))
+
+    # Call the handler for a call or notification, and send back its reply,
+    # or the error, for a call.
+    def handle(self, req_id, message, wants_reply=True):
+        method, _, payload = message.partition(b"\n")
+        method = method.decode(errors="replace")
+        try:
+            fn = self.handlers.get(method)
+            if fn is None:
+                raise RPCError("no such method '%s'" % (method))
+            reply = fn(self, payload)
+            if wants_reply:
+                self.send(req_id, kind_reply, b"" if reply is None else reply)
+        except Exception as err:
+            if not wants_reply:
+                logerr("RPC notification '%s' failed: %s" % (method, err))
+            elif not self.closed:
+                try:
+                    self.send(req_id, kind_error, str(err).encode())
+                except OSError:
+                    pass
+
+    # Send one message, as bytes or a generator of bytes, split into frames.
+    # The send lock is only held for one frame at a time.
+    def send(self, req_id, kind, message):
+        pieces = [message] if isinstance(message, (bytes, bytearray)) else message
+        held = bytearray()
+        for piece in pieces:
+            held += piece
+            start = 0
+            while len(held) - start > max_frame:
+                self.send_frame(req_id, kind, flag_more, bytes(held[start:start + max_frame]))
+                start += max_frame
+            del held[:start]
+        self.send_frame(req_id, kind, 0, held)
+
+    def send_frame(self, req_id, kind, flags, payload):
+        with self.send_lock:
+            self.sock.sendmsg_all([frame_header.pack(len(payload), req_id, kind, flags), payload])
+
+    # Call a method on the other end, and return its reply payload. Raises
+    # RPCError if the handler failed, socket.timeout if no reply came in time,
+    # or some other OSError if the connection failed.
+    def call(self, method, payload=b"", timeout=call_timeout):
+        req_id = self.next_id()
+        waiter = [threading.Event(), None, None]
+        self.pending[req_id] = waiter
+        try:
+            if self.closed:
+                raise ConnectionError("rpc connection is closed")
+            self.send(req_id, kind_call, self.message(method, payload))
+            if not waiter[0].wait(timeout):
+                raise socket.timeout("no reply to rpc call '%s' after %.1f seconds" % (method, timeout))
+        finally:
+            self.pending.pop(req_id, None)
+        if waiter[1] == kind_error:
+            raise RPCError(waiter[2].decode(errors="replace"))
+        if waiter[1] is None:
+            raise ConnectionError("rpc connection closed during call '%s'" % (method))
+        return waiter[2]
+
+    # Send a notification to the other end, with no reply.
+    def notify(self, method, payload=b""):
+        self.send(self.next_id(), kind_notify, self.message(method, payload))
+
+    # Put the method name in front of a payload, given as bytes or a generator.
+    def message(self, method, payload):
+        if isinstance(payload, (bytes, bytearray)):
+            return method.encode() + b"\n" + payload
+        return itertools.chain([method.encode() + b"\n"], payload)
+
+    # Return the next request id, from 1 up to 0xffffffff and then back to 1,
+    # so it always fits in a frame header and is never 0.
+    def next_id(self):
+        return (next(self.ids) - 1) % 0xffffffff + 1
+
+    # Close the connection. Calls still waiting for replies fail.
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        for waiter in list(self.pending.values()):
+            waiter[0].set()
@@ -0,0 +1,454 @@
+# An index of the files a replica stores in its ./share/ folder, which survives
+# restarts. Intended usage:
+#   import share_index
+#   index = share_index.ShareIndex("./share", "./share-index.json")
+#   index.load()                       # at startup
+#   index.start_snapshots()            # save the index every few seconds
+#   index.store("notes.txt", data)     # instead of writing ./share/notes.txt
+#   index.remove("notes.txt")          # instead of os.remove()
+#   index.listing()                    # [("notes.txt", 1234), ...], no disk access
+#   index.digest()                     # short hash of the whole listing
+#   index.changes_since(version)       # what changed since some earlier version
+#   index.entry("notes.txt")           # what is known about one name, see below
+#
+# The index is saved every few seconds as a snapshot file, and at startup only
+# the folders that changed since then are scanned (see load()), instead of
+# stat()'ing every file. Files in ./share/ are only ever
+# created, replaced, or removed, never changed in place (see store()), which is
+# what makes trusting the snapshot safe. Small files go in ./share.packs/
+# instead (see pack_store.py). Every change bumps the index's version, so
+# others can ask for just what changed since a version they have (see
+# changes_since()), and removed files leave tombstones (see remove()).
+
+import hashlib    # for the listing digest
+import json       # for the snapshot file
+import os         # for os.scandir(), os.replace(), etc.
+import threading  # for threading.Lock() and the snapshot thread
+import time       # for time.perf_counter() and time.time_ns()
+from collections import deque
+
+import blob_store   # for storing each distinct file contents once
+import mapped_files # for forgetting memory mappings of removed files
+import pack_store   # for storing small files together
+import share_layout # for where each file goes in the folder
+
+snapshot_interval = 5.0   # seconds between saving snapshots, if anything changed
+max_changes = 10000       # how many recent changes to remember for changes_since()
+tombstone_ttl = 7 * 24 * 3600  # seconds to remember removed files
+
+# Return a short hash of a listing of (name, size) pairs, in any order. The
+# central coordinator uses it to tell whether its copy of a replica's listing
+# is up to date without fetching the whole thing, so it is the same on both
+# ends as long as they agree on the (name, size) pairs.
+def inventory_digest(listing):
+    h = hashlib.sha256()
+    for name, size in sorted(listing):
+        h.update(("%s,%d\n" % (name, size)).encode())
+    return h.hexdigest()[:32]
+
+# Format a listing of (name, size) pairs the way /filenames sends it, like
+# "a.txt,12&b.pdf,3400", and parse it back again.
+def format_listing(listing):
+    return "&".join("%s,%d" % (name, size) for name, size in listing)
+
+def parse_listing(text):
+    listing = []
+    if text == "":
+        return listing
+    for item in text.split("&"):
+        name, size = item.rsplit(",", 1)
+        listing.append((name, int(size)))
+    return listing
+
+# Format a list of changes, as (name, size) pairs with size None for a removed
+# file, like "+a.txt,12&-b.pdf", and parse it back again.
+def format_changes(changes):
+    return "&".join("-" + name if size is None else "+%s,%d" % (name, size) for name, size in changes)
+
+def parse_changes(text):
+    changes = []
+    if text == "":
+        return changes
+    for item in text.split("&"):
+        if item[0] == "-":
+            changes.append((item[1:], None))
+        else:
+            name, size = item[1:].rsplit(",", 1)
+            changes.append((name, int(size)))
+    return changes
+
+class ShareIndex:
+    def __init__(self, share_dir="./share", snapshot_path="./share-index.json"):
+        self.share_dir = share_dir.rstrip("/")
+        self.tmp_dir = self.share_dir + ".tmp"
+        self.blobs = blob_store.BlobStore(self.share_dir + ".blobs", self.tmp_dir)
+        self.packs = pack_store.open_store(self.share_dir + ".packs")
+        self.snapshot_path = snapshot_path
+        self.layout = None   # see share_layout.py, set by load()
+        # The lock is held while changing the files in share_dir, not just the
+        # index, so a snapshot always matches the folders' modification times.
+        self.lock = threading.Lock()
+        self.dir_mtimes = {} # folder -> modification time, as of the last change we made there
+        self.files = {}      # name -> [size, mtime_ns, inode or None if packed, digest hex or None,
+                             #          the file's own st_mtime_ns or None if packed]
+        self.removed = {}    # name -> when it was removed, in nanoseconds, for names not in files
+        self.version = 0     # goes up by one for every change
+        self.changes = deque(maxlen=max_changes)  # (version, name, size or None)
+        self.saved_version = None
+        self.cached_digest = (None, None)  # (version, digest)
+        self.cached_listing = (None, None) # (version, format_listing() text)
+
+    def path(self, name):
+        return self.layout.path(name)
+
+    # Return the contents of a file, or raise OSError if there is no such file.
+    def read(self, name):
+        data = self.packs.get(name)
+        if data is not None:
+            return data
+        with open(self.path(name), "rb") as f:
+            return f.read()
+
+    # Read the snapshot and scan the folder, creating it if needed. Returns a
+    # short description of what was done, for logging.
+    # The snapshot groups the files by the folder in ./share/ each is in (see
+    # share_layout.py), along with each folder's modification time. The files
+    # in folders that haven't changed since the snapshot was saved are taken
+    # from it as-is. The other folders are scanned, and a file with the same
+    # inode number, size, and modification time on disk as in the snapshot
+    # keeps what the snapshot says about it. Checking more than the inode
+    # number catches a file replaced by one that happens to get the removed
+    # file's inode number. A stale or missing snapshot only makes startup
+    # slower, never wrong. Digests are only known for files stored since the
+    # index was created, since working them out for files found by scanning
+    # would mean reading them all (see fill_digests()).
+    # The pack store's index is saved in the snapshot too, so it only has to
+    # read records added since then. If a crash left a name both in ./share/
+    # and in a pack, part way through replacing one with the other, the newer
+    # one is kept, as anti_entropy.py would pick between two copies. For a file
+    # found by scanning, that is the later of its modification time and its
+    # inode's change time, which is when it was renamed into place, since the
+    # contents may have been stored long before, for another name.
+    # The version jumps to the current time in microseconds, so versions keep
+    # going up across restarts, and a version from before a restart is always
+    # older than anything in the new log.
+    def load(self):
+        start = time.perf_counter()
+        self.layout = share_layout.open_layout(self.share_dir)
+        self.blobs.open()
+        snapshot = self.read_snapshot()
+        packed = self.packs.open(None if snapshot is None else snapshot.get("packs"))
+        with self.lock:
+            self.version = max(self.version + 1, time.time_ns() // 1000)
+            self.changes.clear()
+            old = {}   # folder -> [mtime_ns, { name -> info }]
+            if snapshot is not None:
+                old = snapshot["folders"]
+                cutoff = time.time_ns() - tombstone_ttl * 10**9
+                self.removed = { name: t for name, t in snapshot["removed"].items() if t > cutoff }
+            dirs = self.layout.dirs()
+            files = {}
+            changed = []
+            for folder, mtime in dirs:
+                if folder in old and old[folder][0] == mtime:
+                    files.update(old[folder][1])
+                else:
+                    changed.append(folder)
+            everything = None   # all the files in the snapshot, if needed
+            fresh = 0
+            placed = {}   # name -> when a file found by stat() was put in place
+            for folder in changed:
+                if folder in old:
+                    prev_files = old[folder][1]
+                else:
+                    # a new folder, which could hold files moved from other
+                    # folders, as by share_layout.migrate()
+                    if everything is None:
+                        everything = {}
+                        for mtime, group in old.values():
+                            everything.update(group)
+                    prev_files = everything
+                for entry in self.layout.files_in(folder):
+                    st = entry.stat(follow_symlinks=False)
+                    prev = prev_files.get(entry.name)
+                    if (prev is not None and prev[2] == st.st_ino and prev[0] == st.st_size
+                            and prev[4] in (st.st_mtime_ns, None)):
+                        prev[4] = st.st_mtime_ns
+                        files[entry.name] = prev
+                    else:
+                        files[entry.name] = [st.st_size, st.st_mtime_ns, st.st_ino, None, st.st_mtime_ns]
+                        placed[entry.name] = max(st.st_mtime_ns, st.st_ctime_ns)
+                        fresh += 1
+            unpacked = []   # names whose file in ./share/ is older than the packed one
+            for name, (size, mtime_ns, digest) in self.packs.entries().items():
+                info = files.get(name)
+                if info is not None and mtime_ns <= placed.get(name, info[1]):
+                    self.packs.remove(name)
+                else:
+                    if info is not None:
+                        self.blobs.remove(self.path(name), info[3])
+                        unpacked.append(name)
+                    files[name] = [size, mtime_ns, None, digest, None]
+            self.files = files
+            self.dir_mtimes = dict(dirs)
+            for name in unpacked:
+                self.touched(name)
+            if len(changed) == 0:
+                how = "snapshot is current, no scan needed"
+            else:
+                how = "scanned %d of %d %s folders, %d files were new or changed" % (
+                        len(changed), len(dirs), self.layout.name, fresh)
+            how += ", " + packed
+        return "%d files, %s (%.1f ms)" % (len(self.files), how, (time.perf_counter() - start) * 1000)
+
+    # Return the saved snapshot, or None if there isn't a usable one.
+    def read_snapshot(self):
+        try:
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+            if isinstance(snapshot.get("dir_mtime_ns"), int) and isinstance(snapshot.get("files"), dict):
+                # saved before there were layouts, when everything was in one folder
+                snapshot["folders"] = { "": [snapshot["dir_mtime_ns"], snapshot["files"]] }
+            if not isinstance(snapshot.get("folders"), dict):
+                return None
+            for mtime, group in snapshot["folders"].values():
+                for info in group.values():
+                    if len(info) == 3:
+                        info.append(None)  # saved before digests were recorded
+                    if len(info) == 4:
+                        info.append(None)  # saved before the files' own times were recorded
+            if not isinstance(snapshot.get("removed"), dict):
+                snapshot["removed"] = {}  # saved before tombstones were recorded
+            return snapshot
+        except (OSError, ValueError):
+            return None
+
+    # Save a snapshot, if anything changed since the last one.
+    def save_snapshot(self):
+        with self.lock:
+            if self.saved_version == self.version:
+                return
+            version = self.version
+            files = dict(self.files)
+            dir_mtimes = dict(self.dir_mtimes)
+            removed = dict(self.removed)
+            packs = self.packs.state()
+        folders = { folder: [mtime, {}] for folder, mtime in dir_mtimes.items() }
+        for name, info in files.items():
+            if info[2] is not None:   # else it's in packs
+                folders.setdefault(self.layout.dir_of(name), [None, {}])[1][name] = info
+        snapshot = { "folders": folders, "removed": removed, "packs": packs }
+        tmp = self.snapshot_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(snapshot, f, separators=(",", ":"))
+        os.replace(tmp, self.snapshot_path)
+        self.saved_version = version
+
+    # Save snapshots every snapshot_interval seconds, in a background thread,
+    # after cleaning up any blobs left with no names by a crash. Compact the
+    # packs now and then too.
+    def start_snapshots(self):
+        self.packs.start_compaction()
+        def loop():
+            try:
+                self.blobs.sweep()
+            except OSError:
+                pass
+            while True:
+                try:
+                    self.save_snapshot()
+                except OSError:
+                    pass  # try again next time
+                time.sleep(snapshot_interval)
+        t = threading.Thread(target=loop, name="ShareIndexSnapshots")
+        t.daemon = True
+        t.start()
+
+    # Store a file, replacing any existing file with the same name. The file's
+    # modification time can be given, for a copy of a file from elsewhere.
+    # Small files go in the packs, which don't deduplicate. Others go in the
+    # ./share.blobs/ content-addressed store first (see blob_store.py), so the
+    # same contents are only stored once, and then a link to the blob is
+    # renamed into place, so a crash never leaves a half-written file in
+    # ./share/. Files changed in place by hand, without going through the
+    # server, won't be noticed until the snapshot is removed. Since files with
+    # the same contents share an inode, and so a modification time, the index
+    # keeps its own modification time for each file, which is when it was
+    # stored, or the time given.
+    def store(self, name, data, mtime_ns=None):
+        if len(data) <= pack_store.small_file_limit:
+            self.store_packed(name, data, mtime_ns)
+            return
+        digest, staged = self.blobs.stage(data)
+        self.commit(name, digest, staged, mtime_ns)
+
+    # Store a small file in the packs. If it replaces a file in ./share/, that
+    # is removed afterwards.
+    def store_packed(self, name, data, mtime_ns):
+        digest = blob_store.content_digest(data)
+        with self.lock:
+            old = self.files.get(name)
+            mtime_ns = time.time_ns() if mtime_ns is None else mtime_ns
+            self.packs.put(name, data, mtime_ns, digest)
+            self.files[name] = [len(data), mtime_ns, None, digest, None]
+            self.removed.pop(name, None)
+            self.version += 1
+            self.changes.append((self.version, name, len(data)))
+            if old is not None and old[2] is not None:
+                self.blobs.remove(self.path(name), old[3])
+                mapped_files.cache.invalidate(self.path(name))
+                self.touched(name)
+
+    # Like store(), but only if there is already a file with the given digest,
+    # so no data needs to be written or even known. Returns False if not.
+    def store_copy(self, name, digest, mtime_ns=None):
+        staged = self.blobs.stage_existing(digest)
+        if staged is None:
+            return False
+        self.commit(name, digest, staged, mtime_ns)
+        return True
+
+    # Move a blob's staged name into place, see BlobStore.stage(). If it
+    # replaces a file in the packs, that is removed afterwards.
+    def commit(self, name, digest, staged, mtime_ns):
+        try:
+            with self.lock:
+                old = self.files.get(name)
+                path = self.layout.make_path(name)
+                os.replace(staged, path)
+                mapped_files.cache.invalidate(path)
+                self.touched(name)
+                st = os.stat(path)
+                self.files[name] = [st.st_size, time.time_ns() if mtime_ns is None else mtime_ns, st.st_ino, digest,
+                                    st.st_mtime_ns]
+                self.removed.pop(name, None)
+                self.version += 1
+                self.changes.append((self.version, name, st.st_size))
+                if old is not None and old[2] is None:
+                    self.packs.remove(name)
+                elif old is not None and old[3] is not None and old[3] != digest:
+                    self.blobs.release(old[3])
+        except:
+            if os.path.exists(staged):
+                os.remove(staged)
+            raise
+
+    # Remove a file, and leave a tombstone saying when. The time can be given,
+    # for a file removed elsewhere first, and if there is no such file, only
+    # the tombstone is left. Raises FileNotFoundError if there is no such file
+    # and no time is given. Tombstones are kept for tombstone_ttl seconds, so
+    # replicas comparing notes (see anti_entropy.py) can tell a file one of
+    # them removed from a file the other one is missing.
+    def remove(self, name, removed_ns=None):
+        with self.lock:
+            info = self.files.pop(name, None)
+            if info is not None or removed_ns is not None:
+                self.removed[name] = time.time_ns() if removed_ns is None else removed_ns
+                self.version += 1
+                self.changes.append((self.version, name, None))
+            if info is not None and info[2] is None:
+                self.packs.remove(name)
+            elif info is not None or removed_ns is None:
+                self.blobs.remove(self.path(name), None if info is None else info[3])
+                mapped_files.cache.invalidate(self.path(name))
+                self.touched(name)
+
+    # Note the new modification time of the folder holding a file we just
+    # changed, for the next snapshot.
+    def touched(self, name):
+        folder = self.layout.dir_of(name)
+        self.dir_mtimes[folder] = os.stat(os.path.join(self.share_dir, folder)).st_mtime_ns
+
+    # Return (size, mtime_ns, digest hex or None) for a file, (None, removed_ns,
+    # None) for a removed file with a tombstone, or None if the name is unknown.
+    def entry(self, name):
+        with self.lock:
+            return self.entry_locked(name)
+
+    def entry_locked(self, name):
+        info = self.files.get(name)
+        if info is not None:
+            return (info[0], info[1], info[3])
+        removed_ns = self.removed.get(name)
+        if removed_ns is not None:
+            return (None, removed_ns, None)
+        return None
+
+    # Return {name: entry(name)} for every file and tombstone, and the version.
+    def entries(self):
+        with self.lock:
+            names = list(self.files) + [name for name in self.removed if name not in self.files]
+            return { name: self.entry_locked(name) for name in names }, self.version
+
+    # Work out the digest of every file that doesn't have one yet, because it
+    # was found by scanning. This reads all those files, so it can take a while.
+    # Returns how many digests were worked out.
+    def fill_digests(self):
+        with self.lock:
+            todo = [(name, info[2]) for name, info in self.files.items() if info[3] is None]
+        for name, inode in todo:
+            try:
+                digest = blob_store.file_digest(self.path(name))
+            except OSError:
+                continue   # removed or replaced meanwhile
+            with self.lock:
+                info = self.files.get(name)
+                if info is not None and info[2] == inode:
+                    info[3] = digest
+                    self.saved_version = None   # so the next snapshot saves them
+        return len(todo)
+
+    # Return a list of (name, size) pairs for all the files, sorted by name.
+    def listing(self):
+        with self.lock:
+            return sorted((name, info[0]) for name, info in self.files.items())
+
+    # Return format_listing(listing()), and the version it is for. The text is
+    # kept until the next change, so asking again and again costs nothing.
+    def listing_text(self):
+        with self.lock:
+            version, text = self.cached_listing
+            if version != self.version:
+                version = self.version
+                text = format_listing(sorted((name, info[0]) for name, info in self.files.items()))
+                self.cached_listing = (version, text)
+        return text, version
+
+    # Return a list of (name, size, mtime_ns, digest) records for all the files,
+    # sorted by name, with the digest as bytes or None, and the current version.
+    def records(self):
+        with self.lock:
+            return [self.record(name, self.files[name]) for name in sorted(self.files)], self.version
+
+    def record(self, name, info):
+        if info is None:
+            return (name, None, None, None)
+        return (name, info[0], info[1], None if info[3] is None else bytes.fromhex(info[3]))
+
+    # Return the changes since the given version, as a list of (name, size)
+    # pairs with size None for a removed file, and the current version. Returns
+    # None instead of the list if the log doesn't go back that far (or the
+    # version is from the future), in which case the full listing is needed.
+    # With as_records=True, the changes are given as records, like records().
+    def changes_since(self, since, as_records=False):
+        with self.lock:
+            oldest = self.changes[0][0] - 1 if len(self.changes) > 0 else self.version
+            if since < oldest or since > self.version:
+                return None, self.version
+            latest = {}
+            for version, name, size in reversed(self.changes):
+                if version <= since:
+                    break
+                latest.setdefault(name, size)
+            if as_records:
+                return [self.record(name, self.files.get(name)) for name in sorted(latest)], self.version
+            return sorted(latest.items()), self.version
+
+    # Return the digest of listing(), see inventory_digest().
+    def digest(self):
+        version, digest = self.cached_digest
+        if version != self.version:
+            version = self.version
+            digest = inventory_digest(self.listing())
+            self.cached_digest = (version, digest)
+        return digest
@@ -0,0 +1,207 @@
+# Where each shared file lives inside the ./share/ folder. Intended usage:
+#   layout = share_layout.open_layout("./share")
+#   path = layout.path("notes.txt")        # to read a file
+#   path = layout.make_path("notes.txt")   # to create one, making folders as needed
+# and to move an existing ./share/ folder from one layout to another, with the
+# server stopped:
+#   python3 share_layout.py ./share sharded
+#
+# Shared files have a flat namespace, just names like "notes.txt", but keeping
+# them all in one folder gets slow at large numbers of files: listing it,
+# looking up a name in it, and scanning it at startup. So there is a choice of
+# layouts:
+#   flat     ./share/notes.txt, the way it always was
+#   sharded  ./share/3/f/notes.txt, with two levels of 16 folders picked by a
+#            hash of the name, so each folder holds 1/256th of the files
+# Folders in the sharded layout are only made once there is a file for them.
+# There are few enough folders that listing them all is quick, and a million
+# files is still only about 4000 per folder.
+#
+# Which layout a folder uses is saved in a file next to it, like ./share.layout.
+# A folder with no such file, which already has files in it, is taken to be
+# flat, since it was made before there was a choice. An empty or new folder
+# gets default_layout.
+#
+# Every layout can list its folders along with their modification times, and
+# the files in any one of them, so the share index can rescan only the folders
+# that changed since its last snapshot, see share_index.py.
+
+import hashlib    # for hashing names
+import os         # for os.scandir(), os.rename(), etc.
+import sys        # for command-line args
+import threading  # for threading.Lock()
+
+default_layout = "sharded"
+
+# FlatLayout keeps all the files in one folder.
+class FlatLayout:
+    name = "flat"
+
+    def __init__(self, root):
+        self.root = root.rstrip("/")
+
+    # Return the path of the folder holding the named file, relative to the
+    # root folder, or "" for the root folder itself.
+    def dir_of(self, name):
+        return ""
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    # Like path(), but first make the folder if it doesn't exist yet.
+    def make_path(self, name):
+        return self.path(name)
+
+    # Return a list of (folder, modification time in nanoseconds) pairs, for
+    # all the folders that hold files, with folders given like dir_of().
+    def dirs(self):
+        return [("", os.stat(self.root).st_mtime_ns)]
+
+    # Return a list of os.DirEntry objects for the files in one folder.
+    def files_in(self, folder):
+        with os.scandir(os.path.join(self.root, folder)) as it:
+            return [entry for entry in it if entry.is_file(follow_symlinks=False)]
+
+    # Return a list of os.DirEntry objects for all the files.
+    def files(self):
+        return [entry for folder, mtime in self.dirs() for entry in self.files_in(folder)]
+
+# ShardedLayout spreads the files over two levels of folders, 16 at each
+# level, picked by a hash of the name.
+class ShardedLayout(FlatLayout):
+    name = "sharded"
+
+    def __init__(self, root):
+        FlatLayout.__init__(self, root)
+        self.made = set()          # folders known to exist already
+        self.made_lock = threading.Lock()
+
+    def dir_of(self, name):
+        h = hashlib.blake2b(name.encode("utf-8", "surrogateescape"), digest_size=1).hexdigest()
+        return h[0] + "/" + h[1]
+
+    def path(self, name):
+        return os.path.join(self.root, self.dir_of(name), name)
+
+    def make_path(self, name):
+        folder = self.dir_of(name)
+        if folder not in self.made:
+            os.makedirs(os.path.join(self.root, folder), exist_ok=True)
+            with self.made_lock:
+                self.made.add(folder)
+        return os.path.join(self.root, folder, name)
+
+    def dirs(self):
+        found = []
+        with os.scandir(self.root) as top:
+            for outer in top:
+                if not is_shard(outer):
+                    continue
+                with os.scandir(outer.path) as it:
+                    for inner in it:
+                        if is_shard(inner):
+                            found.append((outer.name + "/" + inner.name, inner.stat(follow_symlinks=False).st_mtime_ns))
+        return found
+
+def is_shard_name(name):
+    return len(name) == 1 and name in "0123456789abcdef"
+
+def is_shard(entry):
+    return is_shard_name(entry.name) and entry.is_dir(follow_symlinks=False)
+
+layouts = { "flat": FlatLayout, "sharded": ShardedLayout }
+
+opened = {}    # root folder -> layout, see open_layout()
+opened_lock = threading.Lock()
+
+def marker_path(root):
+    return root.rstrip("/") + ".layout"
+
+# Return the layout used by the given folder, creating the folder if needed.
+# This is worked out once per folder, and the same object is returned after that.
+def open_layout(root):
+    root = root.rstrip("/")
+    with opened_lock:
+        layout = opened.get(root)
+        if layout is None:
+            layout = layouts[read_layout_name(root)](root)
+            opened[root] = layout
+        return layout
+
+def read_layout_name(root):
+    try:
+        with open(marker_path(root)) as f:
+            name = f.read().strip()
+        if name not in layouts:
+            raise ValueError("unknown layout '%s' in %s" % (name, marker_path(root)))
+        return name
+    except FileNotFoundError:
+        pass
+    os.makedirs(root, exist_ok=True)
+    with os.scandir(root) as it:
+        empty = next(it, None) is None
+    name = default_layout if empty else "flat"
+    write_layout_name(root, name)
+    return name
+
+def write_layout_name(root, name):
+    tmp = marker_path(root) + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(name + "\n")
+    os.replace(tmp, marker_path(root))
+
+# Move all the files in a folder from its current layout to another one, and
+# return how many were moved. Only do this while no server is using the folder.
+# If it is interrupted, running it again finishes the job.
+def migrate(root, to):
+    root = root.rstrip("/")
+    read_layout_name(root)   # so the folder has a layout, even if it doesn't have files yet
+    new = layouts[to](root)
+    sharded = ShardedLayout(root)
+    # after an interrupted run, there can be files in both layouts
+    entries = FlatLayout(root).files_in("") + [e for folder, mtime in sharded.dirs() for e in sharded.files_in(folder)]
+    # files named like shard folders could be in the way of those folders, so
+    # they go to a folder to one side until everything else is done
+    aside = root + ".migrating"
+    os.makedirs(aside, exist_ok=True)
+    was_at = {}   # name -> where a file moved to one side was before
+    for entry in entries:
+        if is_shard_name(entry.name):
+            os.rename(entry.path, os.path.join(aside, entry.name))
+            was_at[entry.name] = entry.path
+    moved = 0
+    for entry in entries:
+        if not is_shard_name(entry.name):
+            dest = new.make_path(entry.name)
+            if entry.path != dest:
+                os.rename(entry.path, dest)
+                moved += 1
+    if to == "flat":
+        for folder, mtime in sharded.dirs():
+            if len(os.listdir(os.path.join(root, folder))) == 0:
+                os.rmdir(os.path.join(root, folder))
+        with os.scandir(root) as it:
+            for entry in it:
+                if is_shard(entry) and len(os.listdir(entry.path)) == 0:
+                    os.rmdir(entry.path)
+    with os.scandir(aside) as it:
+        for entry in it:
+            dest = new.make_path(entry.name)
+            os.rename(entry.path, dest)
+            if was_at.get(entry.name) != dest:
+                moved += 1
+    os.rmdir(aside)
+    write_layout_name(root, to)
+    with opened_lock:
+        opened.pop(root, None)
+    return moved
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[2] not in layouts:
+        print("usage: python3 share_layout.py share_folder [%s]" % ("|".join(layouts)))
+        sys.exit(1)
+    root = sys.argv[1]
+    before = read_layout_name(root)
+    moved = migrate(root, sys.argv[2])
+    print("%s: moved %d files from the %s layout to the %s layout" % (root, moved, before, sys.argv[2]))
+    print("The share index snapshot is out of date now, so the next startup will rescan.")
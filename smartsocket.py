@@ -21,6 +21,15 @@ Example usage:
 """
 
 import socket    # for socket stuff
+import os        # for sysconf
+
+# Maximum number of buffers that can be passed to a single sendmsg call.
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
 
 """SmartSocket wrapper class."""
 class SmartSocket():
@@ -34,6 +43,10 @@ class SmartSocket():
     def close(self):
         self.s.close()
 
+    """Shut down one or both halves of the underlying socket, waking up any thread blocked in recv."""
+    def shutdown(self, how):
+        self.s.shutdown(how)
+
     """Get the peer name from the underlying socket."""
     def getpeername(self):
         return self.s.getpeername()
@@ -42,6 +55,53 @@ class SmartSocket():
     def sendall(self, msg):
         return self.s.sendall(msg)
 
+    """
+    Send a list of bytes-like buffers to the underlying socket, in order, as if they were concatenated. This uses
+    scatter-gather I/O (sendmsg) where available, so the buffers never need to be joined together into one big bytes
+    object. Like sendall, this keeps going until everything has been sent.
+    """
+    def sendmsg_all(self, buffers):
+        if not hasattr(self.s, "sendmsg"):
+            for b in buffers:
+                self.s.sendall(b)
+            return
+        bufs = [memoryview(b) for b in buffers if len(b) > 0]
+        while bufs:
+            n = self.s.sendmsg(bufs[0:IOV_MAX])
+            # drop whatever was fully sent, and trim whatever was partially sent
+            i = 0
+            while i < len(bufs) and n >= len(bufs[i]):
+                n -= len(bufs[i])
+                i += 1
+            del bufs[0:i]
+            if n > 0:
+                bufs[0] = bufs[0][n:]
+
+    """
+    Wait up to timeout seconds for the peer to send something, without consuming it. Whatever arrives is saved for
+    subsequent recv calls, and the buffered bytes are returned (possibly empty, if the peer sent nothing in time).
+    This is useful for guessing what protocol the peer is speaking before committing to one.
+    """
+    def peek(self, timeout):
+        if len(self.recvd) == 0:
+            old_timeout = self.s.gettimeout()
+            self.s.settimeout(timeout)
+            try:
+                self.recvd += self.s.recv(4096)
+            except socket.timeout:
+                pass
+            finally:
+                self.s.settimeout(old_timeout)
+        return self.recvd
+
+    """
+    Check whether a delimiter is already sitting in the receive buffer, meaning recv_until(delim) can return without
+    waiting on the network. For example, has_buffered("\r\n\r\n") checks whether the next http request (or at
+    least all of its headers) has already arrived.
+    """
+    def has_buffered(self, delim):
+        return delim in self.recvd
+
     """
     Receive exactly n bytes, no more, no less, from the underlying socket. Actually, this may read more than n, but any
     extra will be stripped off and saved for subsequent recv calls. This returns the n-byte bytes object, or None if there was
@@ -0,0 +1,109 @@
+# Contention-free statistics counters for the cloud file storage servers.
+# Intended usage:
+#   import stats
+#   server_stats = stats.StatsGroup(["connections_so_far", "connections_now"])
+#   server_stats.add("connections_so_far")           # add 1
+#   server_stats.update(connections_so_far=1, connections_now=1)  # add to several at once
+#   snap = server_stats.snapshot()                   # { "connections_so_far": 2, ... }
+#
+# Each thread gets its own "shard" of the counters, a list of numbers guarded by
+# a lock that only that thread and snapshot() ever use. So when a worker thread
+# bumps a counter, it never waits for any other worker thread. The shards are
+# only added up when someone asks for a snapshot. A snapshot holds every shard's
+# lock at once while adding them up, so the totals are exact and consistent
+# with each other: an update() that changes two counters is either entirely in
+# the snapshot or entirely not. Shards of threads that have exited are folded
+# into a single "retired" total, so they don't pile up with one thread per
+# connection. That happens in snapshot(), and also whenever the number of
+# shards has doubled since the last time, so it happens even if nobody ever
+# asks for a snapshot.
+
+import threading  # for threading.local() and threading.Lock()
+import metrics    # for exporting the counters on the /metrics page
+
+class StatsGroup:
+    def __init__(self, names):
+        self.names = list(names)
+        self.index = {}
+        for i, name in enumerate(self.names):
+            self.index[name] = i
+        self.local = threading.local()
+        self.shards_lock = threading.Lock()  # protects the list of shards
+        self.shards = []                     # (thread, lock, values) for each thread
+        self.retired = [0] * len(self.names) # totals from threads that have exited
+        self.retire_at = 16                  # retire shards again when there are this many
+
+    # Get the current thread's shard, creating it the first time.
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = (threading.current_thread(), threading.Lock(), [0] * len(self.names))
+            self.local.shard = shard
+            with self.shards_lock:
+                self.shards.append(shard)
+                if len(self.shards) >= self.retire_at:
+                    self.retire_locked()
+                    self.retire_at = max(16, 2 * len(self.shards))
+            return shard
+
+    # Fold the shards of threads that have exited into the retired totals. The
+    # shards lock must be held. A thread that has exited can't be changing its
+    # shard, and snapshot() can't be reading it, so its lock isn't needed.
+    def retire_locked(self):
+        live = []
+        for shard in self.shards:
+            thread, _, values = shard
+            if thread.is_alive():
+                live.append(shard)
+            else:
+                for i in range(len(values)):
+                    self.retired[i] += values[i]
+        self.shards = live
+
+    # Add an amount (default 1, can be negative) to one counter.
+    def add(self, name, amount=1):
+        _, lock, values = self.shard()
+        i = self.index[name]
+        with lock:
+            values[i] += amount
+
+    # Add amounts to several counters at once. Snapshots will see either all of
+    # these changes or none of them.
+    # Example: server_stats.update(local_files=1, uploads=1)
+    def update(self, **amounts):
+        _, lock, values = self.shard()
+        with lock:
+            for name, amount in amounts.items():
+                values[self.index[name]] += amount
+
+    # Return the current totals of all counters, as a dictionary.
+    def snapshot(self):
+        with self.shards_lock:
+            shards = list(self.shards)
+            for _, lock, _ in shards:
+                lock.acquire()
+            try:
+                totals = list(self.retired)
+                for _, _, values in shards:
+                    for i in range(len(values)):
+                        totals[i] += values[i]
+                self.retire_locked()
+            finally:
+                for _, lock, _ in shards:
+                    lock.release()
+        return dict(zip(self.names, totals))
+
+    # Return the current total of just one counter.
+    def get(self, name):
+        return self.snapshot()[name]
+
+    # Export these counters on the /metrics page, all taken from a single
+    # snapshot. The exports parameter maps each counter name to a triple of
+    # (metric name, "counter" or "gauge", help text); counters not listed there
+    # aren't exported. Use "counter" for ones that only go up, named *_total.
+    def export_metrics(self, exports):
+        def collect():
+            snap = self.snapshot()
+            return [(metric_name, kind, help, snap[name]) for name, (metric_name, kind, help) in exports.items()]
+        metrics.register_collector(collect)
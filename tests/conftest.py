@@ -0,0 +1,8 @@
+# The server modules are flat files at the top of the repo, so make them
+# importable from the tests. Run the tests from the top of the repo with:
+#   python3 -m pytest -q tests
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,78 @@
+# Tests for anti-entropy repair between replicas, see anti_entropy.py.
+
+import json
+import struct
+
+import pytest
+
+import anti_entropy
+import share_index
+
+def test_decide():
+    decide = anti_entropy.decide
+    old = (5, 100, "aa")
+    new = (6, 200, "bb")
+    assert decide(None, new) == "fetch"
+    assert decide(old, new) == "fetch"
+    assert decide(new, old) is None          # ours is newer
+    assert decide(old, (5, 300, "aa")) is None   # same contents, whatever the times
+    assert decide(old, None) is None
+    assert decide(None, (6, 200, None)) is None  # the peer's digest isn't known yet
+    assert decide(old, (None, 200, None)) == "remove"
+    assert decide(old, (None, 50, None)) is None     # removed before ours was stored
+    assert decide((None, 100, None), new) == "fetch"
+    assert decide((None, 300, None), new) is None
+    assert decide(None, (None, 200, None)) == "remove"   # just the tombstone
+    # a tie on time goes to the larger digest, the same on both ends
+    assert decide((5, 100, "aa"), (5, 100, "bb")) == "fetch"
+    assert decide((5, 100, "bb"), (5, 100, "aa")) is None
+
+def new_index(tmp_path, name):
+    share = share_index.ShareIndex(str(tmp_path / name / "share"), str(tmp_path / name / "share-index.json"))
+    share.load()
+    return share
+
+def root(share):
+    tree = anti_entropy.MerkleTree(share)
+    tree.refresh()
+    return tree.hashes(0, [0])[0]
+
+def test_refresh_from_changes_matches_a_full_rebuild(tmp_path):
+    share = new_index(tmp_path, "a")
+    for i in range(50):
+        share.store("file-%d.txt" % (i), b"contents %d" % (i), 1000 + i)
+    tree = anti_entropy.MerkleTree(share)
+    tree.refresh()
+    before = tree.hashes(0, [0])[0]
+    share.store("file-3.txt", b"changed", 2000)
+    share.remove("file-4.txt", 3000)
+    share.remove("never-here.txt", 4000)
+    tree.refresh()
+    after = tree.hashes(0, [0])[0]
+    assert after != before
+    assert after == root(share)
+    leaf = tree.leaf(anti_entropy.leaf_of("file-4.txt"))
+    assert leaf["file-4.txt"] == (None, 3000, None)
+
+def test_same_files_give_the_same_tree(tmp_path):
+    a = new_index(tmp_path, "a")
+    b = new_index(tmp_path, "b")
+    for share, order in [(a, range(20)), (b, reversed(range(20)))]:
+        for i in order:
+            share.store("file-%d.txt" % (i), b"contents %d" % (i), 1000 + i)
+    assert root(a) == root(b)
+    b.store("file-5.txt", b"different", 5000)
+    assert root(a) != root(b)
+
+def test_answers_only_for_real_tree_nodes(tmp_path):
+    share = new_index(tmp_path, "a")
+    share.store("a.txt", b"hello", 1000)
+    repairer = anti_entropy.Repairer(share, lambda: [], lambda: None)
+    repairer.answer_tree(None, bytes([0]) + struct.pack("<I", 0))
+    i = anti_entropy.leaf_of("a.txt")
+    assert json.loads(repairer.answer_leaves(None, json.dumps([i]).encode())) == [{ "a.txt": [5, 1000, share.entry("a.txt")[2]] }]
+    for leaves in [[-1], [anti_entropy.fanout ** anti_entropy.depth], [1.5], [True], ["0"], { "0": 0 }]:
+        with pytest.raises(ValueError, match="no such tree node"):
+            repairer.answer_leaves(None, json.dumps(leaves).encode())
+    with pytest.raises(ValueError, match="no such tree node"):
+        repairer.answer_tree(None, bytes([1]) + struct.pack("<I", anti_entropy.fanout))
@@ -0,0 +1,57 @@
+# Tests for the content-addressed blob store, see blob_store.py.
+
+import os
+
+import blob_store
+
+def new_store(tmp_path):
+    blobs = blob_store.BlobStore(str(tmp_path / "share.blobs"), str(tmp_path / "share.tmp"))
+    blobs.open()
+    os.makedirs(tmp_path / "share", exist_ok=True)
+    return blobs
+
+def test_same_contents_are_stored_once(tmp_path):
+    blobs = new_store(tmp_path)
+    a, b = str(tmp_path / "share" / "a.txt"), str(tmp_path / "share" / "b.txt")
+    digest = blobs.put(b"hello", a)
+    assert blobs.put(b"hello", b) == digest == blob_store.content_digest(b"hello")
+    assert os.stat(a).st_ino == os.stat(b).st_ino == os.stat(blobs.path(digest)).st_ino
+    assert os.stat(blobs.path(digest)).st_nlink == 3
+    assert blob_store.file_digest(a) == digest
+
+def test_blob_goes_with_its_last_name(tmp_path):
+    blobs = new_store(tmp_path)
+    a, b = str(tmp_path / "share" / "a.txt"), str(tmp_path / "share" / "b.txt")
+    digest = blobs.put(b"hello", a)
+    blobs.put(b"hello", b)
+    blobs.remove(a, digest)
+    assert os.path.exists(blobs.path(digest))
+    blobs.remove(b)   # the digest is worked out from the file
+    assert not os.path.exists(blobs.path(digest))
+
+def test_replacing_a_name_releases_the_old_blob(tmp_path):
+    blobs = new_store(tmp_path)
+    a = str(tmp_path / "share" / "a.txt")
+    old = blobs.put(b"old", a)
+    blobs.put(b"new", a)
+    blobs.release(old)
+    assert not os.path.exists(blobs.path(old))
+    with open(a, "rb") as f:
+        assert f.read() == b"new"
+
+def test_stage_existing_and_sweep(tmp_path):
+    blobs = new_store(tmp_path)
+    assert blobs.stage_existing(blob_store.content_digest(b"nothing")) is None
+    digest, staged = blobs.stage(b"orphan")
+    os.remove(staged)   # as if a crash happened before it was moved into place
+    kept = blobs.put(b"kept", str(tmp_path / "share" / "kept.txt"))
+    assert blobs.sweep() == 1
+    assert not os.path.exists(blobs.path(digest))
+    assert os.path.exists(blobs.path(kept))
+
+def test_open_clears_leftover_temporary_files(tmp_path):
+    blobs = new_store(tmp_path)
+    digest, staged = blobs.stage(b"left over")
+    blobs.open()
+    assert not os.path.exists(staged)
+    assert blobs.sweep() == 1
@@ -0,0 +1,58 @@
+# Tests for how the central coordinator takes in a replica's registration, see
+# registration_listing() and register_replica() in central.py.
+
+from types import SimpleNamespace
+
+import pytest
+
+import central
+import inventory_wire
+import share_index
+
+records = [("a&b.txt", 10, 1, b"x" * 16), ("c,d.txt", 20, 2, b"y" * 16), ("plain.txt", 0, 3, None)]
+listing = [(name, size) for name, size, mtime_ns, digest in records]
+
+@pytest.fixture(autouse=True)
+def empty_catalog(monkeypatch):
+    monkeypatch.setattr(central, "replicaset", frozenset())
+    monkeypatch.setattr(central, "inventories", {})
+
+def binary_request():
+    body = b"".join(inventory_wire.encode_inventory(7, records))
+    return SimpleNamespace(headers={ "Content-Type": inventory_wire.mime_type }, content=body, params={})
+
+def test_binary_listing_keeps_any_filename():
+    version, got = central.registration_listing(binary_request())
+    assert (version, got) == (7, listing)
+    status = central.register_replica("10.0.0.1", "8080", share_index.inventory_digest(listing), version, got)
+    assert status == "registered, with 3 files"
+    assert central.inventories[("10.0.0.1", "8080")] == (7, dict(listing))
+
+def test_text_listing_from_older_replicas():
+    req = SimpleNamespace(headers={ "Content-Type": "text/plain; charset=utf-8" },
+            plaintext_content="x.txt,5&y.txt,6", params={ "version": "3" })
+    assert central.registration_listing(req) == ("3", [("x.txt", 5), ("y.txt", 6)])
+
+def test_undecodable_or_mismatched_listing_is_ignored():
+    req = binary_request()
+    req.content = req.content[:-3]
+    version, got = central.registration_listing(req)
+    assert got is None
+    digest = share_index.inventory_digest(listing)
+    assert central.register_replica("10.0.0.1", "8080", digest, version, got) == "registered, with 0 files"
+    assert central.register_replica("10.0.0.2", "8080", digest, 7, listing[:1]) == "registered, with 0 files"
+    # no inventory, so the next gather asks for the whole listing
+    assert central.inventories == {}
+    assert central.replicaset == {("10.0.0.1", "8080"), ("10.0.0.2", "8080")}
+
+def test_update_inventory_applies_deltas_in_order():
+    replica = ("10.0.0.1", "8080")
+    central.update_inventory(replica, 10, [("a.txt", 1), ("b.txt", 2)], False)
+    central.update_inventory(replica, 12, share_index.parse_changes("+c.txt,3&-a.txt"), True)
+    assert central.inventories[replica] == (12, { "b.txt": 2, "c.txt": 3 })
+    # a delta that arrives late, after a newer one, is ignored
+    central.update_inventory(replica, 11, [("a.txt", 1)], True)
+    assert central.inventories[replica] == (12, { "b.txt": 2, "c.txt": 3 })
+    # a whole listing replaces everything
+    central.update_inventory(replica, 20, [("z.txt", 9)], False)
+    assert central.inventories[replica] == (20, { "z.txt": 9 })
@@ -0,0 +1,83 @@
+# Tests for change notifications from a replica to the central coordinator, see
+# change_feed.py and the rpc_handlers in central.py.
+
+import socket
+
+import pytest
+
+import central
+import change_feed
+import rpc
+import share_index
+from smartsocket import SmartSocket
+
+@pytest.fixture(autouse=True)
+def empty_catalog(monkeypatch):
+    monkeypatch.setattr(central, "replicaset", frozenset())
+    monkeypatch.setattr(central, "inventories", {})
+    monkeypatch.setattr(central, "replica_links", {})
+
+def connect(publisher):
+    sa, sb = socket.socketpair()
+    link = rpc.Connection(SmartSocket(sa), publisher.handlers)
+    coordinator = rpc.Connection(SmartSocket(sb), central.rpc_handlers)
+    link.start()
+    coordinator.start()
+    known = link.call("hello", b"10.0.0.1 8080 9090")
+    publisher.sent_version = int(known) if known else None
+    return link, coordinator
+
+# Send what changed, and wait for the coordinator to apply it. Notifications
+# are handled in order before any later call, so a ping's reply means it's done.
+def send_changes(publisher, link):
+    publisher.send_changes(link)
+    link.call("ping")
+
+def test_full_listing_then_deltas(tmp_path):
+    share = share_index.ShareIndex(str(tmp_path / "share"), str(tmp_path / "share-index.json"))
+    share.load()
+    share.store("a.txt", b"aaa")
+    share.store("b.txt", b"bb")
+    publisher = change_feed.Publisher(share, "127.0.0.1", 1, "10.0.0.1", "8080", "9090")
+    replica = ("10.0.0.1", "8080")
+    link, coordinator = connect(publisher)
+    try:
+        assert replica in central.replicaset and publisher.sent_version is None
+        send_changes(publisher, link)
+        assert central.inventories[replica] == (share.version, { "a.txt": 3, "b.txt": 2 })
+        share.store("c.txt", b"c")
+        share.remove("a.txt")
+        send_changes(publisher, link)
+        assert central.inventories[replica] == (share.version, { "b.txt": 2, "c.txt": 1 })
+        version = publisher.sent_version
+        sent = []
+        link.notify = lambda method, payload: sent.append(method)
+        send_changes(publisher, link)     # nothing changed, nothing sent
+        assert sent == [] and publisher.sent_version == version
+    finally:
+        link.close()
+        coordinator.close()
+    # after reconnecting, the replica carries on from what the coordinator has
+    share.store("d.txt", b"dddd")
+    link, coordinator = connect(publisher)
+    try:
+        assert publisher.sent_version == version
+        send_changes(publisher, link)
+        assert central.inventories[replica] == (share.version, { "b.txt": 2, "c.txt": 1, "d.txt": 4 })
+    finally:
+        link.close()
+        coordinator.close()
+
+def test_changes_before_hello_are_refused(tmp_path):
+    sa, sb = socket.socketpair()
+    link = rpc.Connection(SmartSocket(sa), {})
+    coordinator = rpc.Connection(SmartSocket(sb), central.rpc_handlers)
+    link.start()
+    coordinator.start()
+    try:
+        with pytest.raises(rpc.RPCError, match="before hello"):
+            link.call("changes", b"")
+        assert central.inventories == {}
+    finally:
+        link.close()
+        coordinator.close()
@@ -0,0 +1,218 @@
+# Tests for the HTTP helpers, see http_helpers.py.
+
+import gzip
+import socket
+import threading
+import zlib
+
+import pytest
+
+import http_helpers as http
+from smartsocket import SmartSocket
+
+class NoPeeking:
+    def peek(self, timeout):
+        raise AssertionError("peeked again")
+
+def test_looks_like_http_uses_what_was_already_peeked():
+    assert http.looks_like_http(NoPeeking(), first=b"GET /metrics HTTP/1.1\r\n")
+    assert not http.looks_like_http(NoPeeking(), first=b"")
+    assert not http.looks_like_http(NoPeeking(), first=b"metrics\n")
+
+def test_parse_range():
+    assert http.parse_range("bytes=0-499", 1000) == (0, 500)
+    assert http.parse_range("bytes=500-", 1000) == (500, 1000)
+    assert http.parse_range("bytes=-300", 1000) == (700, 1000)
+    assert http.parse_range("bytes=-3000", 1000) == (0, 1000)
+    assert http.parse_range("bytes=900-5000", 1000) == (900, 1000)
+    assert http.parse_range("Bytes = 1-1", 1000) == (1, 2)
+    assert http.parse_range("bytes=1000-", 1000) is False
+    assert http.parse_range("bytes=-0", 1000) is False
+    assert http.parse_range("bytes=-5", 0) is False
+    for header in ["bytes=0-1,5-6", "items=0-1", "bytes=5-1", "bytes=-", "bytes=x-y", "bytes=5"]:
+        assert http.parse_range(header, 1000) is None, header
+
+def test_apply_range():
+    body = bytes(range(100))
+    resp = http.HTTPResponse("200 OK", "application/octet-stream", body)
+    assert http.apply_range(resp, "bytes=10-19")
+    assert resp.code == "206 Partial Content"
+    assert bytes(resp.body) == body[10:20]
+    assert ("Content-Range", "bytes 10-19/100") in resp.headers
+    assert ("Accept-Ranges", "bytes") in resp.headers
+
+    resp = http.HTTPResponse("200 OK", "application/octet-stream", body)
+    assert http.apply_range(resp, "bytes=100-")
+    assert resp.code == "416 Range Not Satisfiable"
+    assert resp.body == b""
+    assert ("Content-Range", "bytes */100") in resp.headers
+
+    for range_header, if_range in [(None, None), ("bytes=0-1", '"etag"'), ("bytes=0-1,3-4", None)]:
+        resp = http.HTTPResponse("200 OK", "application/octet-stream", body)
+        assert not http.apply_range(resp, range_header, if_range)
+        assert resp.code == "200 OK" and resp.body == body
+
+def chunked_body(raw):
+    a, b = socket.socketpair()
+    a.sendall(raw)
+    a.close()
+    sock = SmartSocket(b)
+    try:
+        return list(http.recv_chunked_body(sock)), sock.recv_exactly(len(b"next"))
+    finally:
+        b.close()
+
+def test_recv_chunked_body():
+    raw = b"5;name=value\r\nhello\r\n1A\r\n" + b"x" * 26 + b"\r\n0\r\nTrailer: yes\r\n\r\nnext"
+    assert chunked_body(raw) == ([b"hello", b"x" * 26], b"next")
+    assert chunked_body(b"0\r\n\r\nnext") == ([], b"next")
+    for raw in [b"5\r\nhel", b"5\r\nhelloXX0\r\n\r\n", b"zz\r\n", b"-5\r\nhello\r\n0\r\n\r\n",
+                b"5\r\nhello\r\n0\r\nTrailer: cut"]:
+        with pytest.raises(ValueError):
+            chunked_body(raw)
+
+def serve(sock, n):
+    conn = http.HTTPConnection(SmartSocket(sock), ("127.0.0.1", 1234))
+    writes = []
+    sendmsg_all = conn.sock.sendmsg_all
+    def counting_sendmsg_all(bufs):
+        writes.append(b"".join(bufs))
+        sendmsg_all(bufs)
+    conn.sock.sendmsg_all = counting_sendmsg_all
+    for i in range(n):
+        req = http.recv_next_request(conn)
+        http.send_response(conn, http.HTTPResponse("200 OK", "text/plain", req.path + ":" + req.content.decode()))
+    return writes
+
+def test_pipelined_responses_go_out_together_in_order():
+    a, b = socket.socketpair()
+    a.sendall(b"GET /1 HTTP/1.1\r\n\r\nPOST /2 HTTP/1.1\r\nContent-Length: 2\r\n\r\nhiGET /3 HTTP/1.1\r\n\r\n")
+    try:
+        writes = serve(b, 3)
+    finally:
+        a.close()
+        b.close()
+    assert len(writes) == 1
+    bodies = [writes[0].find(body) for body in [b"/1:", b"/2:hi", b"/3:"]]
+    assert -1 not in bodies and bodies == sorted(bodies)
+
+def test_held_responses_are_sent_before_waiting_for_a_body():
+    a, b = socket.socketpair()
+    a.settimeout(5)
+    a.sendall(b"GET /1 HTTP/1.1\r\n\r\nPOST /2 HTTP/1.1\r\nContent-Length: 2\r\nExpect: 100-continue\r\n\r\n")
+    t = threading.Thread(target=serve, args=(b, 2))
+    t.start()
+    try:
+        reply = SmartSocket(a).recv_until(b"/1:")   # would time out if held back
+        assert reply.startswith(b"HTTP/1.1 200 OK")
+        a.sendall(b"hi")
+    finally:
+        t.join(5)
+        a.close()
+        b.close()
+
+def test_has_buffered_request():
+    a, b = socket.socketpair()
+    sock = SmartSocket(b)
+    try:
+        for raw, whole in [(b"GET / HTTP/1.1\r\nHost: x", False), (b"\r\n\r\n", True),
+                (b"POST / HTTP/1.1\r\ncontent-length: 3\r\n\r\nab", False), (b"c", True),
+                (b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n0\r\n\r\n", False)]:
+            a.sendall(raw)
+            sock.recvd += b.recv(4096)
+            assert http.has_buffered_request(sock) == whole, raw
+            if whole:
+                sock.recvd = b""
+    finally:
+        a.close()
+        b.close()
+
+def request(raw):
+    a, b = socket.socketpair()
+    a.sendall(raw)
+    try:
+        return http.recv_one_request_from_client(SmartSocket(b))
+    finally:
+        a.close()
+        b.close()
+
+def test_keep_alive_defaults():
+    for version, connection, keep_alive in [("HTTP/1.1", None, True), ("HTTP/1.1", "close", False),
+            ("HTTP/1.1", "Upgrade, Close", False), ("HTTP/1.0", None, False),
+            ("HTTP/1.0", "Keep-Alive", True), ("HTTP/1.0", "close", False)]:
+        header = "" if connection is None else "Connection: %s\r\n" % (connection)
+        req = request(("GET / %s\r\nHost: x\r\n%s\r\n" % (version, header)).encode())
+        assert req.keep_alive == keep_alive, (version, connection)
+
+def test_choose_content_encoding():
+    choose = http.choose_content_encoding
+    assert choose("") is None
+    assert choose("gzip, deflate") == "gzip"
+    assert choose("deflate, gzip") == "gzip"    # a tie goes to the one we prefer
+    assert choose("gzip;q=0.5, deflate") == "deflate"
+    assert choose("gzip ; level=1 ; Q = 0.2, deflate;q=0.3") == "deflate"
+    assert choose("x-gzip") == "gzip"
+    assert choose("br, identity") is None
+    assert choose("gzip;q=0, *") == "deflate"
+    assert choose("*;q=0, deflate") == "deflate"
+    assert choose("gzip;q=0, deflate;q=0") is None
+    assert choose("gzip;q=abc") is None
+
+def test_compression_cache_is_keyed_by_etag_and_encoding(monkeypatch):
+    monkeypatch.setattr(http, "compression_cache", http.CompressionCache(1024 * 1024))
+    body = b"hello there " * 200
+    gz, enc = http.compress_content(body, "text/plain", "gzip", etag="v1")
+    assert enc == "gzip" and gzip.decompress(gz) == body
+    df, enc = http.compress_content(body, "text/plain", "deflate", etag="v1")
+    assert enc == "deflate" and zlib.decompress(df) == body
+    assert set(http.compression_cache.entries) == {("v1", "gzip"), ("v1", "deflate")}
+    # a cached variant is used for the same etag, whatever the body
+    assert http.compress_content(b"x" * 2000, "text/plain", "gzip", etag="v1") == (gz, "gzip")
+    other, enc = http.compress_content(b"x" * 2000, "text/plain", "gzip", etag="v2")
+    assert gzip.decompress(other) == b"x" * 2000
+    # too small, not compressible, or not accepted: sent as-is, and not cached
+    for args in [(b"tiny", "text/plain", "gzip"), (body, "image/png", "gzip"), (body, "text/plain", "br")]:
+        assert http.compress_content(*args, etag="v3") == (args[0], None)
+    assert len(http.compression_cache.entries) == 3
+
+def test_encode_headers(monkeypatch):
+    monkeypatch.setattr(http.time, "time", lambda: 1700000000.5)
+    resp = http.HTTPResponse("404 NOT FOUND", "text/html", "<p>gone</p>")
+    resp.add_header("Location", "/x")
+    assert resp.encode_headers(False) == (b"HTTP/1.1 404 NOT FOUND\r\n"
+        b"Date: Tue, 14 Nov 2023 22:13:20 GMT\r\nConnection: close\r\n"
+        b"Content-Type: text/html\r\nVary: Accept-Encoding\r\nContent-Length: 11\r\nLocation: /x\r\n\r\n")
+    streamed = http.HTTPResponse("200 OK", "image/png", iter([b"x"]))
+    assert streamed.encode_headers(True) == (b"HTTP/1.1 200 OK\r\n"
+        b"Date: Tue, 14 Nov 2023 22:13:20 GMT\r\nConnection: keep-alive\r\n"
+        b"Content-Type: image/png\r\nTransfer-Encoding: chunked\r\n\r\n")
+
+def test_date_header_changes_with_the_second(monkeypatch):
+    now = [1700000000.1]
+    monkeypatch.setattr(http.time, "time", lambda: now[0])
+    first = http.http_date_header()
+    now[0] = 1700000000.9
+    assert http.http_date_header() is first
+    now[0] = 1700000001.0
+    assert http.http_date_header() == b"Date: Tue, 14 Nov 2023 22:13:21 GMT\r\n"
+
+def test_streamed_response_is_sent_chunked(monkeypatch):
+    monkeypatch.setattr(http, "min_chunk_size", 10)
+    a, b = socket.socketpair()
+    conn = http.HTTPConnection(SmartSocket(b), ("127.0.0.1", 1234))
+    writes = []
+    sendmsg_all = conn.sock.sendmsg_all
+    conn.sock.sendmsg_all = lambda bufs: (writes.append(b"".join(bufs)), sendmsg_all(bufs))
+    try:
+        pieces = ["small", b"", b"another piece", b"x" * 30, "end"]
+        http.send_response(conn, http.HTTPResponse("200 OK", "application/octet-stream", iter(pieces)))
+        reply = SmartSocket(a)
+        assert b"Transfer-Encoding: chunked" in reply.recv_until(b"\r\n\r\n")
+        body = list(http.recv_chunked_body(reply))
+    finally:
+        a.close()
+        b.close()
+    assert body == [b"smallanother piece", b"x" * 30, b"end"]
+    # the headers go out with the first chunk, and the end marker with the last
+    assert len(writes) == 3
+    assert writes[0].startswith(b"HTTP/1.1 200 OK") and writes[-1].endswith(b"end\r\n0\r\n\r\n")
@@ -0,0 +1,48 @@
+# Tests for the binary inventory format, see inventory_wire.py.
+
+import pytest
+
+import inventory_wire
+
+def decode(stream, piece_size):
+    decoder = inventory_wire.InventoryDecoder()
+    records = []
+    for i in range(0, len(stream), piece_size):
+        records.extend(decoder.feed(stream[i:i + piece_size]))
+    decoder.finish()
+    return decoder, records
+
+def test_round_trip_in_pieces_of_any_size(monkeypatch):
+    monkeypatch.setattr(inventory_wire, "records_per_block", 3)
+    records = [("file-%d, with & in it.txt" % (i), i * 1000, 10**18 + i, bytes([i]) * 16) for i in range(1, 8)]
+    records += [("gone.txt", None, None, None), ("café.txt", 0, 5, None)]
+    fields = inventory_wire.parse_fields("mtime, digest")
+    stream = b"".join(inventory_wire.encode_inventory(42, records, delta=True, fields=fields))
+    for piece_size in [1, 7, 100, len(stream)]:
+        decoder, decoded = decode(stream, piece_size)
+        assert (decoder.version, decoder.delta, decoder.fields) == (42, True, fields)
+        assert decoded == records
+
+def test_fields_not_asked_for_are_none():
+    stream = b"".join(inventory_wire.encode_inventory(1, [("a.txt", 3, 99, b"x" * 16)]))
+    decoder, decoded = decode(stream, 5)
+    assert decoder.delta is False
+    assert decoded == [("a.txt", 3, None, None)]
+
+def test_empty_listing():
+    decoder, decoded = decode(b"".join(inventory_wire.encode_inventory(7, [])), 3)
+    assert decoder.version == 7 and decoded == []
+
+def test_bad_streams_are_rejected():
+    stream = b"".join(inventory_wire.encode_inventory(1, [("a.txt", 3, None, None), ("b.txt", 4, None, None)]))
+    decoder = inventory_wire.InventoryDecoder()
+    decoder.feed(stream[:-1])
+    with pytest.raises(ValueError):
+        decoder.finish()
+    with pytest.raises(ValueError):
+        inventory_wire.InventoryDecoder().feed(b"NOTINV" + stream[6:])
+    with pytest.raises(ValueError):
+        inventory_wire.InventoryDecoder().feed(stream + b"x")
+    end = inventory_wire.block_header.pack(inventory_wire.kind_end, 3, 0)
+    with pytest.raises(ValueError):
+        inventory_wire.InventoryDecoder().feed(stream[:-len(end)] + end)
@@ -0,0 +1,41 @@
+# Tests for memory-mapped reads of big shared files, see mapped_files.py.
+
+import os
+
+import mapped_files
+
+def write(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)   # the way files in ./share/ are replaced
+
+def test_big_files_are_mapped_once_and_remapped_when_replaced(tmp_path, monkeypatch):
+    monkeypatch.setattr(mapped_files, "min_size", 100)
+    cache = mapped_files.MappedFileCache(2)
+    small, big = str(tmp_path / "small"), str(tmp_path / "big")
+    write(small, b"s" * 99)
+    write(big, b"b" * 100)
+    assert cache.read(small) == b"s" * 99
+    first = cache.read(big)
+    assert isinstance(first, memoryview) and first == b"b" * 100
+    mapping = cache.entries[big][2]
+    cache.read(big)
+    assert cache.entries[big][2] is mapping
+    write(big, b"c" * 200)
+    assert cache.read(big) == b"c" * 200
+    assert first == b"b" * 100   # still reads the old file
+    cache.invalidate(big)
+    assert big not in cache.entries
+
+def test_only_the_most_recently_used_are_kept(tmp_path, monkeypatch):
+    monkeypatch.setattr(mapped_files, "min_size", 1)
+    cache = mapped_files.MappedFileCache(2)
+    paths = [str(tmp_path / ("f%d" % (i))) for i in range(3)]
+    for path in paths:
+        write(path, b"x")
+    cache.read(paths[0])
+    cache.read(paths[1])
+    cache.read(paths[0])
+    cache.read(paths[2])
+    assert list(cache.entries) == [paths[0], paths[2]]
@@ -0,0 +1,15 @@
+# Tests for the cloud metadata cache, see metadata.py.
+
+import metadata
+
+def test_cache_is_only_used_on_the_same_host_and_boot(tmp_path, monkeypatch):
+    monkeypatch.setenv("CLOUD_METADATA_CACHE", str(tmp_path / "metadata-cache.json"))
+    ident = metadata.Identity("aws", "host.example.com", "192.0.2.1", "us-east-1a", "us-east-1")
+    metadata.save_cached_identity(ident)
+    assert metadata.load_cached_identity() == ident
+    monkeypatch.setattr(metadata, "boot_id", lambda: "another-boot")
+    assert metadata.load_cached_identity() is None
+    monkeypatch.undo()
+    monkeypatch.setenv("CLOUD_METADATA_CACHE", str(tmp_path / "metadata-cache.json"))
+    monkeypatch.setattr(metadata.socket, "gethostname", lambda: "another-host")
+    assert metadata.load_cached_identity() is None
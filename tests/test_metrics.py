@@ -0,0 +1,50 @@
+# Tests for the per-thread metric shards, see metrics.py.
+
+import threading
+
+import metrics
+
+def run_threads(n, fn):
+    for i in range(n):
+        t = threading.Thread(target=fn)
+        t.start()
+        t.join()
+
+def test_shards_of_exited_threads_dont_pile_up_without_scrapes():
+    c = metrics.Counter("test_shards_total", "Test counter.")
+    run_threads(1000, lambda: c.inc())
+    assert len(metrics.live_shards) < 32
+    assert metrics.collect_shards()[(c, ())] == 1000
+
+def test_histograms_survive_retiring():
+    h = metrics.Histogram("test_retire_seconds", "Test histogram.", buckets=[1.0])
+    run_threads(40, lambda: h.observe(0.5))
+    run_threads(40, lambda: h.observe(2.0))
+    counts = metrics.collect_shards()[(h, ())]
+    assert counts[0] == 40 and counts[1] == 40 and counts[2] == 100.0
+
+def test_render_text_format(monkeypatch):
+    monkeypatch.setattr(metrics, "all_metrics", [])
+    monkeypatch.setattr(metrics, "collectors", [])
+    c = metrics.Counter("test_render_total", "Things done.", ["route", "status"])
+    g = metrics.Gauge("test_render_open", "Things open.", fn=lambda: 3)
+    h = metrics.Histogram("test_render_seconds", "How long.", buckets=[0.1, 1.0])
+    c.inc(("view", "200"), 2)
+    c.inc(("a\"b\\c\nd", "404"))
+    h.observe(0.05)
+    h.observe(0.5)
+    h.observe(5.0)
+    metrics.register_collector(lambda: [("test_render_seen_total", "counter", "Seen.", 7)])
+    text = metrics.render_metrics()
+    assert text.endswith("\n")
+    lines = text.splitlines()
+    for line in ["# HELP test_render_total Things done.", "# TYPE test_render_total counter",
+            'test_render_total{route="view",status="200"} 2',
+            'test_render_total{route="a\\"b\\\\c\\nd",status="404"} 1',
+            "# TYPE test_render_open gauge", "test_render_open 3",
+            "# TYPE test_render_seconds histogram",
+            'test_render_seconds_bucket{le="0.1"} 1', 'test_render_seconds_bucket{le="1.0"} 2',
+            'test_render_seconds_bucket{le="+Inf"} 3', "test_render_seconds_sum 5.55",
+            "test_render_seconds_count 3",
+            "# TYPE test_render_seen_total counter", "test_render_seen_total 7"]:
+        assert line in lines, line
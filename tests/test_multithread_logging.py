@@ -0,0 +1,37 @@
+# Tests for rate-limited logging, see log_sampled() in multithread_logging.py.
+
+import threading
+
+import multithread_logging as logging
+
+def test_log_sampled_limits_each_key_per_second(monkeypatch):
+    sent = []
+    now = [100.0]
+    monkeypatch.setattr(logging, "enqueue", lambda level, msg, args: sent.append(msg % args))
+    monkeypatch.setattr(logging.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(logging, "sample_windows", {})
+    monkeypatch.setattr(logging, "log_level", logging.INFO)
+    for i in range(25):
+        logging.log_sampled("k", "message %d", i)
+    logging.log_sampled("other", "other message")
+    assert sent == ["message %d" % (i) for i in range(10)] + ["other message"]
+    now[0] += 1.0
+    logging.log_sampled("k", "later")
+    assert sent[-2:] == ["(15 similar messages suppressed)", "later"]
+
+def test_log_sampled_from_many_threads(monkeypatch):
+    sent = []
+    monkeypatch.setattr(logging, "enqueue", lambda level, msg, args: sent.append(msg))
+    monkeypatch.setattr(logging.time, "monotonic", lambda: 100.0)
+    monkeypatch.setattr(logging, "sample_windows", {})
+    monkeypatch.setattr(logging, "log_level", logging.INFO)
+    def spam():
+        for i in range(1000):
+            logging.log_sampled("k", "message")
+    threads = [threading.Thread(target=spam) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # approximate under contention, but still close to the limit
+    assert 10 <= len(sent) <= 20
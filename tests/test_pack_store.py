@@ -0,0 +1,95 @@
+# Tests for the pack store for small files, see pack_store.py.
+
+import os
+
+import blob_store
+import pack_store
+
+def put(packs, name, data, mtime_ns=1):
+    packs.put(name, data, mtime_ns, blob_store.content_digest(data))
+
+def reopen(pack_dir, saved=None):
+    packs = pack_store.PackStore(pack_dir)
+    packs.open(saved)
+    return packs
+
+def contents(packs):
+    return { name: packs.get(name) for name in packs.entries() }
+
+def test_put_get_remove_and_reopen(tmp_path):
+    pack_dir = str(tmp_path / "share.packs")
+    packs = reopen(pack_dir)
+    put(packs, "a.txt", b"one", 5)
+    put(packs, "b.txt", b"two")
+    put(packs, "a.txt", b"three", 6)
+    assert packs.remove("b.txt")
+    assert not packs.remove("b.txt")
+    put(packs, "empty.txt", b"")
+    expected = { "a.txt": b"three", "empty.txt": b"" }
+    assert contents(packs) == expected
+    assert packs.entries()["a.txt"] == (5, 6, blob_store.content_digest(b"three"))
+    assert contents(reopen(pack_dir)) == expected
+
+def test_reopen_from_saved_state_reads_only_newer_records(tmp_path):
+    pack_dir = str(tmp_path / "share.packs")
+    packs = reopen(pack_dir)
+    put(packs, "a.txt", b"one")
+    saved = packs.state()
+    put(packs, "b.txt", b"two")
+    packs.remove("a.txt")
+    packs = pack_store.PackStore(pack_dir)
+    how = packs.open(saved)
+    assert "read %d bytes" % (2 * pack_store.record_header.size + len("b.txt") + 3 + len("a.txt")) in how
+    assert contents(packs) == { "b.txt": b"two" }
+
+def test_a_record_cut_short_is_cut_off(tmp_path):
+    pack_dir = str(tmp_path / "share.packs")
+    packs = reopen(pack_dir)
+    put(packs, "a.txt", b"one")
+    put(packs, "b.txt", b"two")
+    path = packs.pack_path(1)
+    good = os.path.getsize(path)
+    with open(path, "ab") as f:
+        f.write(pack_store.record_header.pack(0, 1000, 5, pack_store.kind_put, 0, bytes(16)) + b"c.txt")
+    packs = reopen(pack_dir)
+    assert contents(packs) == { "a.txt": b"one", "b.txt": b"two" }
+    assert os.path.getsize(path) == good
+    put(packs, "c.txt", b"three")
+    assert contents(reopen(pack_dir)) == { "a.txt": b"one", "b.txt": b"two", "c.txt": b"three" }
+
+def test_a_corrupt_record_is_dropped(tmp_path):
+    pack_dir = str(tmp_path / "share.packs")
+    packs = reopen(pack_dir)
+    put(packs, "a.txt", b"one")
+    put(packs, "b.txt", b"two")
+    path = packs.pack_path(1)
+    with open(path, "r+b") as f:
+        f.seek(-1, os.SEEK_END)
+        f.write(b"X")
+    assert contents(reopen(pack_dir)) == { "a.txt": b"one" }
+
+def test_compaction_keeps_live_records_and_needed_tombstones(tmp_path, monkeypatch):
+    monkeypatch.setattr(pack_store, "max_pack_size", 1000)
+    pack_dir = str(tmp_path / "share.packs")
+    packs = reopen(pack_dir)
+    data = { "file-%d.txt" % (i): bytes([i]) * 100 for i in range(20) }
+    for name, d in data.items():
+        put(packs, name, d)
+    assert len(packs.packs) > 3
+    # replace or remove most of the files, leaving the older packs mostly dead
+    for i in range(15):
+        name = "file-%d.txt" % (i)
+        if i % 2 == 0:
+            packs.remove(name)
+            del data[name]
+        else:
+            data[name] = b"new" * i
+            put(packs, name, data[name])
+    before = sum(os.path.getsize(packs.pack_path(num)) for num in packs.packs)
+    assert packs.compact() > 0
+    after = sum(os.path.getsize(packs.pack_path(num)) for num in packs.packs)
+    assert after < before
+    assert sorted(os.listdir(pack_dir)) == sorted(os.path.basename(packs.pack_path(num)) for num in packs.packs)
+    assert contents(packs) == data
+    assert contents(reopen(pack_dir)) == data
+    assert contents(reopen(pack_dir, packs.state())) == data
@@ -0,0 +1,101 @@
+# Tests for the framed RPC protocol, see rpc.py.
+
+import itertools
+import socket
+
+import pytest
+
+import rpc
+from smartsocket import SmartSocket
+
+def linked_pair(handlers_a, handlers_b):
+    sa, sb = socket.socketpair()
+    a = rpc.Connection(SmartSocket(sa), handlers_a)
+    b = rpc.Connection(SmartSocket(sb), handlers_b)
+    a.start()
+    b.start()
+    return a, b
+
+def test_call_and_error():
+    def fail(link, payload):
+        raise ValueError("no good")
+    a, b = linked_pair({}, { "echo": lambda link, payload: payload, "fail": fail })
+    try:
+        assert a.call("echo", b"hello") == b"hello"
+        assert a.call("echo") == b""
+        with pytest.raises(rpc.RPCError, match="no good"):
+            a.call("fail")
+        with pytest.raises(rpc.RPCError, match="no such method"):
+            a.call("missing")
+    finally:
+        a.close()
+        b.close()
+
+def test_big_messages_are_split_and_put_back_together(monkeypatch):
+    monkeypatch.setattr(rpc, "max_frame", 1000)
+    frames = []
+    def reply(link, payload):
+        return (bytes([i]) * 700 for i in range(10))   # a generator of pieces
+    a, b = linked_pair({}, { "big": reply, "echo": lambda link, payload: payload })
+    send_frame = b.send_frame
+    def counting_send_frame(req_id, kind, flags, payload):
+        frames.append((flags, len(payload)))
+        send_frame(req_id, kind, flags, payload)
+    b.send_frame = counting_send_frame
+    try:
+        assert a.call("big") == b"".join(bytes([i]) * 700 for i in range(10))
+        assert frames == [(rpc.flag_more, 1000)] * 6 + [(0, 1000)]
+        data = bytes(range(256)) * 20
+        assert a.call("echo", data) == data
+    finally:
+        a.close()
+        b.close()
+
+def test_request_ids_wrap_around_within_32_bits():
+    link = rpc.Connection(None, {})
+    link.ids = itertools.count(0xfffffffe)
+    ids = [link.next_id() for i in range(4)]
+    assert ids == [0xfffffffe, 0xffffffff, 1, 2]
+    rpc.frame_header.pack(0, ids[1], rpc.kind_call, 0)
+
+# Send raw frames to a started Connection, and wait for it to hang up.
+def hangs_up_after(frames):
+    sa, sb = socket.socketpair()
+    link = rpc.Connection(SmartSocket(sb), {})
+    link.start()
+    try:
+        for length, req_id, kind, flags in frames:
+            sa.sendall(rpc.frame_header.pack(length, req_id, kind, flags) + b"x" * length)
+    except OSError:
+        pass   # it may hang up before we finish sending
+    sa.settimeout(5)
+    try:
+        return sa.recv(1) == b""
+    except ConnectionResetError:
+        return True
+    finally:
+        sa.close()
+
+def test_oversize_frame_closes_the_connection(monkeypatch):
+    monkeypatch.setattr(rpc, "max_frame", 1000)
+    assert hangs_up_after([(1001, 1, rpc.kind_call, 0)])
+
+def test_too_many_or_too_big_split_messages_close_the_connection(monkeypatch):
+    monkeypatch.setattr(rpc, "max_frame", 1000)
+    monkeypatch.setattr(rpc, "max_partial_messages", 3)
+    monkeypatch.setattr(rpc, "max_partial_bytes", 2500)
+    assert hangs_up_after([(10, i, rpc.kind_notify, rpc.flag_more) for i in range(1, 5)])
+    assert hangs_up_after([(1000, 1, rpc.kind_notify, rpc.flag_more)] * 3)
+
+def test_finished_split_messages_free_their_space(monkeypatch):
+    monkeypatch.setattr(rpc, "max_frame", 1000)
+    monkeypatch.setattr(rpc, "max_partial_bytes", 2500)
+    a, b = linked_pair({}, { "echo": lambda link, payload: payload })
+    try:
+        data = b"y" * 2000
+        for i in range(5):
+            assert a.call("echo", data) == data
+        assert (b.partial, b.partial_bytes) == ({}, 0)
+    finally:
+        a.close()
+        b.close()
@@ -0,0 +1,117 @@
+# Tests for the share index, see share_index.py.
+
+import json
+import os
+
+import blob_store
+import pack_store
+import share_index
+
+def new_index(tmp_path):
+    index = share_index.ShareIndex(str(tmp_path / "share"), str(tmp_path / "share-index.json"))
+    index.load()
+    return index
+
+big = b"b" * (pack_store.small_file_limit + 1)
+small = b"small"
+
+def test_crash_while_packing_keeps_the_packed_copy(tmp_path):
+    index = new_index(tmp_path)
+    index.store("a.txt", big)
+    index.save_snapshot()
+    # store_packed() puts the new copy in the packs and then removes the old
+    # file in ./share/, so a crash in between leaves both
+    index.packs.put("a.txt", small, index.entry("a.txt")[1] + 1, blob_store.content_digest(small))
+    index = new_index(tmp_path)
+    assert index.read("a.txt") == small
+    assert not os.path.exists(index.path("a.txt"))
+    assert index.listing() == [("a.txt", len(small))]
+
+def test_crash_while_unpacking_keeps_the_file_in_share(tmp_path):
+    index = new_index(tmp_path)
+    index.store("a.txt", small)
+    index.save_snapshot()
+    # commit() renames the new file into ./share/ and then removes the old
+    # copy from the packs, so a crash in between leaves both
+    digest, staged = index.blobs.stage(big)
+    os.replace(staged, index.layout.make_path("a.txt"))
+    index = new_index(tmp_path)
+    assert index.read("a.txt") == big
+    assert index.packs.get("a.txt") is None
+    assert index.listing() == [("a.txt", len(big))]
+
+def test_rescan_checks_size_and_mtime_not_just_inode(tmp_path):
+    index = new_index(tmp_path)
+    index.store("same.txt", big)
+    index.store("other.txt", big + b"x")
+    digest = index.entry("same.txt")[2]
+    index.save_snapshot()
+    # pretend other.txt was replaced by a file that got the old one's inode
+    # number, and that its folder changed since the snapshot
+    with open(index.snapshot_path) as f:
+        snapshot = json.load(f)
+    for folder, (mtime, group) in snapshot["folders"].items():
+        snapshot["folders"][folder][0] = mtime - 1
+        if "other.txt" in group:
+            group["other.txt"][0] = 5
+    with open(index.snapshot_path, "w") as f:
+        json.dump(snapshot, f)
+    index = new_index(tmp_path)
+    assert index.entry("other.txt")[0] == len(big) + 1
+    assert index.entry("same.txt")[2] == digest
+
+def test_format_and_parse_changes():
+    changes = [("a.txt", 12), ("b, with comma.pdf", 0), ("gone.txt", None)]
+    text = share_index.format_changes(changes)
+    assert text == "+a.txt,12&+b, with comma.pdf,0&-gone.txt"
+    assert share_index.parse_changes(text) == changes
+    assert share_index.parse_changes("") == []
+
+def test_changes_since(tmp_path, monkeypatch):
+    monkeypatch.setattr(share_index, "max_changes", 5)
+    index = new_index(tmp_path)
+    index.store("a.txt", small)
+    index.store("b.txt", big)
+    since = index.version
+    index.store("c.txt", small)
+    index.store("a.txt", b"bigger")
+    index.remove("b.txt")
+    changes, version = index.changes_since(since)
+    assert version == index.version
+    assert changes == [("a.txt", 6), ("b.txt", None), ("c.txt", len(small))]
+    records, version = index.changes_since(since, as_records=True)
+    assert [(name, size) for name, size, mtime_ns, digest in records] == changes
+    assert index.changes_since(index.version) == ([], index.version)
+    assert index.changes_since(index.version + 1)[0] is None     # from the future
+    index.store("d.txt", small)
+    index.store("e.txt", small)
+    assert index.changes_since(since)[0] is not None     # just enough log left
+    index.store("f.txt", small)
+    assert index.changes_since(since)[0] is None     # the log doesn't go back that far
+    # a restart starts a new log, at a higher version
+    index.save_snapshot()
+    old_version = index.version
+    index = new_index(tmp_path)
+    assert index.version > old_version
+    assert index.changes_since(old_version)[0] is None
+
+def test_unchanged_snapshot_is_reused_without_scanning(tmp_path):
+    index = new_index(tmp_path)
+    for i in range(20):
+        index.store("file-%d.txt" % (i), big + bytes([i]), 1000 + i)
+    index.store("small.txt", small, 5000)
+    index.remove("file-3.txt")
+    index.save_snapshot()
+    entries, version = index.entries()
+    index = share_index.ShareIndex(index.share_dir, index.snapshot_path)
+    how = index.load()
+    assert "snapshot is current, no scan needed" in how
+    assert index.entries()[0] == entries
+    # a file added behind the index's back is found by scanning its folder
+    with open(index.layout.make_path("extra.txt"), "wb") as f:
+        f.write(b"extra")
+    index = share_index.ShareIndex(index.share_dir, index.snapshot_path)
+    how = index.load()
+    assert "1 files were new or changed" in how
+    assert index.entry("extra.txt")[0] == 5 and index.entry("extra.txt")[2] is None
+    assert index.entry("file-5.txt") == entries["file-5.txt"]
@@ -0,0 +1,56 @@
+# Tests for the ./share/ folder layouts and moving between them, see
+# share_layout.py.
+
+import os
+
+import share_layout
+
+names = ["notes.txt", "a", "3", "f", "photo.jpg"] + ["file-%d.txt" % (i) for i in range(50)]
+
+def make_flat(root):
+    os.makedirs(root)
+    for name in names:
+        with open(os.path.join(root, name), "w") as f:
+            f.write(name)
+
+def check(root, layout_name):
+    layout = share_layout.layouts[layout_name](root)
+    assert share_layout.read_layout_name(root) == layout_name
+    assert share_layout.open_layout(root).name == layout_name
+    assert sorted(entry.name for entry in layout.files()) == sorted(names)
+    for name in names:
+        with open(layout.path(name)) as f:
+            assert f.read() == name
+    assert not os.path.exists(root + ".migrating")
+
+def test_a_folder_already_holding_files_is_flat(tmp_path):
+    root = str(tmp_path / "share")
+    make_flat(root)
+    assert share_layout.read_layout_name(root) == "flat"
+    assert share_layout.read_layout_name(str(tmp_path / "new")) == share_layout.default_layout
+
+def test_migrate_there_and_back(tmp_path):
+    root = str(tmp_path / "share")
+    make_flat(root)
+    assert share_layout.open_layout(root).name == "flat"
+    assert share_layout.migrate(root, "sharded") == len(names)
+    check(root, "sharded")
+    assert share_layout.migrate(root, "flat") == len(names)
+    check(root, "flat")
+    assert sorted(os.listdir(root)) == sorted(names)
+
+def test_migrate_finishes_an_interrupted_run(tmp_path):
+    root = str(tmp_path / "share")
+    make_flat(root)
+    # as migrate() leaves it part way through: files named like shard folders
+    # moved to one side, and some of the others moved to their new places
+    os.mkdir(root + ".migrating")
+    for name in names:
+        if share_layout.is_shard_name(name):
+            os.rename(os.path.join(root, name), os.path.join(root + ".migrating", name))
+    sharded = share_layout.ShardedLayout(root)
+    for name in names[10:30]:
+        os.rename(os.path.join(root, name), sharded.make_path(name))
+    share_layout.migrate(root, "sharded")
+    check(root, "sharded")
+    assert share_layout.migrate(root, "sharded") == 0
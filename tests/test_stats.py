@@ -0,0 +1,38 @@
+# Tests for the per-thread statistics counters, see stats.py.
+
+import threading
+
+import metrics
+import stats
+
+def run_threads(n, fn):
+    for i in range(n):
+        t = threading.Thread(target=fn)
+        t.start()
+        t.join()
+
+def test_totals_include_exited_threads():
+    group = stats.StatsGroup(["a", "b"])
+    group.add("a")
+    run_threads(50, lambda: group.update(a=1, b=2))
+    assert group.snapshot() == { "a": 51, "b": 100 }
+    assert len(group.shards) == 1    # just this thread's shard is left
+
+def test_shards_of_exited_threads_dont_pile_up_without_snapshots():
+    group = stats.StatsGroup(["n"])
+    run_threads(1000, lambda: group.add("n"))
+    assert len(group.shards) < 32
+    assert group.get("n") == 1000
+
+def test_exported_counters_and_gauges(monkeypatch):
+    monkeypatch.setattr(metrics, "collectors", [])
+    group = stats.StatsGroup(["so_far", "now"])
+    group.update(so_far=5, now=2)
+    group.export_metrics({
+        "so_far": ("test_things_total", "counter", "Things so far."),
+        "now": ("test_things_open", "gauge", "Things now."),
+    })
+    lines = metrics.render_metrics().splitlines()
+    for line in ["# TYPE test_things_total counter", "test_things_total 5",
+            "# TYPE test_things_open gauge", "test_things_open 2"]:
+        assert line in lines, line
@@ -0,0 +1,34 @@
+# Tests for trace IDs passed in from outside, see tracing.py.
+
+import http_helpers as http
+import tracing
+
+def request(headers={}, params={}):
+    return http.HTTPRequest(headers=http.CaseInsensitiveDict(headers), params=dict(params))
+
+def test_incoming_trace_id_accepts_generated_ids():
+    trace_id = tracing.new_trace_id()
+    assert tracing.incoming_trace_id(request({ "X-Trace-Id": trace_id })) == trace_id
+    assert tracing.incoming_trace_id(request(params={ "trace": trace_id })) == trace_id
+
+def test_incoming_trace_id_rejects_anything_else():
+    for bad in ["zz\r\nSet-Cookie: pwned=1", "0123456789ABCDEF", "0123456789abcdef0", "", "abc"]:
+        assert tracing.incoming_trace_id(request({ "X-Trace-Id": bad })) is None
+        assert tracing.incoming_trace_id(request(params={ "trace": bad })) is None
+
+def test_begin_trace_replaces_bad_ids():
+    t = tracing.begin_trace(request(params={ "trace": "x\r\nLocation: evil" }), "test")
+    try:
+        assert "\r" not in t.trace_id and len(t.trace_id) == 16
+        path = tracing.add_trace_param("/upload?filelist=a.txt")
+        assert path == "/upload?filelist=a.txt&trace=" + t.trace_id
+    finally:
+        tracing.end_trace()
+
+def test_add_trace_param_quotes_the_id():
+    t = tracing.begin_trace(request(), "test")
+    try:
+        t.trace_id = "a b\r\nc"
+        assert tracing.add_trace_param("/x") == "/x?trace=a%20b%0D%0Ac"
+    finally:
+        tracing.end_trace()
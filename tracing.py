@@ -0,0 +1,158 @@
+# Request tracing for the cloud file storage servers.
+# Intended usage:
+#   import tracing
+#   trace = tracing.begin_trace(req, "central")  # when a request arrives
+#   with tracing.phase("fanout"):                 # anywhere while handling it
+#       ...
+#   tracing.end_trace()                           # when the response is sent
+#   print(tracing.slowest_report(10))
+#
+# Each request gets a trace ID. The central coordinator makes up a new one, and
+# passes it along to replicas in the X-Trace-Id header on internal requests, or
+# in a "trace" url parameter when redirecting a browser to a replica (since we
+# can't make the browser send a header). The replica picks it up and uses the
+# same ID, so the two halves of a slow download can be matched up.
+#
+# While a request is being handled, the time spent in each phase (parsing the
+# headers, reading the body, looking up the catalog, fanning out to replicas,
+# reading from disk, sending the response, etc.) is recorded. Finished traces go
+# into a fixed-size ring buffer, which can be searched for the slowest ones from
+# the back-end diagnostic port.
+
+import threading    # for threading.local()
+import collections  # for collections.deque
+import time         # for time.perf_counter()
+import os           # for os.urandom()
+import re           # for checking trace IDs
+import urllib.parse # for quoting trace IDs in urls
+
+trace_header = "X-Trace-Id"   # header used to pass trace IDs between servers
+trace_param = "trace"         # url parameter used to pass trace IDs on redirects
+
+max_traces = 2000             # how many finished traces to keep
+finished_traces = collections.deque(maxlen=max_traces)
+
+current = threading.local()   # the trace being recorded by this thread, if any
+
+# Trace holds the timings for one request on this server.
+class Trace:
+    def __init__(self, trace_id, hop, method, path):
+        self.trace_id = trace_id  # shared by all servers that handle this request
+        self.hop = hop            # which kind of server recorded it, like "central" or "replica"
+        self.method = method
+        self.path = path
+        self.start = time.perf_counter()
+        self.total = None         # seconds, set when the trace ends
+        self.phases = []          # (name, seconds, detail) for each phase
+        self.status = None        # response status code, like "200"
+
+    def add_phase(self, name, seconds, detail=None):
+        self.phases.append((name, seconds, detail))
+
+# Make up a new trace ID.
+def new_trace_id():
+    return os.urandom(8).hex()
+
+# Return the trace ID sent to us along with a request, or None if there isn't
+# one. Anything that doesn't look like an ID from new_trace_id() is ignored,
+# since trace IDs end up in the Location headers of redirects, and in logs.
+def incoming_trace_id(req):
+    trace_id = req.headers.get(trace_header)
+    if trace_id is None:
+        trace_id = req.params.get(trace_param)
+    if trace_id is None or re.fullmatch("[0-9a-f]{16}", trace_id) is None:
+        return None
+    return trace_id
+
+# Start recording a trace for a request that just arrived. The request's own
+# timings (see http_helpers.recv_one_request_from_client) become the first
+# phases. This returns the new Trace, which is also this thread's current trace.
+def begin_trace(req, hop):
+    trace_id = incoming_trace_id(req)
+    if trace_id is None:
+        trace_id = new_trace_id()
+    t = Trace(trace_id, hop, req.method, req.path)
+    if req.timings is not None:
+        t.start = req.timings[0][1]
+        prev = t.start
+        for name, when in req.timings[1:]:
+            t.add_phase(name, when - prev)
+            prev = when
+    current.trace = t
+    return t
+
+# Return this thread's current trace, or None.
+def current_trace():
+    return getattr(current, "trace", None)
+
+# Return this thread's current trace ID, or None.
+def current_trace_id():
+    t = getattr(current, "trace", None)
+    if t is None:
+        return None
+    return t.trace_id
+
+# Finish this thread's current trace and put it in the ring buffer.
+def end_trace(status=None):
+    t = getattr(current, "trace", None)
+    if t is None:
+        return
+    current.trace = None
+    t.total = time.perf_counter() - t.start
+    t.status = status
+    finished_traces.append(t)
+
+# phase is used in a with statement, to record how long the code inside takes:
+#   with tracing.phase("disk_io", filename):
+#       data = f.read()
+# If this thread isn't recording a trace, it does nothing.
+class phase:
+    def __init__(self, name, detail=None):
+        self.name = name
+        self.detail = detail
+
+    def __enter__(self):
+        self.trace = getattr(current, "trace", None)
+        if self.trace is not None:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.trace is not None:
+            self.trace.add_phase(self.name, time.perf_counter() - self.start, self.detail)
+        return False
+
+# Return the headers to send along with an internal request, so the server on
+# the other end joins this thread's current trace.
+def outgoing_headers():
+    t = getattr(current, "trace", None)
+    if t is None:
+        return {}
+    return { trace_header: t.trace_id }
+
+# Add the current trace ID as a parameter to a url path we are about to
+# redirect a browser to.
+def add_trace_param(path):
+    trace_id = current_trace_id()
+    if trace_id is None:
+        return path
+    sep = "&" if "?" in path else "?"
+    return path + sep + trace_param + "=" + urllib.parse.quote(trace_id, safe="")
+
+# Return a human-readable report of the n slowest traces in the ring buffer,
+# with their phase timings. If a trace ID is given, show only that trace.
+def slowest_report(n=10, trace_id=None):
+    traces = list(finished_traces)
+    if trace_id is not None:
+        traces = [t for t in traces if t.trace_id == trace_id]
+    traces.sort(key=lambda t: t.total, reverse=True)
+    traces = traces[0:n]
+    lines = ["%d slowest of the last %d requests:" % (len(traces), len(finished_traces))]
+    for t in traces:
+        lines.append("  %8.1f ms  trace=%s  %s %s %s -> %s" % (t.total * 1000, t.trace_id, t.hop, t.method, t.path, t.status))
+        for name, seconds, detail in t.phases:
+            if detail is None:
+                lines.append("      %8.1f ms  %s" % (seconds * 1000, name))
+            else:
+                lines.append("      %8.1f ms  %s (%s)" % (seconds * 1000, name, detail))
+    return "\n".join(lines) + "\n"